@@ -1,11 +1,27 @@
 import argparse
 from colorama import init as coloramaInit, Fore, Style
+from concurrent.futures import ProcessPoolExecutor
+import filecmp
 import glob
+import hashlib
+import importlib.metadata
+import json
+import os
 from pathlib import Path
 import re
 import shutil
 import subprocess
 import asyncio
+import functools
+import sys
+import threading
+import time
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
 
 coloramaInit(convert=True)
 
@@ -54,13 +70,142 @@ def copy_template_to_output(template_dir, output_dir):
         template_files = template_dir.glob("*")
         for f in template_files:
             if f.is_file():
-                shutil.copy(f, output_dir)
+                sync_file(f, output_dir)
+
+
+# All files below a directory (or the file itself) in a stable order
+def tree_files(path):
+    path = Path(path)
+    if path.is_file():
+        return [path]
+    if not path.is_dir():
+        return []
+    return sorted(f for f in path.rglob("*") if f.is_file())
+
+
+def file_digest(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Hash the names and contents of a list of files
+def hash_files(files):
+    h = hashlib.sha256()
+    for f in files:
+        h.update(f"{Path(f).as_posix()}\0{file_digest(f)}\0".encode())
+    return h.hexdigest()
+
+
+# First line of a tool's version output, so outputs are rebuilt when it changes.
+# This is looked up once per run (or once per --watch session).
+@functools.lru_cache(maxsize=None)
+def tool_version(executable):
+    try:
+        completed = subprocess.run(
+            [str(executable), "--version"],
+            capture_output=True,
+            stdin=subprocess.DEVNULL,
+            timeout=30,
+        )
+    except (OSError, subprocess.TimeoutExpired):
+        return ""
+    lines = completed.stdout.decode(errors="replace").splitlines()
+    return lines[0] if lines else ""
+
+
+# The pandoc-pythonexec filter has no --version flag, so use the sciengdox
+# package version and the package sources instead.  The whole package is
+# hashed since the document's code uses it too (e.g. sciengdox.figures).
+@functools.lru_cache(maxsize=None)
+def pythonexec_version():
+    try:
+        version = importlib.metadata.version("sciengdox")
+    except importlib.metadata.PackageNotFoundError:
+        version = ""
+    package_dir = Path(__file__).parent
+    sources = [
+        f
+        for f in tree_files(package_dir)
+        if f.suffix in (".py", ".txt")
+        and "tests" not in f.relative_to(package_dir).parts
+    ]
+    return version + hash_files(sources)
+
+
+# Copy a file unless an identical copy is already in place.  Files are compared
+# by size and modification time first, and by contents if those differ.
+def sync_file(src, dst):
+    src = Path(src)
+    dst = Path(dst)
+    if dst.is_dir():
+        dst = dst.joinpath(src.name)
+    if dst.exists() and filecmp.cmp(src, dst, shallow=True):
+        return False
+    shutil.copy2(src, dst)
+    return True
+
+
+def sync_tree(src_dir, dst_dir):
+    src_dir = Path(src_dir)
+    for f in tree_files(src_dir):
+        destination = Path(dst_dir).joinpath(f.relative_to(src_dir))
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        sync_file(f, destination)
+
+
+# Records a hash of everything an output was built from, so that outputs that
+# are already up to date can be skipped
+class BuildManifest(object):
+    filename = ".compiledoc-manifest.json"
+
+    def __init__(self, output_dir):
+        self._file = Path(output_dir).joinpath(BuildManifest.filename)
+        try:
+            with open(self._file, "r", encoding="utf-8") as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            self._entries = {}
+
+    def up_to_date(self, name, key, output_file):
+        return self._entries.get(name) == key and Path(output_file).exists()
+
+    def record(self, name, key):
+        self._entries[name] = key
+        tmp_file = self._file.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self._entries, f, indent=2)
+        os.replace(tmp_file, self._file)
+
+
+# Key for one pandoc run.  Options that only affect how code is executed (not
+# its results) are left out so that toggling them doesn't force a rebuild.
+def build_key(input_key, params):
+    params = [
+        p
+        for p in params
+        if not p.startswith(
+            (
+                "-Mpythonexec-cache=",
+                "-Mpythonexec-pool=",
+                "-Mpythonexec-checkpoint-after=",
+                "-Mpythonexec-figure-workers=",
+            )
+        )
+    ]
+    return hashlib.sha256(json.dumps([input_key, params]).encode()).hexdigest()
 
 
 # Runs a shell command asynchronously
-async def run(cmd, *args):
+async def run(cmd, *args, cwd=None):
     proc = await asyncio.subprocess.create_subprocess_exec(
-        cmd, *args, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT
+        cmd,
+        *args,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.STDOUT,
+        cwd=cwd,
     )
     stdout, stderr = await proc.communicate()
     if stdout:
@@ -98,27 +243,438 @@ def parse_git_hash():
     return "@" + stdout.strip()
 
 
-def run_pandoc(params, output_path, verbose=False):
-    completedProcess = subprocess.run(params, cwd=str(output_path), capture_output=True)
-    if verbose:
-        print(Fore.YELLOW + f"{completedProcess.stdout.decode()}")
+# Start the interpreter pool once for all builds (including concurrent --jobs
+# workers, which would otherwise each start their own) and remember its socket
+# in the arguments, or turn the pool off if it can't be used
+def use_interpreter_pool(args):
+    if args.pool and args.backend == "python":
+        args.pool_socket = start_interpreter_pool(args.pool_socket, args.pool_preload)
+        args.pool = args.pool_socket is not None
+
+
+# Make sure the pre-warmed interpreter pool is running and return its socket
+def start_interpreter_pool(socket_path, preload):
+    from sciengdox.pandoc_pythonexec import pool
+
+    if not pool.pool_supported():
+        print(Fore.YELLOW + "Interpreter pool is not supported on this platform.")
+        return None
+
+    try:
+        socket_path = socket_path or pool.default_socket_path()
+    except OSError as e:
+        print_error(f"Could not use interpreter pool: {e}")
+        return None
+    if pool.pool_running(socket_path):
+        print(Fore.CYAN + f"Using interpreter pool: {socket_path}")
+    else:
+        print(Fore.CYAN + f"Starting interpreter pool: {socket_path}")
+        if preload is None:
+            preload = pool.default_preload
+        if not pool.start_pool(socket_path, preload):
+            print_error(f"Could not start interpreter pool.  See {socket_path}.log")
+            return None
+    return socket_path
+
+
+# Make the images and static files copied to the output directory available in
+# a scratch directory, as symbolic links where the platform allows it and as
+# copies otherwise
+def link_shared_files(paths, scratch_dir):
+    for path in paths:
+        path = path.absolute()
+        link = scratch_dir.joinpath(path.name)
+        if link.is_symlink():
+            if Path(os.readlink(link)) == path:
+                continue
+            link.unlink()
+        try:
+            os.symlink(path, link, target_is_directory=path.is_dir())
+        except OSError:
+            if path.is_dir():
+                sync_tree(path, link)
+            else:
+                sync_file(path, scratch_dir)
+
+
+# Copy files generated in a scratch directory (e.g. figures written by the
+# Python code) to the output directory.  Template files, links to shared files,
+# and hidden files (e.g. the execution cache) are left behind.  Files are
+# replaced atomically since other formats may publish the same files at the
+# same time.
+def publish_scratch_files(scratch_dir, output_dir, template_dir):
+    template_files = set()
+    if template_dir and template_dir.exists():
+        template_files = {f.name for f in template_dir.glob("*") if f.is_file()}
+
+    for root, dirs, files in os.walk(scratch_dir):
+        root = Path(root)
+        dirs[:] = [d for d in dirs if not d.startswith(".")]
+        for name in files:
+            if name.startswith("."):
+                continue
+            if root == scratch_dir and name in template_files:
+                continue
+            if root.joinpath(name).is_symlink():
+                continue
+            relative = root.relative_to(scratch_dir).joinpath(name)
+            destination = output_dir.joinpath(relative)
+            if destination.exists() and filecmp.cmp(
+                root.joinpath(name), destination, shallow=False
+            ):
+                continue
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            tmp_file = destination.with_name(
+                f".{name}.{os.getpid()}.{scratch_dir.name}.tmp"
+            )
+            shutil.copy2(root.joinpath(name), tmp_file)
+            os.replace(tmp_file, destination)
+
+
+# Build one output format.  pandoc and the document's code run in a scratch
+# directory of their own with a copy of the template files and links to the
+# `shared` images and static files, so concurrent builds of other formats can't
+# interfere with them.  The output and any files written by the code or the
+# filter (e.g. figures or spilled output) are moved to the output directory
+# when it finishes.
+async def build_format(
+    name, params, output_file, template_dir, output_dir, args, shared=()
+):
+    scratch_dir = output_dir.joinpath(".build", name).absolute()
+    scratch_dir.mkdir(parents=True, exist_ok=True)
+    copy_template_to_output(template_dir, scratch_dir)
+    link_shared_files(shared, scratch_dir)
+
+    scratch_output = scratch_dir.joinpath(output_file.name)
+    params = params + [
+        f"-Mpythonexec-cwd={scratch_dir}",
+        f"--resource-path={scratch_dir}{os.pathsep}{output_dir.absolute()}",
+        "--output",
+        str(scratch_output),
+    ]
+
+    print(Fore.CYAN + f"Running pandoc ({name})")
+    start = time.monotonic()
+    code, stdout, _ = await run(*params, cwd=str(scratch_dir))
+    if args.verbose or code != 0:
+        print((Fore.YELLOW if code == 0 else Fore.RED) + f"{stdout or ''}")
+    if code != 0:
+        print_error(f"Building {name} output failed")
+        return code
+
+    os.replace(scratch_output, output_file)
+    publish_scratch_files(scratch_dir, output_dir, template_dir)
+    print(Fore.CYAN + f"Finished {name} output in {time.monotonic() - start:.1f} s")
+    return 0
+
+
+# Whether the builds share one running Jupyter kernel (--kernel-connection).
+# Its namespace is shared too, so only one build may use it at a time.
+def shares_kernel(args):
+    return args.backend == "jupyter" and bool(args.kernel_connection)
+
+
+# Build the given formats concurrently (or one after the other if they share a
+# kernel) and exit if any of them failed.  Formats whose inputs haven't changed
+# since they were last built are skipped.  Returns the names of the formats
+# that were built.
+def build_formats(
+    builds, template_dir, output_dir, args, manifest, input_key, shared=()
+):
+    pending = []
+    for name, params, output_file in builds:
+        key = build_key(input_key, params)
+        if not args.force and manifest.up_to_date(name, key, output_file):
+            print(Fore.GREEN + f"Output is up to date: {output_file.absolute()}")
+        else:
+            pending.append((name, params, output_file, key))
+
+    async def build_all():
+        builds = [
+            build_format(
+                name, params, output_file, template_dir, output_dir, args, shared
+            )
+            for name, params, output_file, key in pending
+        ]
+        if shares_kernel(args):
+            return [await build for build in builds]
+        return await asyncio.gather(*builds)
+
+    codes = asyncio.run(build_all())
+    for (name, params, output_file, key), code in zip(pending, codes):
+        if code == 0:
+            manifest.record(name, key)
+    for code in codes:
+        if code != 0:
+            exit(code)
+
+    return [name for name, params, output_file, key in pending]
+
+
+# Expand glob patterns in the list of inputs (for shells that don't), keeping
+# the order given and dropping duplicates
+def expand_input_patterns(patterns):
+    input_files = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True))
+        for f in matches if matches else [pattern]:
+            path = Path(f)
+            if path not in input_files:
+                input_files.append(path)
+    return input_files
+
+
+# Choose an output subdirectory per document.  Documents are named after the
+# input file, falling back to the path relative to the common parent directory
+# of all inputs for files that share a name.
+def document_output_dirs(input_files, output_dir):
+    stems = [f.stem for f in input_files]
+    common_dir = Path(os.path.commonpath([f.absolute().parent for f in input_files]))
+    names = []
+    for f in input_files:
+        if stems.count(f.stem) == 1:
+            names.append(f.stem)
+        else:
+            relative = f.absolute().relative_to(common_dir).with_suffix("")
+            names.append("-".join(relative.parts))
+    return [output_dir.joinpath(name) for name in names]
+
+
+# Build one document in a worker process, returning its status and timing
+def build_document_job(input_md, output_dir, args):
+    start = time.monotonic()
+    code = 0
+    try:
+        build_document(input_md, output_dir, args)
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            code = e.code or 0
+        else:
+            code = 1
+    except Exception as e:
+        print_error(f"Error building {input_md}: {e}")
+        code = 1
+    return input_md, code, time.monotonic() - start, output_dir
+
+
+def print_build_summary(results):
+    print(Fore.BLUE + "Summary:")
+    for input_md, code, elapsed, output_dir in results:
+        if code == 0:
+            status = Fore.GREEN + f"{'ok':<12}"
+        else:
+            status = Fore.RED + f"{f'failed ({code})':<12}"
+        print(
+            f"  {status}{Style.RESET_ALL}{elapsed:7.1f} s  {input_md} -> {output_dir}"
+        )
+    print(Style.RESET_ALL)
+
+
+# Print the slowest pieces of code from the profiles written by the pandoc
+# filter (one per output format that was built)
+def print_profile(profile_files, count):
+    rows = []
+    for profile_file in sorted(profile_files):
+        output_format = profile_file.suffixes[-2].lstrip(".")
+        with open(profile_file, "r", encoding="utf-8") as f:
+            for record in json.load(f)["elements"]:
+                rows.append((output_format, record))
+    if not rows:
+        print(Fore.YELLOW + "No profile recorded (were all outputs up to date?)")
+        return
+
+    rows.sort(key=lambda row: row[1]["seconds"], reverse=True)
+    print(Fore.BLUE + f"Slowest code ({min(count, len(rows))} of {len(rows)}):")
+    print(
+        f"  {'seconds':>8} {'trips':>5} {'output':>9} {'peak RSS':>9}  "
+        f"{'format':<8} location"
+    )
+    for output_format, record in rows[:count]:
+        rss = record["peak_rss_delta_kb"]
+        rss = "" if rss is None else f"+{rss} kB"
+        session = f" [{record['session']}]" if record["session"] else ""
+        print(
+            f"  {record['seconds']:8.3f} {record['round_trips']:5d} "
+            f"{record['output_bytes']:7d} B {rss:>9}  {output_format:<8} "
+            f"{record['location']}{session}  {record['code']}"
+        )
+    print(Style.RESET_ALL)
+
+
+# The pandoc filter inserts HTML output (e.g. interactive Plotly figures)
+# between numbered comments, followed by a placeholder <img> tag with the same
+# number that marks where the HTML belongs.  Move each HTML fragment to its
+# placeholder with one pass over the document for each.
+html_fragment_pattern = re.compile(
+    r"<!-- pythonexec-html (\d+) -->(.*?)<!-- /pythonexec-html \1 -->", re.DOTALL
+)
+html_placeholder_pattern = re.compile(
+    r"<img\b[^>]*\bdata-pythonexec-html=[\"']?(\d+)[\"']?[^>]*>"
+)
 
-    if completedProcess.returncode != 0:
-        print(Fore.RED + f"{completedProcess.stderr.decode()}")
-        exit(completedProcess.returncode)
+
+def replace_html_placeholders(html):
+    fragments = {}
+
+    def extract_fragment(match):
+        fragments[match.group(1)] = match.group(2)
+        return ""
+
+    html = html_fragment_pattern.sub(extract_fragment, html)
+    return html_placeholder_pattern.sub(
+        lambda match: fragments.get(match.group(1), match.group(0)), html
+    )
+
+
+# Files and directories that trigger a rebuild in --watch mode.  Static file
+# patterns are expanded every time so that new matching files are noticed.
+def watched_paths(input_files, args):
+    paths = list(input_files) + [Path(args.template_dir), Path(args.images_dir)]
+    for g in args.statics:
+        paths += [Path(f) for f in glob.glob(str(Path(g).absolute()))]
+    return paths
+
+
+# Modification time and size of every watched file
+def watch_snapshot(paths):
+    snapshot = {}
+    for path in paths:
+        for f in tree_files(path):
+            try:
+                stat = f.stat()
+            except OSError:
+                continue
+            snapshot[str(f.absolute())] = (stat.st_mtime_ns, stat.st_size)
+    return snapshot
+
+
+# Wakes up the watch loop on any file system event under the watched paths
+class WatchEventHandler(FileSystemEventHandler if Observer else object):
+    def __init__(self, event):
+        super().__init__()
+        self._event = event
+
+    def on_any_event(self, event):
+        self._event.set()
+
+
+# Block until a watched file changes.  File system events are used when the
+# optional watchdog package is installed, otherwise the files are polled.
+# Either way the snapshots are compared so that unrelated events (e.g. output
+# files written next to the input) don't trigger a rebuild, and the change is
+# only reported once the files have stopped changing for `settle` seconds.
+# The files are compared once before waiting, so that edits saved since
+# `previous` was taken (e.g. during a build) are not missed.
+def wait_for_changes(input_files, args, previous, interval=0.25, settle=0.2):
+    changed = threading.Event()
+    changed.set()
+    observer = None
+    if Observer is not None:
+        observer = Observer()
+        handler = WatchEventHandler(changed)
+        watched_dirs = set()
+        for path in watched_paths(input_files, args):
+            if not path.exists():
+                continue
+            directory = (path if path.is_dir() else path.parent).absolute()
+            if directory not in watched_dirs:
+                watched_dirs.add(directory)
+                observer.schedule(handler, str(directory), recursive=path.is_dir())
+        observer.start()
+
+    try:
+        while True:
+            changed.wait(timeout=None if observer else interval)
+            changed.clear()
+            current = watch_snapshot(watched_paths(input_files, args))
+            if current == previous:
+                continue
+            while True:
+                time.sleep(settle)
+                settled = watch_snapshot(watched_paths(input_files, args))
+                if settled == current:
+                    return current
+                current = settled
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+
+
+# Rebuild the documents whenever one of their inputs changes.  Code output is
+# cached and interpreters come from the pre-warmed pool, so after an edit only
+# the code from the first changed block onward is executed again, and outputs
+# whose inputs didn't change are skipped entirely.
+#
+# A pool that watch mode starts itself (rather than one asked for with --pool
+# or already running) is stopped again when watching ends.
+def watch_documents(input_files, output_dirs, args):
+    from sciengdox.pandoc_pythonexec import pool
+
+    args.cache = True
+    stop_pool_on_exit = False
+    if not args.pool and args.backend == "python" and pool.pool_supported():
+        args.pool = True
+        try:
+            stop_pool_on_exit = not pool.pool_running(
+                args.pool_socket or pool.default_socket_path()
+            )
+        except OSError:
+            pass
+    use_interpreter_pool(args)
+    stop_pool_on_exit = stop_pool_on_exit and args.pool
+    if stop_pool_on_exit:
+        print(Fore.CYAN + "The interpreter pool is stopped when watching ends.")
+
+    print(
+        Fore.BLUE
+        + "Watching for changes "
+        + ("(file system events)" if Observer else "(polling)")
+        + ".  Press Ctrl-C to stop."
+        + Style.RESET_ALL
+    )
+    snapshot = watch_snapshot(watched_paths(input_files, args))
+    try:
+        while True:
+            results = [
+                build_document_job(input_md, output_dir, args)
+                for input_md, output_dir in zip(input_files, output_dirs)
+            ]
+            print_build_summary(results)
+            print(Fore.BLUE + "Waiting for changes..." + Style.RESET_ALL)
+            snapshot = wait_for_changes(input_files, args, snapshot)
+    except KeyboardInterrupt:
+        print(Style.RESET_ALL)
+    finally:
+        if stop_pool_on_exit:
+            pool.stop_pool(args.pool_socket)
+            print(Fore.CYAN + "Stopped interpreter pool" + Style.RESET_ALL)
 
 
 # ------------------------------------------------------------------------------
 
 
-def main():
+# Command line arguments of compiledoc
+def argument_parser():
     parser = argparse.ArgumentParser(description="Compile a Python-enabled document")
     parser.add_argument(
-        "input_md", metavar="input_md", type=str, help="input markdown file"
+        "input_md",
+        metavar="input_md",
+        type=str,
+        nargs="+",
+        help="input markdown file(s) or glob pattern(s)",
     )
     parser.add_argument(
         "-o", "--output_dir", type=str, default="output", help="output directory"
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of documents to build concurrently when building more than "
+        "one document",
+    )
     parser.add_argument(
         "--template_dir", type=str, default="template", help="template directory"
     )
@@ -192,6 +748,128 @@ def main():
         default=False,
         help="build all output formats (can be combined with --no-<format>)",
     )
+    parser.add_argument(
+        "--exec-once",
+        action="store_true",
+        default=False,
+        help="execute the document's Python code once, save the executed "
+        "document as pandoc JSON in the output directory, and build every "
+        "output format from that",
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        default=False,
+        help="rebuild all outputs even if their inputs have not changed",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        default=False,
+        help="rebuild whenever the input, template, images, or static files "
+        "change (implies --cache, and --pool where supported)",
+    )
+    parser.add_argument(
+        "--timeout",
+        type=float,
+        metavar="SECONDS",
+        help="time limit for the code of each block or inline element (can be "
+        "set per element with e.g. {.python timeout=30})",
+    )
+    parser.add_argument(
+        "--document-timeout",
+        type=float,
+        metavar="SECONDS",
+        help="time limit for all code in a document",
+    )
+    parser.add_argument(
+        "--keep-going",
+        action="store_true",
+        default=False,
+        help="when code reaches its time limit, show a marker in its place and "
+        "continue instead of stopping the build",
+    )
+    parser.add_argument(
+        "--max-output",
+        type=int,
+        metavar="CHARS",
+        help="maximum number of characters of output shown for each piece of "
+        "code (default 1000000, 0 for no limit); the full output of code "
+        "exceeding it is written to the pythonexec-output directory",
+    )
+    parser.add_argument(
+        "--figure-workers",
+        type=int,
+        metavar="N",
+        help="render figures from sciengdox.figures.svg_figure in N worker "
+        "processes while the code continues",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        default=False,
+        help="record the run time of each piece of code in the document and "
+        "print the slowest at the end of the build",
+    )
+    parser.add_argument(
+        "--profile-top",
+        type=int,
+        default=10,
+        metavar="N",
+        help="number of the slowest pieces of code printed by --profile "
+        "(default 10)",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        default=False,
+        help="cache the output of executed code in the output directory and "
+        "only re-execute code from the first changed block onward",
+    )
+    parser.add_argument(
+        "--checkpoint-after",
+        type=float,
+        metavar="SECONDS",
+        help="save the interpreter's variables after code blocks that take at "
+        "least this long, so a rebuild can resume from there (implies --cache)",
+    )
+    parser.add_argument(
+        "--pool",
+        action="store_true",
+        default=False,
+        help="execute code in pre-warmed interpreters from a background pool "
+        "(started if not already running; not available on Windows)",
+    )
+    parser.add_argument(
+        "--pool-socket",
+        type=str,
+        help="path of the Unix socket of the interpreter pool",
+    )
+    parser.add_argument(
+        "--pool-preload",
+        type=str,
+        nargs="*",
+        help="modules imported by the interpreter pool when it starts",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=["python", "jupyter"],
+        default="python",
+        help="execute code in a plain Python interpreter (default) or in a "
+        "Jupyter kernel (requires the jupyter_client package)",
+    )
+    parser.add_argument(
+        "--kernel",
+        type=str,
+        help="name of the Jupyter kernel to start (default python3)",
+    )
+    parser.add_argument(
+        "--kernel-connection",
+        type=str,
+        metavar="FILE",
+        help="connection file of an already running Jupyter kernel to use "
+        "instead of starting one (its variables are shared between builds)",
+    )
     parser.add_argument(
         "--pandoc",
         type=str,
@@ -226,8 +904,58 @@ def main():
         default=False,
         help="whether to run citation processing",
     )
+    return parser
+
+
+def main():
+    args = argument_parser().parse_args()
+
+    input_files = expand_input_patterns(args.input_md)
+    output_dir = Path(args.output_dir)
+
+    if args.watch:
+        if len(input_files) == 1:
+            output_dirs = [output_dir]
+        else:
+            output_dirs = document_output_dirs(input_files, output_dir)
+        watch_documents(input_files, output_dirs, args)
+        return
+
+    use_interpreter_pool(args)
+    if len(input_files) == 1:
+        build_document(input_files[0], output_dir, args)
+        return
+    if shares_kernel(args) and args.jobs > 1:
+        print(
+            Fore.YELLOW
+            + "Building one document at a time since they share a Jupyter kernel."
+        )
+        args.jobs = 1
+
+    # Build each document into its own subdirectory of the output directory
+    output_dirs = document_output_dirs(input_files, output_dir)
+    print(
+        Fore.BLUE
+        + f"Building {len(input_files)} documents with {args.jobs} job(s)"
+        + Style.RESET_ALL
+    )
+    with ProcessPoolExecutor(max_workers=max(args.jobs, 1)) as executor:
+        results = list(
+            executor.map(
+                build_document_job,
+                input_files,
+                output_dirs,
+                [args] * len(input_files),
+            )
+        )
+
+    print_build_summary(results)
+    if any(result[1] != 0 for result in results):
+        exit(1)
 
-    args = parser.parse_args()
+
+def build_document(input_md, output_dir, args):
+    build_start = time.time()
 
     # Check for required utilities
     pandoc_exec = find_executable("pandoc", args.pandoc)
@@ -246,22 +974,22 @@ def main():
         build_html = True
 
     # Build paths to inputs, outputs, templates
-    input_md = Path(args.input_md)
     if not input_md.exists():
-        print_error(f"Input file does not exist: {args.input_md}")
+        print_error(f"Input file does not exist: {input_md}")
 
     input_basename = input_md.stem
 
     template_dir = Path(args.template_dir)
 
-    output_dir = Path(args.output_dir)
     try:
         output_dir.mkdir(parents=True)
         print(Fore.BLUE + f"Creating output directory: {output_dir.absolute()}")
     except FileExistsError:
         print(Fore.BLUE + f"Using output directory: {output_dir.absolute()}")
 
-    # Copy static images to output directory
+    # Copy static images to output directory.  The copies are shared with the
+    # scratch directory of each output format.
+    shared_files = []
     images_dir = Path(args.images_dir)
     if images_dir.exists():
         print(
@@ -272,9 +1000,8 @@ def main():
 
         output_images = output_dir.joinpath(images_dir.name)
 
-        shutil.copytree(
-            images_dir.absolute(), output_images.absolute(), dirs_exist_ok=True
-        )
+        sync_tree(images_dir.absolute(), output_images.absolute())
+        shared_files.append(output_images)
 
     # Copy other specified static files to output directory
     static_files = []
@@ -287,23 +1014,124 @@ def main():
             print(f"    {f}")
             if f.is_dir():
                 result_dir = output_dir.joinpath(f.name)
-                shutil.copytree(f.absolute(), result_dir.absolute(), dirs_exist_ok=True)
+                sync_tree(f.absolute(), result_dir.absolute())
             else:
-                shutil.copy(f.absolute(), output_dir.absolute())
+                sync_file(f.absolute(), output_dir.absolute())
+            shared_files.append(output_dir.joinpath(f.name))
 
-    common_pandoc_params = [
+    # Hash everything the outputs are built from
+    manifest = BuildManifest(output_dir)
+    tools = [pandoc_exec, pandoc_crossref] + (
+        [pandoc_citeproc] if pandoc_citeproc else []
+    )
+    input_key = hash_files(
+        [input_md]
+        + tree_files(template_dir)
+        + tree_files(images_dir)
+        + sorted(f for static in static_files for f in tree_files(static))
+    )
+    input_key += json.dumps(
+        [tool_version(t) for t in tools] + [pythonexec_version(), sys.version]
+    )
+
+    source_pandoc_params = [
         str(pandoc_exec.absolute()),
         str(input_md.absolute()),
         "--from",
         "markdown",
-        "-Mcref",
-        "-Mlistings",
-        f"-Mgithash={parse_git_branch()}{parse_git_hash()}",
+    ]
+    exec_pandoc_params = [
         "--filter",
         str(pandoc_pythonexec.absolute()),
-        "--filter",
-        str(pandoc_crossref.absolute()),
     ]
+    if args.cache or args.checkpoint_after is not None:
+        exec_pandoc_params.append("-Mpythonexec-cache=.pythonexec-cache")
+    if args.checkpoint_after is not None:
+        exec_pandoc_params.append(
+            f"-Mpythonexec-checkpoint-after={args.checkpoint_after:g}"
+        )
+    if args.backend != "python":
+        exec_pandoc_params.append(f"-Mpythonexec-backend={args.backend}")
+        if args.kernel:
+            exec_pandoc_params.append(f"-Mpythonexec-kernel={args.kernel}")
+        if args.kernel_connection:
+            exec_pandoc_params.append(
+                "-Mpythonexec-kernel-connection="
+                f"{Path(args.kernel_connection).absolute()}"
+            )
+    elif args.pool and args.pool_socket:
+        exec_pandoc_params.append(f"-Mpythonexec-pool={args.pool_socket}")
+    if args.timeout is not None:
+        exec_pandoc_params.append(f"-Mpythonexec-timeout={args.timeout:g}")
+    if args.document_timeout is not None:
+        exec_pandoc_params.append(
+            f"-Mpythonexec-document-timeout={args.document_timeout:g}"
+        )
+    if args.keep_going:
+        exec_pandoc_params.append("-Mpythonexec-timeout-action=continue")
+    if args.max_output is not None:
+        exec_pandoc_params.append(f"-Mpythonexec-max-output={args.max_output}")
+    if args.figure_workers:
+        exec_pandoc_params.append(f"-Mpythonexec-figure-workers={args.figure_workers}")
+    if args.profile:
+        exec_pandoc_params += [
+            f"-Mpythonexec-profile={input_basename}-profile",
+            f"-Mpythonexec-source={input_md.absolute()}",
+        ]
+
+    if args.exec_once:
+        # Execute the code once and keep the resulting AST for all formats
+        ast_file = output_dir.joinpath(input_basename + ".json")
+        print(Fore.BLUE + f"Executing Python code: {ast_file.absolute()}")
+
+        output_formats = []
+        if build_md:
+            output_formats.append("markdown")
+        if build_html:
+            output_formats.append("html")
+        if build_pdf:
+            output_formats.append("latex")
+
+        pandoc_params = (
+            source_pandoc_params
+            + exec_pandoc_params
+            + [
+                f"-Mpythonexec-formats={','.join(output_formats)}",
+                "--to",
+                "json",
+            ]
+        )
+        build_formats(
+            [("json", pandoc_params, ast_file)],
+            template_dir,
+            output_dir,
+            args,
+            manifest,
+            input_key,
+            shared_files,
+        )
+
+        source_pandoc_params = [
+            str(pandoc_exec.absolute()),
+            str(ast_file.absolute()),
+            "--from",
+            "json",
+        ]
+        exec_pandoc_params = []
+
+    common_pandoc_params = (
+        source_pandoc_params
+        + [
+            "-Mcref",
+            "-Mlistings",
+            f"-Mgithash={parse_git_branch()}{parse_git_hash()}",
+        ]
+        + exec_pandoc_params
+        + [
+            "--filter",
+            str(pandoc_crossref.absolute()),
+        ]
+    )
 
     if not args.no_citeproc:
         if pandoc_citeproc:
@@ -314,18 +1142,14 @@ def main():
         else:
             common_pandoc_params += ["--citeproc"]
 
+    builds = []
+
     if build_md:
         # Build Markdown output
         output_file = output_dir.joinpath(input_basename + ".md")
         print(Fore.BLUE + "Building Markdown output: " + f"{output_file.absolute()}")
 
-        copy_template_to_output(template_dir, output_dir)
-        print(Fore.CYAN + "Running pandoc")
-        pandoc_params = common_pandoc_params + [
-            "--output",
-            str(output_file.absolute()),
-        ]
-        run_pandoc(pandoc_params, output_dir, verbose=args.verbose)
+        builds.append(("markdown", common_pandoc_params, output_file))
 
     if build_html:
         # Build HTML output
@@ -348,31 +1172,31 @@ def main():
             sass_exec = find_executable("sass", args.sass)
             infile = stylesheet_file
             stylesheet_file = output_dir.joinpath(f"{infile.stem}.css")
-            print(Fore.CYAN + "Converting SCSS to CSS")
-            subprocess.run(
-                [
-                    str(sass_exec.absolute()),
-                    str(infile.absolute()),
-                    str(stylesheet_file.absolute()),
-                    "--style",
-                    "compressed",
-                ]
+            sass_params = [
+                str(sass_exec.absolute()),
+                str(infile.absolute()),
+                str(stylesheet_file.absolute()),
+                "--style",
+                "compressed",
+            ]
+            sass_key = build_key(
+                hash_files(tree_files(template_dir)) + tool_version(sass_exec),
+                sass_params,
             )
+            if args.force or not manifest.up_to_date("sass", sass_key, stylesheet_file):
+                print(Fore.CYAN + "Converting SCSS to CSS")
+                completedProcess = subprocess.run(sass_params)
+                if completedProcess.returncode == 0:
+                    manifest.record("sass", sass_key)
         else:
             stylesheet_file = find_template_file(template_dir, args.template, "css")
             if stylesheet_file:
-                shutil.copy(stylesheet_file, output_dir)
+                sync_file(stylesheet_file, output_dir)
 
         if stylesheet_file:
             stylesheet_file = stylesheet_file.name
 
-        copy_template_to_output(template_dir, output_dir)
-
-        print(Fore.CYAN + "Running pandoc")
-
         pandoc_params = common_pandoc_params + [
-            "--output",
-            str(output_file.absolute()),
             "--listings",
             "--toc",
             "--number-sections",
@@ -392,22 +1216,7 @@ def main():
         if args.self_contained:
             pandoc_params.append("--self-contained")
 
-        run_pandoc(pandoc_params, output_dir, verbose=args.verbose)
-
-        # Post-process HTML file to incorporate e.g. interactive Plotly images
-        from bs4 import BeautifulSoup
-
-        with open(output_file, "r", encoding="utf-8") as f:
-            soup = BeautifulSoup(f.read(), "html.parser")
-        for img in soup.find_all(src="broken_img_replace_me"):
-            div = soup.find(
-                lambda tag: tag.name == "div"
-                and tag.has_attr("id")
-                and tag["id"] == img["id"]
-            )
-            img.replace_with(div.extract())
-        with open(output_file, "w", encoding="utf-8") as f:
-            f.write(str(soup))
+        builds.append(("html", pandoc_params, output_file))
 
     if build_pdf:
         # Build PDF output
@@ -424,13 +1233,7 @@ def main():
         else:
             print(Fore.CYAN + f"Using template: {template_file.absolute()}")
 
-        copy_template_to_output(template_dir, output_dir)
-
-        print(Fore.CYAN + "Running pandoc")
-
         pandoc_params = common_pandoc_params + [
-            "--output",
-            str(output_file.absolute()),
             "--pdf-engine",
             "xelatex",
             "--listings",
@@ -445,7 +1248,29 @@ def main():
         if args.verbose:
             pandoc_params.append("--verbose")
 
-        run_pandoc(pandoc_params, output_dir, verbose=args.verbose)
+        builds.append(("pdf", pandoc_params, output_file))
+
+    # Run pandoc for all formats at once
+    built = build_formats(
+        builds, template_dir, output_dir, args, manifest, input_key, shared_files
+    )
+
+    if "html" in built:
+        # Post-process HTML file to incorporate e.g. interactive Plotly images
+        output_file = output_dir.joinpath(input_basename + ".html")
+        with open(output_file, "r", encoding="utf-8") as f:
+            html = f.read()
+        if "broken_img_replace_me" in html:
+            with open(output_file, "w", encoding="utf-8") as f:
+                f.write(replace_html_placeholders(html))
+
+    if args.profile:
+        profile_files = [
+            f
+            for f in output_dir.glob(f"{input_basename}-profile.*.json")
+            if f.stat().st_mtime >= build_start
+        ]
+        print_profile(profile_files, args.profile_top)
 
     print(Fore.GREEN + "Complete")
     print(Style.RESET_ALL)
@@ -1 +1,2 @@
 from .figures import *  # noqa: F401, F403
+from .decimation import decimate  # noqa: F401
@@ -0,0 +1,151 @@
+import contextlib
+import math
+
+import numpy as np
+
+try:
+    import matplotlib.figure
+    import matplotlib.lines
+
+    matplotlib_loaded = True
+except ModuleNotFoundError:
+    matplotlib_loaded = False
+
+try:
+    import plotly.graph_objects as go
+except ModuleNotFoundError:
+    go = None
+
+# Plotly figures are this wide (in pixels) unless their layout says otherwise
+plotly_default_width = 700
+
+
+# Indices of the points to keep when reducing `y` to about `max_points`
+# points: the first and last point, and the minimum and maximum of each of
+# `max_points / 2` equally long buckets, in order.  Peaks are never lost, so
+# the decimated line looks the same as the full one when each bucket is at most
+# one pixel wide.  The first NaN of each bucket is kept too, so that gaps in a
+# line stay gaps.
+def minmax_indices(y, max_points):
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    buckets = max(max_points // 2 - 1, 1)
+    if n <= max_points or n <= 2:
+        return np.arange(n)
+
+    size = math.ceil(n / buckets)
+    padded = np.pad(y, (0, buckets * size - n), mode="edge").reshape(buckets, size)
+    nan = np.isnan(padded)
+    offsets = np.arange(buckets) * size
+    lows = np.argmin(np.where(nan, np.inf, padded), axis=1) + offsets
+    highs = np.argmax(np.where(nan, -np.inf, padded), axis=1) + offsets
+    with_gaps = nan.any(axis=1)
+    gaps = np.argmax(nan, axis=1)[with_gaps] + offsets[with_gaps]
+    indices = np.concatenate([[0, n - 1], lows, highs, gaps])
+    return np.unique(np.minimum(indices, n - 1))
+
+
+# Indices of the points to keep when reducing a line to `max_points` points
+# with the Largest-Triangle-Three-Buckets algorithm (Steinarsson, 2013), which
+# keeps the point of each bucket that forms the largest triangle with the
+# previous kept point and the average of the next bucket.  It keeps the shape
+# of a line better than minmax_indices for smooth data, but may miss peaks.
+def lttb_indices(x, y, max_points):
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    n = len(y)
+    if n <= max_points or max_points < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, max_points - 1).astype(int)
+    indices = np.empty(max_points, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+    previous = 0
+    for i in range(max_points - 2):
+        start, end = edges[i], edges[i + 1]
+        if i + 2 < len(edges):
+            next_x = x[end : edges[i + 2]].mean()
+            next_y = y[end : edges[i + 2]].mean()
+        else:
+            next_x, next_y = x[-1], y[-1]
+        areas = np.abs(
+            (x[previous] - next_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (next_y - y[previous])
+        )
+        areas = np.nan_to_num(areas, nan=-1.0)
+        previous = start + int(np.argmax(areas)) if end > start else start
+        indices[i + 1] = previous
+    return np.unique(indices)
+
+
+decimation_methods = {
+    "minmax": lambda x, y, max_points: minmax_indices(y, max_points),
+    "lttb": lttb_indices,
+}
+
+
+# Reduce a line with points `x` and `y` to about `max_points` points using
+# `method` ("minmax" or "lttb").  Returns the decimated x and y arrays.  The
+# points are assumed to be in order along x (e.g. a time series).
+def decimate(x, y, max_points, method="minmax"):
+    if method not in decimation_methods:
+        raise ValueError(f"Unknown decimation method: {method}")
+    x = np.asarray(x)
+    y = np.asarray(y)
+    numeric_x = x if x.dtype.kind in "iuf" else np.arange(len(x))
+    indices = decimation_methods[method](numeric_x, y, max_points)
+    return x[indices], y[indices]
+
+
+# Temporarily decimate the lines of a matplotlib figure that have more than
+# `max_points` points.  With `max_points=True`, each line is reduced to two
+# points per pixel of the width of its axes.
+@contextlib.contextmanager
+def decimated(fig, max_points, method="minmax"):
+    changed = []
+    if (
+        max_points is not None
+        and max_points is not False
+        and matplotlib_loaded
+        and isinstance(fig, matplotlib.figure.Figure)
+    ):
+        for line in fig.findobj(matplotlib.lines.Line2D):
+            budget = max_points
+            if max_points is True:
+                if line.axes is None:
+                    continue
+                budget = 2 * math.ceil(line.axes.bbox.width)
+            x, y = line.get_data(orig=True)
+            if np.ndim(y) != 1 or len(y) <= budget:
+                continue
+            changed.append((line, x, y))
+            line.set_data(*decimate(x, y, budget, method))
+    try:
+        yield
+    finally:
+        for line, x, y in changed:
+            line.set_data(x, y)
+
+
+# A copy of a Plotly figure with its line traces decimated as by `decimated`,
+# a dict of the full x and y arrays of each decimated trace by index, and the
+# number of points traces were reduced to.  With `max_points=True`, traces are
+# reduced to two points per pixel of the figure's width.
+def decimated_plotly(fig, max_points, method="minmax"):
+    budget = max_points
+    if max_points is True:
+        budget = 2 * (fig.layout.width or plotly_default_width)
+
+    fig = go.Figure(fig)
+    full_data = {}
+    for i, trace in enumerate(fig.data):
+        if trace.type not in ("scatter", "scattergl") or trace.mode == "markers":
+            continue
+        if trace.y is None or len(trace.y) <= budget:
+            continue
+        x = np.arange(len(trace.y)) if trace.x is None else np.asarray(trace.x)
+        y = np.asarray(trace.y)
+        full_data[i] = (x, y)
+        trace.x, trace.y = decimate(x, y, budget, method)
+    return fig, full_data, budget
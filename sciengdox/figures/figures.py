@@ -1,8 +1,25 @@
+import contextlib
+import io
+import multiprocessing
 import os
+import pickle
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
 from svg import RootSvg
 
+from sciengdox.figures.decimation import decimated, decimated_plotly
+from sciengdox.figures.fingerprints import fingerprint, figure_fingerprints
+from sciengdox.figures.interactive import lazy_plotly_figure
+from sciengdox.pandoc_pythonexec.displays import display_key
+
 try:
+    import matplotlib
+    import matplotlib.collections
     import matplotlib.figure
+    import matplotlib.lines
 
     matplotlib_loaded = True
 except ModuleNotFoundError:
@@ -17,28 +34,305 @@
     plotly_loaded = False
 
 
-def svg_figure(fig, basename, figure_dir="figures", output_dir="", interactive=False):
-    if output_dir == "":
-        output_dir = figure_dir
-    elif figure_dir != "":
-        output_dir = "/".join([output_dir, figure_dir])
+# Publisher of display objects when running under pandoc-pythonexec (see
+# driver.py), or None
+def document_display():
+    return getattr(sys.modules.get("__main__"), "pythonexec_display", None)
 
-    if output_dir != "" and not os.path.exists(output_dir):
-        os.makedirs(output_dir)
 
-    filename = f"{basename}.svg"
-    output_file = f"{output_dir}/{filename}" if output_dir != "" else filename
+# File format of figures for each pandoc output format, if not SVG.  LaTeX
+# includes PDF figures directly, while SVG figures would have to be converted.
+figure_formats = {"latex": "pdf", "beamer": "pdf"}
+
+figure_mime_types = {"svg": "image/svg+xml", "pdf": "application/pdf"}
+
+# Parts of matplotlib's SVG output that change on every save
+volatile_svg_metadata = re.compile(rb"\s*<dc:date>.*?</dc:date>", re.DOTALL)
+
 
+# File format for a figure in the document being built, given
+# `document_output_format` (see the pandoc filter).  RootSvg figures are always
+# SVG.  When building several output formats at once the format isn't known,
+# so SVG is used.
+def figure_format(fig):
     if isinstance(fig, RootSvg):
-        fig.write(output_file)
+        return "svg"
+    output_format = getattr(sys.modules.get("__main__"), "document_output_format", None)
+    return figure_formats.get(output_format, "svg")
+
+
+# Temporarily rasterize the lines and collections (e.g. scatter plots) of a
+# matplotlib figure that have more than `max_points` points, so a dense plot
+# becomes an embedded image instead of a huge number of vector shapes
+@contextlib.contextmanager
+def rasterized(fig, max_points):
+    changed = []
+    if (
+        max_points is not None
+        and matplotlib_loaded
+        and isinstance(fig, matplotlib.figure.Figure)
+    ):
+        for artist in fig.findobj():
+            if isinstance(artist, matplotlib.lines.Line2D):
+                points = len(artist.get_xydata())
+            elif isinstance(artist, matplotlib.collections.Collection):
+                points = max(len(artist.get_offsets()), len(artist.get_paths()))
+            else:
+                continue
+            if points > max_points and not artist.get_rasterized():
+                artist.set_rasterized(True)
+                changed.append(artist)
+    try:
+        yield
+    finally:
+        for artist in changed:
+            artist.set_rasterized(False)
+
+
+# Attributes holding the geometry of SVG elements, whose numbers minify_svg
+# rounds.  Numbers elsewhere (e.g. in text labels) are left alone.
+_svg_geometry_attributes = (
+    rb"d|points|transform|viewBox|x|y|x1|y1|x2|y2|cx|cy|r|rx|ry|width|height"
+    rb"|stroke-width|style"
+)
+
+
+def _round_svg_numbers(match):
+    return re.sub(
+        rb"\d+\.\d{3,}",
+        lambda m: (b"%.2f" % float(m[0])).rstrip(b"0").rstrip(b"."),
+        match[0],
+    )
+
+
+# Make SVG data smaller by dropping comments and indentation and rounding
+# geometry numbers to two decimals (a hundredth of a point in matplotlib
+# figures)
+def minify_svg(data):
+    data = re.sub(rb"<!--.*?-->", b"", data, flags=re.DOTALL)
+    data = re.sub(rb">\s*\n\s*<", b"><", data)
+    return re.sub(
+        rb"(?<=\s)(?:" + _svg_geometry_attributes + rb')="[^"]*"',
+        _round_svg_numbers,
+        data,
+    )
+
+
+# Data of a figure in the given file format ("svg" or "pdf").  matplotlib
+# figures are saved with fixed element IDs and without the date, so that the
+# same figure always gives the same data.
+def figure_data(fig, file_format="svg", minify=False):
+    if isinstance(fig, RootSvg):
+        data = fig.to_string()
     elif matplotlib_loaded and isinstance(fig, matplotlib.figure.Figure):
-        fig.savefig(output_file, format="svg")
+        buffer = io.BytesIO()
+        if file_format == "pdf":
+            fig.savefig(buffer, format="pdf", metadata={"CreationDate": None})
+        else:
+            with matplotlib.rc_context({"svg.hashsalt": "sciengdox"}):
+                fig.savefig(buffer, format=file_format)
+        data = buffer.getvalue()
+        if file_format == "svg":
+            data = volatile_svg_metadata.sub(b"", data)
     elif plotly_loaded and str(type(fig).__module__).find("plotly") != -1:
-        if interactive:
-            return plotly.io.to_html(fig, include_plotlyjs=False, full_html=False)
-        fig.write_image(output_file)  # Note: requires 'kaleido' package
+        # Note: requires 'kaleido' package
+        data = fig.to_image(format=file_format)
     else:
         raise Exception("Unknown figure type.  Try installing matplotlib or plotly.")
 
+    if minify and file_format == "svg":
+        data = minify_svg(data)
+    return data
+
+
+# Worker processes rendering figures in the background, started when the
+# document's code sets `document_figure_workers` to the number of workers (e.g.
+# with `compiledoc --figure-workers`).  Workers are spawned rather than forked
+# so that they don't inherit the state of the document's interpreter.
+_figure_pool = None
+
+
+def figure_pool():
+    global _figure_pool
+    workers = getattr(sys.modules.get("__main__"), "document_figure_workers", None)
+    if not workers:
+        return None
+    if _figure_pool is None:
+        _figure_pool = ProcessPoolExecutor(
+            int(workers), mp_context=multiprocessing.get_context("spawn")
+        )
+    return _figure_pool
+
+
+# A snapshot of a figure that render_figure can render in a worker process,
+# or None if the figure has to be rendered where it is.  Taking the snapshot
+# right away lets the code go on changing (or closing) the figure.
+def render_job(fig):
+    if matplotlib_loaded and isinstance(fig, matplotlib.figure.Figure):
+        try:
+            return ("matplotlib", pickle.dumps(fig))
+        except Exception:
+            return None
+    elif plotly_loaded and "plotly" in str(type(fig).__module__):
+        return ("plotly", fig.to_json())
+    return None
+
+
+def render_figure(kind, data, file_format, minify):
+    if kind == "matplotlib":
+        fig = pickle.loads(data)
+    else:
+        fig = plotly.io.from_json(data)
+    return figure_data(fig, file_format, minify)
+
+
+# Fingerprint of a figure that can be taken without rendering it, or None.
+# matplotlib figures are fingerprinted by their data instead.
+def source_fingerprint(fig, file_format, minify):
+    options = f"{file_format}|{minify}|".encode()
+    if isinstance(fig, RootSvg):
+        return fingerprint(options + b"svg:" + fig.to_string())
+    elif plotly_loaded and "plotly" in str(type(fig).__module__):
+        return fingerprint(options + b"plotly:" + fig.to_json().encode("utf-8"))
+    return None
+
+
+# Render a figure and publish its data for `output_file`, unless the file
+# already holds the same figure (see FigureFingerprints)
+def publish_figure(display, fig, file_url, output_file, file_format, minify):
+    fingerprints = figure_fingerprints(os.path.dirname(output_file))
+    figure_fingerprint = source_fingerprint(fig, file_format, minify)
+    if figure_fingerprint is not None and fingerprints.unchanged(
+        output_file, figure_fingerprint
+    ):
+        return
+    fingerprints.forget(output_file)
+
+    pool = figure_pool()
+    job = render_job(fig) if pool is not None else None
+    if job is not None:
+
+        def record(future):
+            if not future.cancelled() and future.exception() is None:
+                data = future.result()
+                fingerprints.record(
+                    output_file, figure_fingerprint or fingerprint(data), data
+                )
+
+        data = pool.submit(render_figure, *job, file_format, minify)
+        data.add_done_callback(record)
+    else:
+        data = figure_data(fig, file_format, minify)
+        if figure_fingerprint is None:
+            figure_fingerprint = fingerprint(data)
+            if fingerprints.unchanged(output_file, figure_fingerprint):
+                return
+        fingerprints.record(output_file, figure_fingerprint, data)
+    display.publish(figure_mime_types[file_format], data, file_url, path=output_file)
+
+
+# Save a figure and return its URL for an image in the document.  With
+# `interactive`, a Plotly figure is returned as HTML instead.  With
+# `interactive="lazy"`, the HTML only loads the figure when it scrolls into
+# view, from files saved in the figure directory (see lazy_plotly_figure).
+#
+# Figures are saved as SVG, except that matplotlib and Plotly figures are
+# saved as PDF when building LaTeX (see figure_format) unless `file_format`
+# says otherwise.  With `rasterize_over`, lines and collections of matplotlib
+# figures with more than that many points are embedded as images (see
+# rasterized), and with `minify` SVG data is made smaller (see minify_svg).
+#
+# With `decimate`, lines with more points than that (or, with `decimate=True`,
+# more than two points per pixel of width) are reduced to that many points
+# before rendering, keeping the minimum and maximum of each stretch of points
+# (or using `decimation_method="lttb"`, see decimation.py).  With
+# `multiresolution` and `interactive="lazy"`, zooming into a decimated Plotly
+# figure shows the full data of the visible range.
+#
+# When run by pandoc-pythonexec, the figure is sent to the pandoc filter as a
+# display object rather than saved directly.  The filter saves it, and
+# interactive HTML is passed by a short key instead of as a printed string.
+# Figures that are the same as in the last build are not saved again, and
+# only matplotlib figures are rendered again to tell.  If the document uses
+# figure workers (see figure_pool), matplotlib and Plotly figures are rendered
+# in the background and the URL is returned right away.  The filter waits for
+# the figures at the end of the document.
+def svg_figure(
+    fig,
+    basename,
+    figure_dir="figures",
+    output_dir="",
+    interactive=False,
+    file_format=None,
+    rasterize_over=None,
+    minify=False,
+    decimate=None,
+    decimation_method="minmax",
+    multiresolution=False,
+):
+    if output_dir == "":
+        output_dir = figure_dir
+    elif figure_dir != "":
+        output_dir = "/".join([output_dir, figure_dir])
+
+    if file_format is None:
+        file_format = figure_format(fig)
+    filename = f"{basename}.{file_format}"
+    output_file = f"{output_dir}/{filename}" if output_dir != "" else filename
     file_url = f"{figure_dir}/{filename}" if figure_dir != "" else filename
+
+    display = document_display()
+    is_plotly = plotly_loaded and "plotly" in str(type(fig).__module__)
+    full_data, points = None, None
+    if decimate and is_plotly:
+        fig, full_data, points = decimated_plotly(fig, decimate, decimation_method)
+
+    if interactive == "lazy" and is_plotly:
+        html = lazy_plotly_figure(
+            display,
+            fig,
+            basename,
+            figure_dir,
+            output_dir,
+            full_data if multiresolution else None,
+            points,
+        )
+        if display is None:
+            return html
+        key = display_key(html.encode("utf-8"))
+        display.publish("text/html", html, key)
+        return key
+
+    if display is not None:
+        if interactive and is_plotly:
+            html = plotly.io.to_html(fig, include_plotlyjs=False, full_html=False)
+            key = display_key(html.encode("utf-8"))
+            display.publish("text/html", html, key)
+            return key
+        with decimated(fig, decimate, decimation_method), rasterized(
+            fig, rasterize_over
+        ):
+            publish_figure(display, fig, file_url, output_file, file_format, minify)
+        return file_url
+
+    if output_dir != "" and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    if interactive and is_plotly:
+        return plotly.io.to_html(fig, include_plotlyjs=False, full_html=False)
+
+    with decimated(fig, decimate, decimation_method), rasterized(fig, rasterize_over):
+        if minify:
+            Path(output_file).write_bytes(figure_data(fig, file_format, minify))
+        elif isinstance(fig, RootSvg):
+            fig.write(output_file)
+        elif matplotlib_loaded and isinstance(fig, matplotlib.figure.Figure):
+            fig.savefig(output_file, format=file_format)
+        elif is_plotly:
+            fig.write_image(output_file)  # Note: requires 'kaleido' package
+        else:
+            raise Exception(
+                "Unknown figure type.  Try installing matplotlib or plotly."
+            )
+
     return file_url
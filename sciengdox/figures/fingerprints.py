@@ -0,0 +1,77 @@
+import hashlib
+import json
+import os
+import threading
+from pathlib import Path
+
+# File in each figure directory that records the fingerprints of the figures
+# saved there (hidden, so compiledoc doesn't copy it to the output directory)
+fingerprint_file = ".fingerprints.json"
+
+
+def fingerprint(data):
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+    return hashlib.sha256(data).hexdigest()
+
+
+# Fingerprints of the figures that svg_figure saved in a directory, each with a
+# hash of the data saved to the figure's file.  A figure is unchanged if its
+# fingerprint is the same as last time and its file still holds that data, in
+# which case it doesn't have to be rendered or saved again.
+#
+# Figures can be recorded from other threads (e.g. when a figure rendered in
+# the background is done).  Entries recorded by other interpreters (e.g. of
+# other sessions) are kept when the file is saved.
+class FigureFingerprints(object):
+    def __init__(self, directory):
+        self._file = Path(directory or ".").joinpath(fingerprint_file)
+        self._lock = threading.Lock()
+        self._entries = self._load()
+
+    # Whether the file at `path` holds the figure with the given fingerprint
+    def unchanged(self, path, figure_fingerprint):
+        entry = self._entries.get(Path(path).name)
+        if entry is None or entry[0] != figure_fingerprint:
+            return False
+        try:
+            return fingerprint(Path(path).read_bytes()) == entry[1]
+        except OSError:
+            return False
+
+    # Forget the figure at `path`, e.g. while a new figure is being rendered
+    # for it
+    def forget(self, path):
+        with self._lock:
+            self._entries[Path(path).name] = None
+
+    # Record the fingerprint of the figure saved with `data` to `path`
+    def record(self, path, figure_fingerprint, data):
+        with self._lock:
+            self._entries = {**self._load(), **self._entries}
+            self._entries[Path(path).name] = [figure_fingerprint, fingerprint(data)]
+            try:
+                self._file.parent.mkdir(parents=True, exist_ok=True)
+                tmp_file = self._file.with_name(f"{fingerprint_file}.{os.getpid()}.tmp")
+                entries = {k: v for k, v in self._entries.items() if v is not None}
+                tmp_file.write_text(json.dumps(entries, indent=2))
+                os.replace(tmp_file, self._file)
+            except OSError:
+                pass
+
+    def _load(self):
+        try:
+            return json.loads(self._file.read_text())
+        except (OSError, ValueError):
+            return {}
+
+
+_fingerprints = {}
+
+
+# FigureFingerprints of a figure directory
+def figure_fingerprints(directory):
+    directory = str(directory)
+    if directory not in _fingerprints:
+        _fingerprints[directory] = FigureFingerprints(directory)
+    return _fingerprints[directory]
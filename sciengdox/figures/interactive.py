@@ -0,0 +1,328 @@
+import base64
+import html
+import json
+import os
+from pathlib import Path
+
+import numpy as np
+
+from sciengdox.figures.fingerprints import fingerprint, figure_fingerprints
+
+try:
+    import plotly.io
+    import plotly.offline
+
+    plotly_loaded = True
+except ModuleNotFoundError:
+    plotly_loaded = False
+
+# Trace arrays with at least this many numbers are stored as base64 typed
+# arrays, which plotly.js decodes from version 2.28 on
+typed_array_min_length = 64
+typed_array_plotlyjs_version = (2, 28)
+
+# Script that draws the lazily loaded Plotly figures on the page.  Each figure
+# is a <div> naming the script with its spec (see lazy_plotly_figure).  When
+# the <div> is about to scroll into view, the shared plotly.js bundle is
+# loaded (once), then the figure's script, which registers the spec with
+# `window.pythonexecPlotly`.  Scripts are used rather than fetching JSON so
+# that the page also works when opened from a local file.
+loader_script = """(function () {
+  var lazy = window.pythonexecPlotly;
+  if (!lazy) {
+    lazy = window.pythonexecPlotly = {
+      specs: {},
+      scripts: {},
+      load: function (src) {
+        if (!lazy.scripts[src]) {
+          lazy.scripts[src] = new Promise(function (resolve, reject) {
+            var script = document.createElement("script");
+            script.src = src;
+            script.onload = resolve;
+            script.onerror = reject;
+            document.head.appendChild(script);
+          });
+        }
+        return lazy.scripts[src];
+      },
+      register: function (src, spec) {
+        lazy.specs[src] = spec;
+      },
+      registerFull: function (src, traces) {
+        lazy.specs[src] = traces;
+      },
+      show: function (div) {
+        var src = div.getAttribute("data-figure");
+        lazy.load(div.getAttribute("data-plotlyjs"))
+          .then(function () { return lazy.load(src); })
+          .then(function () {
+            var spec = lazy.specs[src];
+            div.style.height = "";
+            div.pythonexecOverview = spec.data.map(function (trace) {
+              return { x: trace.x, y: trace.y };
+            });
+            return Plotly.newPlot(div, spec.data, spec.layout, spec.config);
+          })
+          .then(function () {
+            if (div.getAttribute("data-full")) {
+              div.on("plotly_relayout", function (event) {
+                lazy.zoom(div, event);
+              });
+            }
+          });
+      },
+      // Show the full-resolution data of the visible x range of decimated
+      // traces, reduced to the figure's point budget, or the overview again
+      // when zoomed out
+      zoom: function (div, event) {
+        var x0 = event["xaxis.range[0]"];
+        var x1 = event["xaxis.range[1]"];
+        if (event["xaxis.range"]) {
+          x0 = event["xaxis.range"][0];
+          x1 = event["xaxis.range"][1];
+        }
+        var reset = event["xaxis.autorange"];
+        if (x0 === undefined && !reset) {
+          return;
+        }
+        var src = div.getAttribute("data-full");
+        var points = Number(div.getAttribute("data-points"));
+        lazy.load(src).then(function () {
+          var traces = Object.keys(lazy.specs[src]);
+          var update = { x: [], y: [] };
+          traces.forEach(function (i) {
+            var data = reset
+              ? div.pythonexecOverview[i]
+              : lazy.range(lazy.specs[src][i], x0, x1, points);
+            update.x.push(data.x);
+            update.y.push(data.y);
+          });
+          Plotly.restyle(div, update, traces.map(Number));
+        });
+      },
+      decode: function (value) {
+        if (value && value.bdata) {
+          var text = atob(value.bdata);
+          var bytes = new Uint8Array(text.length);
+          for (var i = 0; i < text.length; i++) {
+            bytes[i] = text.charCodeAt(i);
+          }
+          var types = { f8: Float64Array, i4: Int32Array };
+          return new types[value.dtype](bytes.buffer);
+        }
+        return value;
+      },
+      // The points of a trace between x0 and x1, keeping the first and last
+      // point and the minimum and maximum of each bucket (as minmax_indices in
+      // decimation.py)
+      range: function (trace, x0, x1, points) {
+        if (!trace.decoded) {
+          trace.x = lazy.decode(trace.x);
+          trace.y = lazy.decode(trace.y);
+          trace.decoded = true;
+        }
+        var x = trace.x;
+        var y = trace.y;
+        var start = Math.max(lazy.search(x, x0) - 1, 0);
+        var end = Math.min(lazy.search(x, x1) + 1, x.length);
+        var size = Math.ceil((end - start) / Math.max(Math.floor(points / 2) - 1, 1));
+        if (end - start <= points) {
+          return { x: x.slice(start, end), y: y.slice(start, end) };
+        }
+        var result = { x: [x[start]], y: [y[start]] };
+        for (var first = start; first < end; first += size) {
+          var last = Math.min(first + size, end);
+          var low = first;
+          var high = first;
+          for (var j = first; j < last; j++) {
+            if (y[j] < y[low]) low = j;
+            if (y[j] > y[high]) high = j;
+          }
+          [Math.min(low, high), Math.max(low, high)].forEach(function (k, n) {
+            if (n === 0 || low !== high) {
+              result.x.push(x[k]);
+              result.y.push(y[k]);
+            }
+          });
+        }
+        result.x.push(x[end - 1]);
+        result.y.push(y[end - 1]);
+        return result;
+      },
+      // Index of the first value of the sorted array `x` that is not below
+      // `value`
+      search: function (x, value) {
+        var low = 0;
+        var high = x.length;
+        while (low < high) {
+          var middle = (low + high) >> 1;
+          if (x[middle] < value) {
+            low = middle + 1;
+          } else {
+            high = middle;
+          }
+        }
+        return low;
+      }
+    };
+    if ("IntersectionObserver" in window) {
+      lazy.observer = new IntersectionObserver(function (entries) {
+        entries.forEach(function (entry) {
+          if (entry.isIntersecting) {
+            lazy.observer.unobserve(entry.target);
+            lazy.show(entry.target);
+          }
+        });
+      }, { rootMargin: "200px" });
+    }
+  }
+  var divs = document.querySelectorAll("div.pythonexec-plotly:not([data-seen])");
+  Array.prototype.forEach.call(divs, function (div) {
+    div.setAttribute("data-seen", "");
+    if (lazy.observer) {
+      lazy.observer.observe(div);
+    } else {
+      lazy.show(div);
+    }
+  });
+})();
+"""
+
+
+def plotlyjs_version():
+    return tuple(int(n) for n in plotly.offline.get_plotlyjs_version().split(".")[:2])
+
+
+# Typed array spec of a list of numbers (or of equally long lists of numbers),
+# or None if it isn't one or is too short to be worth it
+def typed_array(values):
+    if len(values) < typed_array_min_length or not all(
+        isinstance(v, (int, float, list)) and not isinstance(v, bool) for v in values
+    ):
+        return None
+    try:
+        return array_spec(np.array(values))
+    except ValueError:
+        return None
+
+
+# Typed array spec of a NumPy array of numbers, or None if it has other values
+def array_spec(array):
+    if array.dtype.kind in "iu" and np.abs(array).max(initial=0) < 2**31:
+        array = array.astype("<i4")
+    elif array.dtype.kind in "iuf":
+        array = array.astype("<f8")
+    else:
+        return None
+    spec = {
+        "dtype": "i4" if array.dtype.kind == "i" else "f8",
+        "bdata": base64.b64encode(array.tobytes()).decode("ascii"),
+    }
+    if array.ndim > 1:
+        spec["shape"] = ",".join(str(n) for n in array.shape)
+    return spec
+
+
+# Replace the long number lists in a figure's traces with typed arrays
+def compact_arrays(value):
+    if isinstance(value, dict):
+        return {k: compact_arrays(v) for k, v in value.items()}
+    elif isinstance(value, list):
+        return typed_array(value) or [compact_arrays(v) for v in value]
+    return value
+
+
+# JSON spec of a Plotly figure with its trace data in compact form
+def plotly_spec(fig):
+    spec = json.loads(plotly.io.to_json(fig, validate=False))
+    if plotlyjs_version() >= typed_array_plotlyjs_version:
+        spec["data"] = compact_arrays(spec["data"])
+    spec.setdefault("config", {"responsive": True})
+    return json.dumps(spec, separators=(",", ":"))
+
+
+# Save `data` to `output_file`, or publish it to the pandoc filter, which saves
+# it, unless the file already holds it (see FigureFingerprints)
+def save_asset(display, data, mime, file_url, output_file):
+    fingerprints = figure_fingerprints(os.path.dirname(output_file))
+    data_fingerprint = fingerprint(data)
+    if fingerprints.unchanged(output_file, data_fingerprint):
+        return
+    if display is not None:
+        display.publish(mime, data, file_url, path=output_file)
+    else:
+        Path(output_file).parent.mkdir(parents=True, exist_ok=True)
+        Path(output_file).write_bytes(data)
+    fingerprints.record(output_file, data_fingerprint, data)
+
+
+# Figure directories the shared scripts were saved to, for each publisher
+_saved_assets = set()
+
+
+# Save a Plotly figure for lazy loading and return the HTML that shows it.  The
+# figure's spec goes to `<basename>.js` in the figure directory, next to the
+# shared plotly.js bundle that comes with the plotly package and the loader
+# script.  The HTML is only a placeholder <div> and the loader script, so the
+# document stays small however much data its figures have.
+#
+# `full_data` optionally has the full x and y arrays of traces that were
+# decimated to `points` points (see decimated_plotly).  They are saved to
+# `<basename>.full.js`, and when the figure is zoomed in, the loader shows the
+# full data of the visible range, reduced to the same number of points.
+def lazy_plotly_figure(
+    display, fig, basename, figure_dir, output_dir, full_data=None, points=None
+):
+    def paths(filename):
+        return (
+            f"{figure_dir}/{filename}" if figure_dir != "" else filename,
+            f"{output_dir}/{filename}" if output_dir != "" else filename,
+        )
+
+    mime = "text/javascript"
+    plotlyjs_url, plotlyjs_file = paths(
+        f"plotly-{plotly.offline.get_plotlyjs_version()}.min.js"
+    )
+    loader_url, loader_file = paths("pythonexec-plotly.js")
+    assets_key = (display, os.path.abspath(output_dir))
+    if assets_key not in _saved_assets:
+        save_asset(
+            display,
+            plotly.offline.get_plotlyjs().encode(),
+            mime,
+            plotlyjs_url,
+            plotlyjs_file,
+        )
+        save_asset(display, loader_script.encode(), mime, loader_url, loader_file)
+        _saved_assets.add(assets_key)
+
+    figure_url, figure_file = paths(f"{basename}.js")
+    figure_script = (
+        f"window.pythonexecPlotly.register({json.dumps(figure_url)}, "
+        f"{plotly_spec(fig)});\n"
+    )
+    save_asset(display, figure_script.encode(), mime, figure_url, figure_file)
+
+    attributes = {"data-figure": figure_url, "data-plotlyjs": plotlyjs_url}
+    full_traces = {
+        i: {"x": array_spec(x), "y": array_spec(y)}
+        for i, (x, y) in (full_data or {}).items()
+    }
+    full_traces = {
+        i: trace for i, trace in full_traces.items() if None not in trace.values()
+    }
+    if full_traces:
+        full_url, full_file = paths(f"{basename}.full.js")
+        full_script = (
+            f"window.pythonexecPlotly.registerFull({json.dumps(full_url)}, "
+            f"{json.dumps(full_traces, separators=(',', ':'))});\n"
+        )
+        save_asset(display, full_script.encode(), mime, full_url, full_file)
+        attributes.update({"data-full": full_url, "data-points": str(points)})
+
+    height = fig.layout.height or 450
+    return (
+        f'<div class="pythonexec-plotly" style="height: {height}px"'
+        + "".join(f' {k}="{html.escape(v)}"' for k, v in attributes.items())
+        + f'></div><script src="{html.escape(loader_url)}"></script>'
+    )
@@ -0,0 +1,227 @@
+import base64
+import hashlib
+import json
+import os
+import sys
+import time
+from pathlib import Path
+
+
+# Extend a hash chain with one request to the interpreter.  Each key depends on
+# every request that came before it, so editing one code block invalidates the
+# cached results of all blocks that follow it.
+def chain_key(previous_key, lines, echo_input, repl):
+    h = hashlib.sha256(previous_key.encode())
+    h.update(json.dumps([lines, echo_input, repl]).encode())
+    return h.hexdigest()
+
+
+# On-disk store of interpreter output keyed by hash chain.  There is one file
+# per seed (e.g. per output format) so that builds of different formats don't
+# prune each other's entries.  Checkpoints of the interpreter's variables are
+# kept in a directory next to that file, one file per key.  Their paths are
+# absolute since the interpreter may run in another directory.
+class ExecutionCache(object):
+    def __init__(self, directory, seed):
+        self.seed = seed
+        self._directory = Path(directory).absolute()
+        name = hashlib.sha256(seed.encode()).hexdigest()[:16]
+        self._file = self._directory.joinpath(name + ".json")
+        self._checkpoint_dir = self._directory.joinpath(name + "-checkpoints")
+        self._entries = self._load()
+        self._used = {}
+
+    def get(self, key):
+        output = self._entries.get(key)
+        if output is not None:
+            self._used[key] = output
+        return output
+
+    def put(self, key, output):
+        self._used[key] = output
+
+    def checkpoint_path(self, key, create=False):
+        if create:
+            self._checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        return self._checkpoint_dir.joinpath(key + ".pkl")
+
+    # Write only the entries used by this build, dropping stale results and
+    # their checkpoints
+    def save(self):
+        self._directory.mkdir(parents=True, exist_ok=True)
+        tmp_file = self._file.with_suffix(".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"seed": self.seed, "entries": self._used}, f)
+        os.replace(tmp_file, self._file)
+
+        if self._checkpoint_dir.exists():
+            for checkpoint in self._checkpoint_dir.iterdir():
+                if checkpoint.stem not in self._used:
+                    checkpoint.unlink()
+
+    def _load(self):
+        try:
+            with open(self._file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if data.get("seed") != self.seed:
+            return {}
+        return data.get("entries", {})
+
+
+# Wraps a PythonRunner and replays cached output for as long as the document
+# matches the previous build.  The interpreter is only started at the first
+# request without a cached result.  The requests before it are then re-run
+# (discarding their output) to rebuild the interpreter state that the changed
+# code depends on.
+#
+# To avoid re-running expensive code, the interpreter's variables can be saved
+# in a checkpoint after a request, either when asked to (`checkpoint=True`) or
+# when the request took at least `checkpoint_after` seconds.  Checkpoints are
+# keyed by the hash chain, so a later build restores the last checkpoint before
+# the first changed request and only re-runs the requests after it.  If a
+# checkpoint can't be saved (e.g. without cloudpickle or dill), no more are
+# saved in this build, and a later build replays all code as without them.
+#
+# Display objects without a file (e.g. HTML of interactive figures) are cached
+# along with the output.  Those with a file were already written by the build
+# that cached them.
+class CachingRunner(object):
+    def __init__(self, runner, cache, checkpoint_after=None):
+        self._runner = runner
+        self._cache = cache
+        self._checkpoint_after = checkpoint_after
+        self._key = hashlib.sha256(cache.seed.encode()).hexdigest()
+        self._history = []
+        self._started = False
+        self._displays = []
+        self._checkpoints_failed = False
+        self.cache_hits = 0
+
+    # Whether the wrapped runner can save and restore checkpoints
+    @property
+    def supports_checkpoints(self):
+        return hasattr(self._runner, "checkpoint")
+
+    async def start(self):
+        return ""
+
+    async def run_lines(
+        self, lines, echo_input=True, repl=False, timeout=None, checkpoint=False
+    ):
+        self._key = chain_key(self._key, lines, echo_input, repl)
+
+        if not self._started:
+            entry = self._cache.get(self._key)
+            if entry is not None:
+                self._history.append((self._key, lines, echo_input, repl))
+                self.cache_hits += 1
+                if isinstance(entry, dict):
+                    self._displays += [
+                        (description, base64.b64decode(data))
+                        for description, data in entry["displays"]
+                    ]
+                    return entry["output"]
+                return entry
+            await self._start_and_replay()
+
+        start = time.monotonic()
+        output = await self._runner.run_lines(
+            lines, echo_input=echo_input, repl=repl, timeout=timeout
+        )
+        elapsed = time.monotonic() - start
+
+        displays = self._runner.pop_displays()
+        self._displays += displays
+        cached_displays = [
+            [description, base64.b64encode(data).decode("ascii")]
+            for description, data in displays
+            if not description.get("path")
+        ]
+        if cached_displays:
+            self._cache.put(self._key, {"output": output, "displays": cached_displays})
+        else:
+            self._cache.put(self._key, output)
+
+        slow = self._checkpoint_after is not None and elapsed >= self._checkpoint_after
+        if (
+            self.supports_checkpoints
+            and not self._checkpoints_failed
+            and (checkpoint or slow)
+        ):
+            await self._save_checkpoint()
+        return output
+
+    def pop_displays(self):
+        displays = self._displays + self._runner.pop_displays()
+        self._displays = []
+        return displays
+
+    async def wait_for_displays(self):
+        if self._started:
+            await self._runner.wait_for_displays()
+
+    # Statistics of the wrapped runner, for profiling
+    @property
+    def round_trips(self):
+        return self._runner.round_trips
+
+    @property
+    def output_bytes(self):
+        return self._runner.output_bytes
+
+    @property
+    def peak_rss_kb(self):
+        return self._runner.peak_rss_kb
+
+    async def close(self):
+        if self._started:
+            await self._runner.close()
+        self._cache.save()
+
+    async def _start_and_replay(self):
+        self._started = True
+        await self._runner.start()
+        history = self._history
+        if self.supports_checkpoints:
+            history = history[await self._restore_latest_checkpoint() :]
+        for key, lines, echo_input, repl in history:
+            await self._runner.run_lines(lines, echo_input=echo_input, repl=repl)
+        self._runner.pop_displays()
+        self._history = []
+
+    async def _save_checkpoint(self):
+        path = self._cache.checkpoint_path(self._key, create=True)
+        reply = await self._runner.checkpoint(path)
+        if reply.get("error"):
+            self._checkpoints_failed = True
+            warn(f"could not save checkpoint ({reply['error']})")
+        elif reply["skipped"]:
+            warn(
+                "variables left out of checkpoint as they can't be pickled: "
+                + ", ".join(reply["skipped"])
+            )
+
+    # Restore the checkpoint of the latest request in the history that has one,
+    # and return the number of requests it covers
+    async def _restore_latest_checkpoint(self):
+        for i in range(len(self._history) - 1, -1, -1):
+            path = self._cache.checkpoint_path(self._history[i][0])
+            if not path.exists():
+                continue
+            reply = await self._runner.restore(path)
+            if reply.get("error"):
+                warn(f"could not restore checkpoint ({reply['error']})")
+                continue
+            if reply["skipped"]:
+                warn(
+                    "variables not restored from checkpoint: "
+                    + ", ".join(reply["skipped"])
+                )
+            return i + 1
+        return 0
+
+
+def warn(message):
+    print(f"pandoc-pythonexec: {message}", file=sys.stderr)
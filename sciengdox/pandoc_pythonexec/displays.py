@@ -0,0 +1,64 @@
+import hashlib
+import os
+from pathlib import Path
+
+# Prefix of the keys of display objects that aren't saved to a file (e.g. HTML
+# for interactive figures), which the code puts in the document in their place
+display_key_prefix = "pythonexec-display:"
+
+
+def display_key(data):
+    return display_key_prefix + hashlib.sha256(data).hexdigest()[:16]
+
+
+# Display objects published by the document's code (see DisplayPublisher in
+# driver.py).  Objects with a file path are written to that file, once per
+# build and only if the file doesn't already hold the same data.  Other objects
+# are kept until the element showing them takes them by their key.  Relative
+# paths are relative to `directory` (the working directory of the code), or to
+# the current directory.
+#
+# Inline objects (e.g. images displayed by code run in a Jupyter kernel) are
+# shown after the code that displayed them, and are kept until that code's
+# element takes them.
+class Displays(object):
+    def __init__(self, directory=None):
+        self._directory = Path(directory or ".")
+        self._pending = {}
+        self._inline = []
+        self._written = {}
+
+    def add(self, displays):
+        for description, data in displays:
+            if description.get("path"):
+                self._write(description["path"], data)
+            elif description.get("inline"):
+                self._inline.append((description, data))
+            else:
+                self._pending[description["key"]] = (description, data)
+
+    # Descriptions and data of the inline objects added since the last call
+    def pop_inline(self):
+        inline, self._inline = self._inline, []
+        return inline
+
+    # Description and data of the object with the given key, or None
+    def pop(self, key):
+        return self._pending.pop(key, None)
+
+    def _write(self, path, data):
+        digest = hashlib.sha256(data).hexdigest()
+        if self._written.get(path) == digest:
+            return
+        self._written[path] = digest
+
+        path = self._directory.joinpath(path)
+        try:
+            if path.stat().st_size == len(data) and path.read_bytes() == data:
+                return
+        except OSError:
+            pass
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_file = path.with_name(f".{path.name}.{os.getpid()}.tmp")
+        tmp_file.write_bytes(data)
+        os.replace(tmp_file, path)
@@ -0,0 +1,441 @@
+# Driver loop for the document's Python interpreter.
+#
+# This script is run by PythonRunner in the interpreter that executes the
+# document's code.  It only depends on the standard library so that it works in
+# any environment the document's code runs in.
+#
+# All communication uses frames made up of a one byte channel, a four byte
+# payload length, and the payload.  Control messages (requests, echoed input
+# lines, and end-of-response markers) are JSON on the message channel.  Output
+# is streamed as raw UTF-8 on separate stdout and stderr channels while the
+# code runs, so nothing in the output can be mistaken for protocol data.
+#
+# PythonRunner sends all lines of a code block in one request, and the driver
+# feeds them through an InteractiveConsole so they behave exactly as if typed
+# at a `python -i` prompt.
+#
+# The driver can also save the document's variables to a checkpoint file and
+# restore them later (see CachingRunner in cache.py).
+#
+# Display objects (e.g. figures from sciengdox.figures.svg_figure) are sent on a
+# separate display channel as a JSON description followed by the raw bytes, so
+# they don't have to pass through printed output.  Document code publishes them
+# with the `pythonexec_display` object in its global namespace.  Objects still
+# being rendered in the background are sent once they are ready, and all of
+# them when PythonRunner asks for the rest at the end of the document.
+import builtins
+import code
+import contextlib
+import importlib
+import io
+import json
+import os
+import pickle
+import signal
+import struct
+import sys
+import tempfile
+import types
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows
+
+prompt = ">>> "
+continuation = "... "
+
+header = struct.Struct(">cI")
+
+message_channel = b"M"
+stdout_channel = b"O"
+stderr_channel = b"E"
+display_channel = b"D"
+
+# Length of the JSON description at the start of a display frame
+display_header = struct.Struct(">I")
+
+# Output is sent in frames of about this many characters
+chunk_size = 65536
+
+
+def encode_frame(channel, payload):
+    return header.pack(channel, len(payload)) + payload
+
+
+def encode_message(obj):
+    return encode_frame(message_channel, json.dumps(obj).encode("utf-8"))
+
+
+def encode_display(description, data):
+    description = json.dumps(description).encode("utf-8")
+    return encode_frame(
+        display_channel, display_header.pack(len(description)) + description + data
+    )
+
+
+# Description and data of a display frame's payload
+def decode_display(payload):
+    (length,) = display_header.unpack_from(payload)
+    start = display_header.size
+    description = json.loads(payload[start : start + length].decode("utf-8"))
+    return description, payload[start + length :]
+
+
+def read_frame(stream):
+    head = stream.read(header.size)
+    if len(head) < header.size:
+        return None, None
+    channel, length = header.unpack(head)
+    return channel, stream.read(length)
+
+
+def read_message(stream):
+    channel, payload = read_frame(stream)
+    if channel != message_channel:
+        return None
+    return json.loads(payload.decode("utf-8"))
+
+
+# Writes frames to the protocol stream.  Consecutive writes to the same output
+# channel are combined into larger frames, and pending output is always sent
+# before output on another channel so that the order is preserved.
+class FrameWriter(object):
+    def __init__(self, stream):
+        self._stream = stream
+        self._channel = None
+        self._pending = []
+        self._pending_size = 0
+
+    def write_output(self, channel, text):
+        if channel != self._channel:
+            self._send_pending()
+            self._channel = channel
+        self._pending.append(text)
+        self._pending_size += len(text)
+        if self._pending_size >= chunk_size:
+            self._send_pending()
+
+    def write_message(self, obj):
+        self._send_pending()
+        self._stream.write(encode_message(obj))
+        self._stream.flush()
+
+    def write_display(self, description, data):
+        self._send_pending()
+        self._stream.write(encode_display(description, data))
+
+    def flush(self):
+        self._send_pending()
+        self._stream.flush()
+
+    def _send_pending(self):
+        if self._pending:
+            payload = "".join(self._pending).encode("utf-8", errors="replace")
+            self._stream.write(encode_frame(self._channel, payload))
+            self._pending = []
+            self._pending_size = 0
+
+
+# File-like object standing in for sys.stdout or sys.stderr while code runs
+class ChannelStream(io.TextIOBase):
+    def __init__(self, writer, channel):
+        self._writer = writer
+        self._channel = channel
+
+    @property
+    def encoding(self):
+        return "utf-8"
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        self._writer.write_output(self._channel, text)
+        return len(text)
+
+    def flush(self):
+        self._writer.flush()
+
+
+# Publishes display objects from the document's code to the pandoc filter.
+# `key` is the text the code puts in the document in place of the object (e.g.
+# the URL returned by svg_figure).  If `path` is given, the filter writes the
+# data to that file (unless it already holds the same data).
+#
+# `data` can also be a future (e.g. of a figure rendered in a worker process),
+# which is sent when it is done.  A newer object for the same key replaces one
+# that is still pending.
+class DisplayPublisher(object):
+    def __init__(self, writer):
+        self._writer = writer
+        self._pending = {}
+
+    def publish(self, mime, data, key, path=None):
+        previous = self._pending.pop(key, None)
+        if previous is not None:
+            previous[1].cancel()
+
+        description = {"mime": mime, "key": key, "path": path}
+        if hasattr(data, "result"):
+            self._pending[key] = (description, data)
+        else:
+            self._write(description, data)
+
+    # Send the pending objects that are done
+    def publish_ready(self):
+        for key, (description, future) in list(self._pending.items()):
+            if future.done():
+                del self._pending[key]
+                self._write_result(description, future)
+
+    # Wait for all pending objects and send them
+    def wait(self):
+        pending, self._pending = self._pending, {}
+        for description, future in pending.values():
+            self._write_result(description, future)
+
+    def _write_result(self, description, future):
+        try:
+            data = future.result()
+        except Exception as e:
+            print(
+                f"pandoc-pythonexec: could not render {description['key']} "
+                f"({type(e).__name__}: {e})",
+                file=sys.stderr,
+            )
+            return
+        self._write(description, data)
+
+    def _write(self, description, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self._writer.write_display(description, data)
+
+
+# Temporarily send output written directly to file descriptors 1 and 2 (e.g.
+# by subprocesses or extension modules) to files so it can be captured too.
+@contextlib.contextmanager
+def capture_fds(capture_files):
+    saved = [os.dup(1), os.dup(2)]
+    for fd, capture_file in zip([1, 2], capture_files):
+        capture_file.seek(0)
+        capture_file.truncate()
+        os.dup2(capture_file.fileno(), fd)
+    try:
+        yield
+    finally:
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        os.close(saved[0])
+        os.close(saved[1])
+
+
+# Peak resident set size of the interpreter in kilobytes, or None if unknown
+def peak_rss_kb():
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and kilobytes elsewhere
+    return maxrss // 1024 if sys.platform == "darwin" else maxrss
+
+
+class DocumentConsole(code.InteractiveConsole):
+    def __init__(self, namespace, writer, display=None):
+        super().__init__(namespace, filename="<stdin>")
+        self.more = False
+        self.interrupted = False
+        self._writer = writer
+        self._display = display
+        self._stdout = ChannelStream(writer, stdout_channel)
+        self._stderr = ChannelStream(writer, stderr_channel)
+        self._fd_output = [tempfile.TemporaryFile(), tempfile.TemporaryFile()]
+
+    # Run the lines of a block.  Each input line is announced on the message
+    # channel and followed by the output it produced.  A statement left open at
+    # the end of the block (e.g. a loop as the last lines) is finished as if a
+    # blank line had been entered, so it runs as part of this block.  If the
+    # code is interrupted (e.g. when PythonRunner's time limit is reached), the
+    # rest of the block is skipped.
+    def run_lines(self, lines):
+        self.interrupted = False
+        for line in lines:
+            line_prompt = continuation if self.more else prompt
+            self._writer.write_message({"input": [line_prompt, line]})
+            self._push_line(line)
+            if self.interrupted:
+                self.resetbuffer()
+                self.more = False
+                break
+        if self.more:
+            self._push_line("")
+        if self._display is not None:
+            self._display.publish_ready()
+        self.end_response(self.interrupted)
+
+    def end_response(self, interrupted=False):
+        self._writer.write_message(
+            {"end": True, "maxrss": peak_rss_kb(), "interrupted": interrupted}
+        )
+
+    def _push_line(self, line):
+        with capture_fds(self._fd_output), contextlib.redirect_stdout(
+            self._stdout
+        ), contextlib.redirect_stderr(self._stderr):
+            # Python's own SIGINT handler is used while the code runs so that
+            # tracebacks look as usual
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            try:
+                self.more = self.push(line)
+            except KeyboardInterrupt:
+                # Interrupted outside of the code itself (e.g. compiling)
+                self.interrupted = True
+                self.write("KeyboardInterrupt\n")
+            finally:
+                signal.signal(signal.SIGINT, self.interrupt)
+        for stream, capture_file in zip([self._stdout, self._stderr], self._fd_output):
+            capture_file.seek(0)
+            output = capture_file.read()
+            if output:
+                stream.write(output.decode("utf-8", errors="replace"))
+
+    # SIGINT handler outside of the document's code, so that the protocol
+    # itself is never interrupted
+    def interrupt(self, signum, frame):
+        self.interrupted = True
+
+    def showtraceback(self):
+        if isinstance(sys.exc_info()[1], KeyboardInterrupt):
+            self.interrupted = True
+        super().showtraceback()
+
+
+# Names in the document's namespace that are never saved in a checkpoint
+unsaved_names = {"__builtins__", "__name__", "pythonexec_display"}
+
+
+# Module used to pickle checkpoints, or None.  cloudpickle and dill save
+# functions and classes defined in the document by value.  Plain pickle saves
+# them by reference to `__main__`, so they couldn't be restored in a new
+# interpreter, and it isn't used.
+def checkpoint_pickler():
+    for name in ["cloudpickle", "dill"]:
+        try:
+            return importlib.import_module(name)
+        except ImportError:
+            pass
+    return None
+
+
+# Save the picklable variables of `namespace` to `path`.  Modules (e.g. `np`
+# from `import numpy as np`) are saved by name and imported again on restore.
+# Returns the names of variables that could not be saved.
+def save_checkpoint(namespace, path):
+    pickler = checkpoint_pickler()
+    if pickler is None:
+        raise RuntimeError("checkpoints require the cloudpickle or dill package")
+    values = {k: v for k, v in namespace.items() if k not in unsaved_names}
+    modules = {
+        k: v.__name__ for k, v in values.items() if isinstance(v, types.ModuleType)
+    }
+    values = {k: v for k, v in values.items() if k not in modules}
+    skipped = []
+    try:
+        data = pickler.dumps(values)
+    except Exception:
+        # Find the variables that can't be pickled and leave them out
+        for name, value in list(values.items()):
+            try:
+                pickler.dumps(value)
+            except Exception:
+                skipped.append(name)
+                del values[name]
+        data = pickler.dumps(values)
+
+    checkpoint = {
+        "pickler": pickler.__name__,
+        "skipped": skipped,
+        "modules": modules,
+        "data": data,
+    }
+    tmp_file = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
+        pickle.dump(checkpoint, f)
+    os.replace(tmp_file, path)
+    return skipped
+
+
+# Restore variables saved by save_checkpoint into `namespace`.  Returns the
+# names of variables that were not saved or whose module can't be imported.
+def restore_checkpoint(namespace, path):
+    with open(path, "rb") as f:
+        checkpoint = pickle.load(f)
+    pickler = importlib.import_module(checkpoint["pickler"])
+    namespace.update(pickler.loads(checkpoint["data"]))
+    skipped = list(checkpoint["skipped"])
+    for name, module in checkpoint["modules"].items():
+        try:
+            namespace[name] = importlib.import_module(module)
+        except ImportError:
+            skipped.append(name)
+    return skipped
+
+
+# Fresh __main__ module for the document's code, as in an interactive session
+def document_namespace(display):
+    module = types.ModuleType("__main__")
+    module.__builtins__ = builtins
+    module.pythonexec_display = display
+    sys.modules["__main__"] = module
+    return module.__dict__
+
+
+# Answer requests from PythonRunner until told to exit
+def serve(protocol_in, protocol_out):
+    writer = FrameWriter(protocol_out)
+    display = DisplayPublisher(writer)
+    console = DocumentConsole(document_namespace(display), writer, display)
+    signal.signal(signal.SIGINT, console.interrupt)
+    writer.write_message({"pid": os.getpid()})
+
+    while True:
+        request = read_message(protocol_in)
+        if request is None or request.get("exit"):
+            break
+        if "checkpoint" in request or "restore" in request:
+            writer.write_message(run_checkpoint_request(console.locals, request))
+        elif request.get("wait_displays"):
+            display.wait()
+            console.end_response()
+        else:
+            console.run_lines(request["lines"])
+
+
+def run_checkpoint_request(namespace, request):
+    try:
+        if "checkpoint" in request:
+            skipped = save_checkpoint(namespace, request["checkpoint"])
+        else:
+            skipped = restore_checkpoint(namespace, request["restore"])
+    except Exception as e:
+        return {"error": f"{type(e).__name__}: {e}"}
+    return {"skipped": skipped}
+
+
+def main():
+    # Keep the original stdout for the protocol.  Outside of captured code,
+    # anything written directly to file descriptor 1 goes to stderr instead so
+    # it can't corrupt a frame.
+    protocol_in = sys.stdin.buffer
+    protocol_out = os.fdopen(os.dup(1), "wb")
+    os.dup2(2, 1)
+    sys.stdin = io.StringIO()
+
+    # Import from the working directory as `python -i` would
+    sys.path[0] = ""
+
+    serve(protocol_in, protocol_out)
+
+
+if __name__ == "__main__":
+    main()
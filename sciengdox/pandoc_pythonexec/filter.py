@@ -1,117 +1,255 @@
 import panflute
+import base64
+import codecs
+import json
+import os
 import re
+import signal
+import sys
+import time
 import urllib
 import asyncio
 from itertools import chain
 
+from sciengdox.pandoc_pythonexec import driver, pool
+from sciengdox.pandoc_pythonexec.cache import CachingRunner, ExecutionCache
+from sciengdox.pandoc_pythonexec.displays import Displays
+from sciengdox.pandoc_pythonexec.fragments import FragmentConverter, simple_inlines
+from sciengdox.pandoc_pythonexec.profiling import ExecutionProfile
+from sciengdox.pandoc_pythonexec.transcript import (
+    Transcript,
+    echo_line,
+    spill_directory,
+)
+
 
 # Wrapper to always provide a list of classes
 def element_classes(elem):
     return elem.classes if hasattr(elem, "classes") else []
 
 
+# Blank lines would end an indented block in the interactive console, so
+# replace blank lines inside a block with the indent of the next line.
+def fill_blank_lines(lines):
+    filled = []
+    level = 0
+
+    for idx, line in enumerate(lines):
+        if line == "" and level != 0:
+            this_level = 0
+            for el in lines[(idx + 1) :]:
+                if el != "":
+                    this_level = indent_level(el)
+                    break
+            line = "    " * this_level
+
+        level = indent_level(line)
+        filled.append(line)
+
+    return filled
+
+
+def indent_level(line):
+    m = re.search(r"^\s*", line)
+    if m is not None:
+        return int(len(m[0]) / 4)
+    return 0
+
+
+# Raised when code runs longer than its time limit.  The output the code
+# produced before it was stopped is kept in `output`.
+class ExecutionTimeout(Exception):
+    def __init__(self, message, output=""):
+        super().__init__(message)
+        self.output = output
+
+
+# Runs code in a separate Python interpreter.  The interpreter runs the driver
+# loop in driver.py, and each call to run_lines sends a whole block of lines in
+# a single request.  See driver.py for the framing protocol.
+#
+# If the socket of an interpreter pool (see pool.py) is given, the runner uses a
+# pre-warmed interpreter from the pool instead of starting a new process.  The
+# interpreter runs in `cwd`, or in the filter's working directory.
 class PythonRunner(object):
-    prompt = ">>> "
-    continuation = "... "
+    prompt = driver.prompt
+    continuation = driver.continuation
+
+    # Seconds to wait for interrupted code to stop before killing the
+    # interpreter
+    interrupt_grace_period = 5
 
-    def __init__(self, executable="python"):
+    def __init__(self, executable="python", pool=None, max_output=None, cwd=None):
         self._proc = None
+        self._reader = None
+        self._writer = None
         self._executable = executable
+        self._pool = pool
+        self._max_output = max_output
+        self._cwd = cwd
+        self._killed = False
+        self._displays = []
+        self.pid = None
+
+        # Statistics for profiling (see profiling.py)
+        self.round_trips = 0
+        self.output_bytes = 0
+        self.peak_rss_kb = None
 
     async def start(self):
-        assert self._proc is None
-        self._proc = await asyncio.subprocess.create_subprocess_exec(
-            self._executable,
-            "-i",
-            stdin=asyncio.subprocess.PIPE,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.STDOUT,
+        assert self._reader is None
+        if self._pool is not None:
+            try:
+                self._reader, self._writer = await pool.open_pool_connection(
+                    self._pool, self._cwd
+                )
+            except OSError as e:
+                print(
+                    f"pandoc-pythonexec: interpreter pool not available ({e})",
+                    file=sys.stderr,
+                )
+
+        if self._reader is None:
+            self._proc = await asyncio.subprocess.create_subprocess_exec(
+                self._executable,
+                driver.__file__,
+                stdin=asyncio.subprocess.PIPE,
+                stdout=asyncio.subprocess.PIPE,
+                cwd=self._cwd,
+            )
+            self._reader, self._writer = self._proc.stdout, self._proc.stdin
+
+        hello = await self._receive_message()
+        self.pid = hello["pid"]
+        return ""
+
+    # Run a block of lines and return the transcript.  If `timeout` (seconds)
+    # is given and the code runs longer, it is interrupted with SIGINT (and the
+    # interpreter killed if it doesn't stop) and ExecutionTimeout is raised.
+    #
+    # If the runner has a `max_output` (characters), longer transcripts are cut
+    # down to their beginning and end, and the full transcript is written to a
+    # file (see transcript.py).
+    async def run_lines(self, lines, echo_input=True, repl=False, timeout=None):
+        if self._killed:
+            raise ExecutionTimeout("interpreter was stopped after a timeout")
+
+        self._send({"lines": fill_blank_lines(lines)})
+        transcript = Transcript(self._max_output, spill_directory)
+        receive = asyncio.ensure_future(
+            self._receive_transcript(transcript, echo_input, repl)
         )
-        return await self._wait_for_prompt()
-
-    async def run_lines(self, lines, echo_input=True, repl=False):
-        indent_level = 0
-        output = PythonRunner.prompt
-
-        for idx, line in enumerate(lines):
-            # handle empty line in indent
-            if line == "" and indent_level != 0:
-                if idx == len(lines) - 1:
-                    # last line
-                    this_level = 0
-                else:
-                    # find next indent level
-                    for el in lines[(idx + 1) :]:
-                        if el != "":
-                            this_level = self._indent_level(el)
-                            break
-                line = "    " * this_level
-
-            indent_level = self._indent_level(line)
-
-            # Send the command and capture the result
-            self._sendline(line)
-
-            result = await self._wait_for_prompt()
-
-            # Remove any leading line break from result and combine
-            # with the input.  Note that this includes prompts which
-            # may get removed below depending on args.
-            #
-            # If the input line was blank, output a space in its place to avoid
-            # the blank line getting dropped in HTML output.
-            output += (
-                (line if line != "" else " ") + "\n" + re.sub(r"^\r?\n", "", result)
+        try:
+            await asyncio.wait_for(asyncio.shield(receive), timeout)
+        except asyncio.TimeoutError:
+            await self._interrupt(receive)
+            transcript.finish()
+            raise ExecutionTimeout(
+                f"code timed out after {timeout:g} s", transcript.text()
             )
+        finally:
+            self.round_trips += 1
+            transcript.finish()
 
-        # Split output into individual lines
-        output_lines = output.split("\n")
+        return transcript.text()
 
-        # Remove trailing prompt from result
-        del output_lines[-1]
-
-        if echo_input:
-            if not repl:
-                # Remove prompts from the beginning of lines
-                output_lines = list(
-                    map(lambda x: re.sub(r"^(>>>|\.\.\.)\s", "", x), output_lines)
-                )
-        else:
-            # Remove echoed input lines
-            output_lines = list(
-                filter(lambda x: not re.search(r"^(>>>|\.\.\.)\s", x), output_lines)
-            )
+    # Interrupt running code, and kill the interpreter if it doesn't stop
+    # within the grace period
+    async def _interrupt(self, receive):
+        self._signal(signal.SIGINT)
+        try:
+            await asyncio.wait_for(asyncio.shield(receive), self.interrupt_grace_period)
+        except asyncio.TimeoutError:
+            receive.cancel()
+            self._signal(getattr(signal, "SIGKILL", signal.SIGTERM))
+            self._killed = True
 
-        return "\n".join(output_lines)
+    def _signal(self, signum):
+        try:
+            if self._proc is not None:
+                self._proc.send_signal(signum)
+            else:
+                os.kill(self.pid, signum)
+        except OSError:
+            pass
+
+    # Save the interpreter's variables to a file, or restore them from one (see
+    # save_checkpoint in driver.py).  Return the reply, which has either the
+    # names of variables that could not be saved or an error message.
+    async def checkpoint(self, path):
+        self._send({"checkpoint": str(path)})
+        return await self._receive_message()
+
+    async def restore(self, path):
+        self._send({"restore": str(path)})
+        return await self._receive_message()
+
+    # Display objects published by the code since the last call, as a list of
+    # (description, data) pairs (see DisplayPublisher in driver.py)
+    def pop_displays(self):
+        displays, self._displays = self._displays, []
+        return displays
+
+    # Wait for display objects that the code is still rendering in the
+    # background (e.g. figures rendered by worker processes).  They are then
+    # returned by pop_displays.
+    async def wait_for_displays(self):
+        if self._killed:
+            return
+        self._send({"wait_displays": True})
+        await self._receive_transcript(Transcript(), False, False)
 
     async def close(self):
-        assert self._proc is not None
-        self._sendline("exit()")
-        await self._proc.wait()
-
-    def _sendline(self, line):
-        assert self._proc is not None
-        self._proc.stdin.write(str.encode(line + "\r\n"))
-
-    async def _wait_for_prompt(self):
-        prompt_bytes = PythonRunner.prompt.encode()
-        continuation_bytes = PythonRunner.continuation.encode()
-
-        output = b""
+        assert self._reader is not None
+        if not self._killed:
+            self._send({"exit": True})
+        if self._proc is not None:
+            await self._proc.wait()
+        else:
+            self._writer.close()
+            await self._writer.wait_closed()
+
+    def _send(self, request):
+        assert self._writer is not None
+        self._writer.write(driver.encode_message(request))
+
+    async def _receive_frame(self):
+        head = await self._reader.readexactly(driver.header.size)
+        channel, length = driver.header.unpack(head)
+        return channel, await self._reader.readexactly(length)
+
+    async def _receive_message(self):
+        channel, payload = await self._receive_frame()
+        assert channel == driver.message_channel
+        return json.loads(payload.decode("utf-8"))
+
+    # Add the echoed input and output of one response to `transcript`.  Output
+    # is decoded incrementally per channel as frames arrive, so the cost is
+    # linear in the output size.
+    async def _receive_transcript(self, transcript, echo_input, repl):
+        decoders = {
+            driver.stdout_channel: codecs.getincrementaldecoder("utf-8")("replace"),
+            driver.stderr_channel: codecs.getincrementaldecoder("utf-8")("replace"),
+        }
 
         while True:
-            if output[-len(prompt_bytes) :] == prompt_bytes:
-                break
-            if output[-len(continuation_bytes) :] == continuation_bytes:
-                break
-            output += await self._proc.stdout.read(1024)
-        return output.decode()
-
-    def _indent_level(self, line):
-        m = re.search(r"^\s*", line)
-        if m is not None:
-            return int(len(m[0]) / 4)
-        return 0
+            channel, payload = await self._receive_frame()
+            if channel == driver.message_channel:
+                message = json.loads(payload.decode("utf-8"))
+                if "input" in message:
+                    prompt, line = message["input"]
+                    transcript.add_input(
+                        echo_line(prompt, line, repl) if echo_input else None
+                    )
+                elif message.get("end"):
+                    self.peak_rss_kb = message.get("maxrss")
+                    return transcript
+            elif channel == driver.display_channel:
+                self.output_bytes += len(payload)
+                self._displays.append(driver.decode_display(payload))
+            else:
+                self.output_bytes += len(payload)
+                transcript.add_output(decoders[channel].decode(payload))
 
 
 def find_inline_code(text):
@@ -125,13 +263,15 @@ def find_inline_code(text):
     return None
 
 
-async def replace_embedded_code_with_result(text, doc):
+async def replace_embedded_code_with_result(text, doc, runner, owner):
     found = find_inline_code(text)
     if found is not None:
         code, classes, span = found
         if "python" in classes:
             # Run the code
-            result = (await exec_inline_python(panflute.Str(code), doc)).text
+            result = (
+                await exec_inline_python(panflute.Str(code), doc, runner, owner)
+            ).text
 
             # Replace the result in the Math element
             text = text[0 : span[0]] + result + text[span[1] :]
@@ -139,45 +279,155 @@ async def replace_embedded_code_with_result(text, doc):
     return text
 
 
-async def exec_python_block(elem, doc):
-    elem.text = await doc.runner.run_lines(
-        elem.text.splitlines(), repl=("repl" in element_classes(elem))
+# Time limits for running code, from metadata and element attributes:
+#
+# - pythonexec-timeout: default limit in seconds for each element's code
+# - pythonexec-document-timeout: limit in seconds for all code in the document
+# - pythonexec-timeout-action: `fail` (default) to stop the build when a limit
+#   is reached, or `continue` to show a marker in place of the output instead
+#
+# An element's `timeout` attribute (e.g. `{.python timeout=30}`) overrides the
+# default limit for that element.
+class ExecutionLimits(object):
+    def __init__(self, doc):
+        self.timeout = self._seconds(doc.get_metadata("pythonexec-timeout", None))
+        document_timeout = self._seconds(
+            doc.get_metadata("pythonexec-document-timeout", None)
+        )
+        self.deadline = None
+        if document_timeout is not None:
+            self.deadline = time.monotonic() + document_timeout
+        action = doc.get_metadata("pythonexec-timeout-action", "fail")
+        self.fail = str(action).strip().lower() != "continue"
+
+    def timeout_for(self, elem):
+        timeout = self.timeout
+        attributes = getattr(elem, "attributes", None)
+        if attributes and attributes.get("timeout"):
+            timeout = self._seconds(attributes["timeout"])
+        if self.deadline is not None:
+            remaining = max(self.deadline - time.monotonic(), 0)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return timeout
+
+    def _seconds(self, value):
+        return None if value in (None, "") else float(value)
+
+
+# Run code with the time limit for `owner`.  Returns the transcript and whether
+# the limit was reached, in which case the transcript ends with a marker (or
+# the build is stopped, depending on the configuration).  Display objects
+# published by the code are handed to doc.displays.
+async def run_code(runner, doc, owner, lines, **kwargs):
+    timeout = doc.limits.timeout_for(owner)
+    try:
+        if timeout is not None and timeout <= 0:
+            raise ExecutionTimeout("document time limit reached, code not run")
+        return await runner.run_lines(lines, timeout=timeout, **kwargs), False
+    except ExecutionTimeout as e:
+        first_line = lines[0] if lines else ""
+        e.args = (f"{e.args[0]}: {first_line}",)
+        if doc.limits.fail:
+            raise
+        print(f"pandoc-pythonexec: {e}", file=sys.stderr)
+        marker = f"[{e.args[0]}]"
+        return (f"{e.output}\n{marker}" if e.output else marker), True
+    finally:
+        doc.displays.add(runner.pop_displays())
+
+
+# Paragraph with an image showing an inline display object (see Displays), with
+# the data in the URL so that no file has to be written
+def inline_display_image(description, data):
+    url = f"data:{description['mime']};base64,{base64.b64encode(data).decode()}"
+    return panflute.Para(panflute.Image(url=url))
+
+
+async def exec_python_block(elem, doc, runner):
+    kwargs = {}
+    if "checkpoint" in element_classes(elem) and getattr(
+        runner, "supports_checkpoints", False
+    ):
+        # Save the interpreter's variables after this block (see CachingRunner)
+        kwargs["checkpoint"] = True
+    elem.text, timed_out = await run_code(
+        runner,
+        doc,
+        elem,
+        elem.text.splitlines(),
+        repl=("repl" in element_classes(elem)),
+        **kwargs,
     )
-    if "echo" in element_classes(elem):
-        return None
-    return []
+    images = [inline_display_image(*d) for d in doc.displays.pop_inline()]
+    # Blocks that timed out are always shown so the marker is visible
+    if "echo" in element_classes(elem) or timed_out:
+        return [elem] + images if images else None
+    return images
 
 
-async def exec_inline_python(elem, doc):
-    elem.text = await doc.runner.run_lines([elem.text], echo_input=False)
+# `owner` is the element whose attributes set the time limit, if not `elem`
+async def exec_inline_python(elem, doc, runner, owner=None):
+    elem.text, timed_out = await run_code(
+        runner, doc, owner or elem, [elem.text], echo_input=False
+    )
     elem.text = elem.text.strip()
+    # Only blocks show inline display objects
+    doc.displays.pop_inline()
 
     if "asCode" in element_classes(elem):
         return None
     return panflute.Str(elem.text)
 
 
-async def exec_code_in_image(elem, doc):
+# HTML comments delimiting HTML output that replaces a placeholder image
+def html_placeholder_markers(number):
+    return (
+        f"<!-- pythonexec-html {number} -->",
+        f"<!-- /pythonexec-html {number} -->",
+    )
+
+
+async def exec_code_in_image(elem, doc, runner):
     # Remove escape characters from image url
     url = urllib.parse.unquote(elem.url)
 
     # Execute any embedded code replacing it with the output result
-    url = await replace_embedded_code_with_result(url, doc)
+    url = await replace_embedded_code_with_result(url, doc, runner, elem)
 
     # Remove any single quotes around executed output
     url = re.sub(r"\'", "", url)
 
+    # HTML published as a display object (see svg_figure) is shown in place of
+    # its key
+    display = doc.displays.pop(url)
+    html = display is not None and display[0]["mime"] == "text/html"
+    if html:
+        url = display[1].decode("utf-8")
+
     # See if the url was replaced with HTML (see svg_figure function)
-    if url.startswith("<div>"):
+    if html or url.startswith("<div>"):
         # Insert the HTML as RawBlock, followed by the original image node
-        # wrapped in a paragraph.  The associated <img> tag should be replaced
-        # later by the inserted div.
+        # wrapped in a paragraph.  The image is kept so that e.g. pandoc-crossref
+        # can still number it, and compiledoc later replaces the associated
+        # <img> tag with the HTML.  Both are tagged with a number so that they
+        # can be matched up in a single pass over the output (see
+        # html_placeholder_markers).
+        number = doc.raw_html_count
+        doc.raw_html_count += 1
 
         elem.url = "broken_img_replace_me"
+        elem.attributes["data-pythonexec-html"] = str(number)
 
-        url = url.replace("<div>", f"<div id='{elem.identifier}'>", 1)
-        doc.elements_to_replace.append(elem.parent)
-        doc.replacement_elements.append([panflute.RawBlock(url), panflute.Para(elem)])
+        if url.startswith("<div>"):
+            url = url.replace("<div>", f"<div id='{elem.identifier}'>", 1)
+        else:
+            url = f"<div id='{elem.identifier}'>{url}</div>"
+        start, end = html_placeholder_markers(number)
+        postpone_replacement(
+            doc,
+            elem.parent,
+            [panflute.RawBlock(start + url + end), panflute.Para(elem)],
+        )
 
         return None
 
@@ -187,14 +437,45 @@ async def exec_code_in_image(elem, doc):
     return None
 
 
+# Replace a block (e.g. the paragraph containing an inline element) once the
+# whole document has been executed.  Replacements are keyed by identity, and the
+# first replacement recorded for an element wins.
+def postpone_replacement(doc, old_elem, new_elems):
+    doc.postponed_replacements.setdefault(id(old_elem), (old_elem, new_elems))
+
+
+# Splice the postponed replacements into the containers holding the replaced
+# elements.  Only those containers are searched, not the whole document.
+def apply_postponed_replacements(doc):
+    remaining = {}
+    for old_elem, new_elems in doc.postponed_replacements.values():
+        if not isinstance(new_elems, list):
+            new_elems = [new_elems]
+        container = old_elem.container
+        if isinstance(container, panflute.ListContainer):
+            for i, item in enumerate(container.list):
+                if item is old_elem:
+                    container[i : i + 1] = new_elems
+                    break
+            else:
+                remaining[id(old_elem)] = new_elems
+        else:
+            remaining[id(old_elem)] = new_elems
+
+    # Elements that aren't where their parent says they are (which shouldn't
+    # happen) are found by walking the document instead
+    if remaining:
+        doc.walk(lambda elem, doc: remaining.get(id(elem)))
+    doc.postponed_replacements = {}
+
+
 def replace_element(doc, old_elem, new_elem):
     if isinstance(old_elem, panflute.Inline):
         if isinstance(new_elem, panflute.Inline):
             return new_elem
         elif isinstance(new_elem, panflute.Block):
             # new_elem is block.  Need to replace parent.
-            doc.elements_to_replace.append(old_elem.parent)
-            doc.replacement_elements.append(new_elem)
+            postpone_replacement(doc, old_elem.parent, new_elem)
     elif isinstance(old_elem, panflute.Block):
         if isinstance(new_elem, panflute.Block):
             return new_elem
@@ -204,50 +485,168 @@ def replace_element(doc, old_elem, new_elem):
     return None
 
 
-# Basically a copy of Element.walk from panflute, but converted to be async.
-# See https://github.com/sergiocorreia/panflute/blob/master/panflute/base.py
-async def async_walk(element, action, doc=None):
-    # Infer the document thanks to .parent magic
-    if doc is None:
-        doc = element.doc
+# Child elements of an element, each with the container holding it and its
+# index or key there (or None if the element is held directly by an attribute)
+def child_elements(element):
+    for child in element._children:
+        obj = getattr(element, child)
+        if isinstance(obj, panflute.Element):
+            yield None, None, obj
+        elif isinstance(obj, panflute.ListContainer):
+            for i, item in enumerate(obj.list):
+                yield obj, i, item
+        elif isinstance(obj, panflute.DictContainer):
+            for k, v in obj.dict.items():
+                yield obj, k, v
+
+
+# Set the .parent, .location, and .index of an element held in a container.
+# panflute's walk gets these set as a side effect of fetching each element from
+# its container (see panflute.containers.attach), and actions rely on them.
+def attach_to_container(element, container, key):
+    element.parent = container.parent
+    element.location = container.location
+    element.index = key if isinstance(container, panflute.ListContainer) else None
+
+
+# Elements of the tree that are of one of the given types or contain such an
+# element, i.e. the only elements an action for those types can change, paired
+# with their parents in post-order (children before their parent).  This is a
+# quick synchronous pass so the rest of the document isn't walked asynchronously.
+def find_elements_containing(root, types):
+    order = []
+    contains = set()
+    stack = [(root, None, None, child_elements(root))]
+    while stack:
+        element, container, key, children = stack[-1]
+        child = next(children, None)
+        if child is not None:
+            child_container, child_key, child_element = child
+            if child_element._children:
+                stack.append(
+                    (
+                        child_element,
+                        child_container,
+                        child_key,
+                        child_elements(child_element),
+                    )
+                )
+            elif isinstance(child_element, types):
+                # Leaves (most of the document's text) are handled here
+                # without a stack frame of their own
+                if child_container is not None:
+                    attach_to_container(child_element, child_container, child_key)
+                order.append((child_element, element))
+                contains.add(id(element))
+            continue
+        stack.pop()
+        parent = stack[-1][0] if stack else None
+        if isinstance(element, types) or id(element) in contains:
+            if container is not None:
+                attach_to_container(element, container, key)
+            order.append((element, parent))
+            contains.add(id(parent))
+    return order
+
+
+# Rebuild an element's children with the results of the action, as panflute's
+# walk does: lists returned by the action are spliced in, and dictionary
+# entries replaced by [] are dropped.
+def replace_children(element, replacements):
+    def result(item):
+        return replacements.get(id(item), item)
 
-    # Iterate over children
     for child in element._children:
         obj = getattr(element, child)
         if isinstance(obj, panflute.Element):
-            ans = await async_walk(obj, action, doc)
+            setattr(element, child, result(obj))
         elif isinstance(obj, panflute.ListContainer):
-            ans = []
-            for item in obj:
-                ans.append(await async_walk(item, action, doc))
-            # We need to convert single elements to iterables, so that they
-            # can be flattened later
+            ans = [result(item) for item in obj.list]
             ans = ((item,) if type(item) != list else item for item in ans)
-            # Flatten the list, by expanding any sublists
-            ans = list(chain.from_iterable(ans))
+            setattr(element, child, list(chain.from_iterable(ans)))
         elif isinstance(obj, panflute.DictContainer):
-            ans = []
-            for k, v in obj.items():
-                ans.append((k, await async_walk(v, action, doc)))
-            ans = [(k, v) for k, v in ans if v != []]
-        elif obj is None:
-            ans = None  # Empty table headers or captions
-        else:
-            raise TypeError(type(obj))
-        setattr(element, child, ans)
+            ans = [(k, result(v)) for k, v in obj.items()]
+            setattr(element, child, [(k, v) for k, v in ans if v != []])
+
+
+# Async version of panflute's Element.walk (see
+# https://github.com/sergiocorreia/panflute/blob/master/panflute/base.py), with
+# the action only applied to elements of the given types.  Parts of the tree
+# without such elements are skipped.  The walk is iterative so that deeply
+# nested documents don't hit the recursion limit.
+async def async_walk(element, action, doc=None, types=panflute.Element):
+    # Infer the document thanks to .parent magic
+    if doc is None:
+        doc = element.doc
+
+    replacements = {}
+    changed = set()
+    for elem, parent in find_elements_containing(element, types):
+        if id(elem) in changed:
+            replace_children(elem, replacements)
+        if isinstance(elem, types):
+            altered = await action(elem, doc)
+            if altered is not None and altered is not elem:
+                replacements[id(elem)] = altered
+                changed.add(id(parent))
 
-    # Then apply the action to the element
-    altered = await action(element, doc)
-    return element if altered is None else altered
+    return replacements.get(id(element), element)
+
+
+# The only elements exec_code_blocks changes
+executable_types = (panflute.Code, panflute.CodeBlock, panflute.Math, panflute.Image)
+
+
+# Name of the session an element's code runs in, or None for the main session
+def element_session(elem):
+    attributes = getattr(elem, "attributes", None)
+    if attributes:
+        return attributes.get("session") or None
+    return None
 
 
 async def exec_code_blocks(elem, doc):
+    session = element_session(elem)
+    if session is None:
+        return await exec_profiled(elem, doc, doc.runner, session)
+
+    # Run the code in the named session's interpreter alongside the rest of the
+    # document and put the result in place once everything has run
+    async def exec_in_session(runner):
+        altered = await exec_profiled(elem, doc, runner, session)
+        if altered is not None:
+            postpone_replacement(doc, elem, altered)
+
+    doc.sessions.run(session, exec_in_session)
+    return None
+
+
+async def exec_profiled(elem, doc, runner, session):
+    if doc.profile is None:
+        return await exec_element(elem, doc, runner)
+    return await doc.profile.measure(
+        elem, runner, session, exec_element(elem, doc, runner)
+    )
+
+
+# Inline content of a converted markdown block, or its text if it has no inline
+# content (e.g. if the code printed a traceback that became a code block)
+def inline_content(block):
+    content = getattr(block, "content", None)
+    if content and all(isinstance(e, panflute.Inline) for e in content):
+        return list(content)
+    return [panflute.Str(panflute.stringify(block).strip())]
+
+
+async def exec_element(elem, doc, runner):
     classes = element_classes(elem)
     if type(elem) == panflute.Image:
-        return await exec_code_in_image(elem, doc)
+        return await exec_code_in_image(elem, doc, runner)
 
     if type(elem) == panflute.Math:
-        elem.text = await replace_embedded_code_with_result(elem.text, doc)
+        elem.text = await replace_embedded_code_with_result(
+            elem.text, doc, runner, elem
+        )
         return None
 
     if "noexec" not in classes:
@@ -255,43 +654,201 @@ async def exec_code_blocks(elem, doc):
             # Handle special case of printing numbers, quantities, or raw
             # markdown if all that is in the code block is `pq(value)`,
             # `pmd(value)`, `pi(value)` or `pf(value)`
-            await exec_inline_python(elem, doc)
-            new_element = panflute.convert_text(elem.text)[0]
-            return panflute.Span(*new_element.content)
+            await exec_inline_python(elem, doc, runner)
+            inlines = simple_inlines(elem.text)
+            if inlines is not None:
+                return panflute.Span(*inlines)
+            span = panflute.Span()
+            doc.fragments.add(
+                elem.text,
+                lambda block: setattr(span, "content", inline_content(block)),
+            )
+            return span
         if "python" in classes:
             if type(elem) == panflute.CodeBlock:
-                return await exec_python_block(elem, doc)
+                return await exec_python_block(elem, doc, runner)
             elif type(elem) == panflute.Code:
-                result = await exec_inline_python(elem, doc)
+                result = await exec_inline_python(elem, doc, runner)
                 if "md" in classes:
-                    new_element = panflute.convert_text(
-                        elem.text, input_format="markdown"
-                    )[0]
-                    return replace_element(doc, elem, new_element)
+                    # The parent block is replaced by the converted markdown
+                    doc.fragments.add(
+                        elem.text, lambda block: replace_element(doc, elem, block)
+                    )
+                    return None
                 return result
 
 
-async def walk_and_execute_code(doc, executable="python"):
-    doc.runner = PythonRunner(executable)
-    doc.elements_to_replace = []
-    doc.replacement_elements = []
+# Output formats that the executed document will be written to.  When
+# compiledoc executes the code once for several formats, the filter is run with
+# pandoc's JSON writer and the real target formats are listed in metadata.
+def document_output_formats(doc):
+    formats = doc.get_metadata("pythonexec-formats", None)
+    if not formats:
+        return [doc.format]
+    return [f.strip() for f in str(formats).split(",") if f.strip()]
+
+
+# Maximum number of characters of output shown for one element's code, unless
+# set with the pythonexec-max-output metadata (0 for no limit)
+default_max_output = 1000000
 
-    await doc.runner.start()
 
-    # Assign the doc output format to a global in the runner context
-    await doc.runner.run_lines([f"document_output_format = '{doc.format}'\n"])
+def max_output(doc):
+    value = doc.get_metadata("pythonexec-max-output", None)
+    if value in (None, ""):
+        return default_max_output
+    return int(value) or None
 
-    doc = await async_walk(doc, exec_code_blocks)
 
-    await doc.runner.close()
+# Working directory of the document's code, if not the filter's own (e.g. when
+# compiledoc runs pandoc in a scratch directory, the code still runs in the
+# output directory, where the static files are)
+def document_cwd(doc):
+    return doc.get_metadata("pythonexec-cwd", None) or None
 
 
-def handle_postponed_replacements(elem, doc):
+def python_backend(doc, executable):
+    return PythonRunner(
+        executable,
+        doc.get_metadata("pythonexec-pool", None),
+        max_output(doc),
+        document_cwd(doc),
+    )
+
+
+def jupyter_backend(doc, executable):
+    from sciengdox.pandoc_pythonexec.jupyter import JupyterRunner
+
+    return JupyterRunner(
+        doc.get_metadata("pythonexec-kernel", "python3"),
+        doc.get_metadata("pythonexec-kernel-connection", None),
+        max_output(doc),
+        document_cwd(doc),
+    )
+
+
+# Execution backends, selected with the pythonexec-backend metadata.  Each
+# creates a runner with the interface of PythonRunner: start(), run_lines(),
+# close(), and the statistics used for profiling.
+backends = {"python": python_backend, "jupyter": jupyter_backend}
+
+
+# Runner for one interpreter session, optionally replaying results of unchanged
+# code from a previous build
+def create_runner(doc, executable, session=None):
+    backend = str(doc.get_metadata("pythonexec-backend", "python"))
+    if backend not in backends:
+        raise ValueError(f"unknown pythonexec-backend: {backend}")
+    runner = backends[backend](doc, executable)
+    cache_dir = doc.get_metadata("pythonexec-cache", None)
+    if cache_dir:
+        seed = f"{executable}|{doc.format}"
+        if backend != "python":
+            seed += f"|{backend}"
+        if session is not None:
+            seed += f"|{session}"
+        checkpoint_after = doc.get_metadata("pythonexec-checkpoint-after", None)
+        runner = CachingRunner(
+            runner,
+            ExecutionCache(cache_dir, seed),
+            float(checkpoint_after) if checkpoint_after not in (None, "") else None,
+        )
+    return runner
+
+
+async def start_runner(runner, doc):
+    await runner.start()
+
+    # Assign the doc output format to a global in the runner context.  If the
+    # result is shared between several output formats, the format is that of
+    # the shared document (i.e. 'json') and the individual formats are listed
+    # in document_output_formats.
+    formats = document_output_formats(doc)
+    output_format = formats[0] if len(formats) == 1 else doc.format
+    lines = [
+        f"document_output_format = '{output_format}'",
+        f"document_output_formats = {formats!r}",
+    ]
+
+    # Optionally let sciengdox.figures render figures in this many worker
+    # processes while the code continues
+    figure_workers = doc.get_metadata("pythonexec-figure-workers", None)
+    if figure_workers not in (None, ""):
+        lines.append(f"document_figure_workers = {int(figure_workers)}")
+    lines[-1] += "\n"
+    await runner.run_lines(lines)
+
+
+# Collect the display objects still being rendered by the runner's code, then
+# close the runner
+async def close_runner(runner, doc):
     try:
-        idx = doc.elements_to_replace.index(elem)
-        return doc.replacement_elements[idx]
-    except ValueError:
-        return None
+        await runner.wait_for_displays()
+        doc.displays.add(runner.pop_displays())
+    finally:
+        await runner.close()
+
+
+# Named sessions (e.g. `{.python session=thermal}`), each with its own
+# interpreter.  The code of a session runs in document order, but concurrently
+# with the main session and with other sessions.
+class Sessions(object):
+    def __init__(self, doc, executable):
+        self._doc = doc
+        self._executable = executable
+        self._runners = {}
+        self._tasks = {}
+
+    # Schedule `execute(runner)` after the session's previous code
+    def run(self, name, execute):
+        previous = self._tasks.get(name)
+        if previous is None:
+            runner = create_runner(self._doc, self._executable, name)
+            self._runners[name] = runner
+            previous = asyncio.ensure_future(start_runner(runner, self._doc))
+        runner = self._runners[name]
+
+        async def run_after_previous():
+            await previous
+            await execute(runner)
+
+        self._tasks[name] = asyncio.ensure_future(run_after_previous())
+
+    async def wait(self):
+        try:
+            await asyncio.gather(*self._tasks.values())
+        finally:
+            for runner in self._runners.values():
+                await close_runner(runner, self._doc)
+
+
+async def walk_and_execute_code(doc, executable="python"):
+    doc.runner = create_runner(doc, executable)
+    doc.sessions = Sessions(doc, executable)
+    doc.postponed_replacements = {}
+    doc.raw_html_count = 0
+    doc.fragments = FragmentConverter()
+    doc.displays = Displays(document_cwd(doc))
+    doc.limits = ExecutionLimits(doc)
+
+    # Optionally record the run time of each element's code.  The profile is
+    # written to <pythonexec-profile>.<output format>.json.
+    profile_path = doc.get_metadata("pythonexec-profile", None)
+    doc.profile = None
+    if profile_path:
+        doc.profile = ExecutionProfile(doc.get_metadata("pythonexec-source", None))
+
+    await start_runner(doc.runner, doc)
+
+    doc = await async_walk(doc, exec_code_blocks, types=executable_types)
+    await doc.sessions.wait()
+    doc.fragments.convert()
+    apply_postponed_replacements(doc)
+
+    await close_runner(doc.runner, doc)
+
+    if doc.profile is not None:
+        doc.profile.save(f"{profile_path}.{doc.format}.json")
 
 
 def main(doc=None):
@@ -311,9 +868,16 @@ def main(doc=None):
                 "environment variable: PYTHONIOENCODING=utf-8"
             )
 
+    # panflute reads and writes the document recursively, so allow for deeply
+    # nested documents
+    sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+
     doc = panflute.load()
-    asyncio.run(walk_and_execute_code(doc, sys.executable))
-    doc = doc.walk(handle_postponed_replacements)
+    try:
+        asyncio.run(walk_and_execute_code(doc, sys.executable))
+    except ExecutionTimeout as e:
+        print(f"pandoc-pythonexec: {e}", file=sys.stderr)
+        sys.exit(1)
     panflute.dump(doc)
 
 
@@ -0,0 +1,87 @@
+import re
+
+import panflute
+
+# Markdown printed by the document's code (e.g. by pq() and pmd()) is converted
+# to pandoc elements after all code has run, with a single pandoc call for the
+# whole document rather than one call per fragment.  Short, plain fragments
+# like the quantities printed by pq() are converted directly without pandoc.
+
+fragment_id_prefix = "pythonexec-fragment-"
+
+# Letters, digits, spaces, and punctuation with no special meaning in pandoc's
+# markdown, plus ^superscripts^ and ~subscripts~ (e.g. "9.81 m/s^2^")
+simple_text_pattern = re.compile(r"^(?:[^\W_]|[ .,:;/+\-=%°×·()^~])+$")
+simple_token_pattern = re.compile(r"(\^[^\s^~]+\^|~[^\s^~]+~| +)")
+
+# Text that pandoc would turn into a list item or typographic punctuation
+list_marker_pattern = re.compile(r"^(?:[-+] |\(?(?:\d+|[A-Za-z]+)[.)] )")
+
+
+# Inline elements for plain text, or None if the text needs pandoc's markdown
+# reader to be converted correctly
+def simple_inlines(text):
+    text = text.strip()
+    if (
+        not simple_text_pattern.match(text)
+        or list_marker_pattern.match(text)
+        or ".." in text
+        or "--" in text
+    ):
+        return None
+
+    inlines = []
+    for token in simple_token_pattern.split(text):
+        if not token:
+            continue
+        if token.isspace():
+            inlines.append(panflute.Space())
+        elif token[0] == "^" and len(token) > 2 and token[-1] == "^":
+            inlines.append(panflute.Superscript(panflute.Str(token[1:-1])))
+        elif token[0] == "~" and len(token) > 2 and token[-1] == "~":
+            inlines.append(panflute.Subscript(panflute.Str(token[1:-1])))
+        elif "^" in token or "~" in token:
+            return None
+        else:
+            inlines.append(panflute.Str(token))
+    return inlines
+
+
+# Collects markdown fragments while the document is walked and converts them
+# all at once.  Each fragment is given a callback that receives the first block
+# of the converted fragment.
+class FragmentConverter(object):
+    def __init__(self):
+        self._fragments = []
+
+    def add(self, text, callback):
+        self._fragments.append((text, callback))
+
+    # Convert every fragment with one pandoc call.  Each fragment is wrapped in
+    # a fenced div so the converted blocks can be matched up with it again.
+    def convert(self):
+        if not self._fragments:
+            return
+
+        source = "\n\n".join(
+            f"::: {{#{fragment_id_prefix}{i}}}\n{text}\n:::"
+            for i, (text, callback) in enumerate(self._fragments)
+        )
+        converted = {}
+        for block in panflute.convert_text(source, input_format="markdown"):
+            if isinstance(block, panflute.Div) and block.identifier.startswith(
+                fragment_id_prefix
+            ):
+                converted[block.identifier] = block
+
+        for i, (text, callback) in enumerate(self._fragments):
+            div = converted.get(f"{fragment_id_prefix}{i}")
+            if div is None or len(div.content) == 0:
+                # Something in the fragment broke up the div, so fall back to
+                # converting this fragment on its own
+                blocks = panflute.convert_text(text, input_format="markdown")
+                block = blocks[0]
+            else:
+                block = div.content[0]
+            callback(block)
+        self._fragments = []
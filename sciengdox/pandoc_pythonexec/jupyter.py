@@ -0,0 +1,253 @@
+import asyncio
+import base64
+import codeop
+import os
+import re
+import time
+
+from sciengdox.pandoc_pythonexec.displays import display_key
+from sciengdox.pandoc_pythonexec.filter import (
+    ExecutionTimeout,
+    PythonRunner,
+    fill_blank_lines,
+)
+from sciengdox.pandoc_pythonexec.transcript import (
+    Transcript,
+    echo_line,
+    spill_directory,
+)
+
+try:
+    from jupyter_client import AsyncKernelClient, AsyncKernelManager
+except ImportError:
+    AsyncKernelClient = None
+    AsyncKernelManager = None
+
+
+# Defines the `pythonexec_display` object for the document's code (see
+# DisplayPublisher in driver.py), which sends display objects as display data
+# tagged with their description.  Output of the code's statements has to be
+# sent while they run, so objects rendered in the background are waited for.
+display_publisher_code = """
+class PythonexecDisplay(object):
+    def publish(self, mime, data, key, path=None):
+        import base64
+        from IPython.display import publish_display_data
+
+        if hasattr(data, "result"):
+            data = data.result()
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        publish_display_data(
+            {mime: base64.b64encode(data).decode("ascii")},
+            metadata={"pythonexec": {"mime": mime, "key": key, "path": path}},
+        )
+
+
+pythonexec_display = PythonexecDisplay()
+del PythonexecDisplay
+"""
+
+# Image types of display data shown in the document (e.g. figures shown with
+# IPython's display() or matplotlib's inline backend), most preferred first.
+# Images are passed as base64 in display data, except for SVG.
+inline_image_types = ["image/svg+xml", "image/png", "image/jpeg"]
+
+# ANSI escape sequences, e.g. the colors in IPython tracebacks
+ansi_escape_pattern = re.compile(r"\x1b\[[0-9;]*[A-Za-z]")
+
+
+# Group lines into complete statements the way the interactive console does,
+# so that each statement's output follows its lines in the transcript.  A
+# statement that is still open at the end of the lines is completed there.
+def group_statements(lines):
+    buffer = []
+    for line in lines:
+        buffer.append(line)
+        try:
+            complete = codeop.compile_command("\n".join(buffer), "<stdin>", "single")
+        except (SyntaxError, OverflowError, ValueError):
+            # Let the kernel report the error
+            complete = True
+        if complete:
+            yield buffer
+            buffer = []
+    if buffer:
+        yield buffer
+
+
+# MIME type and data of the image in display data, or None
+def inline_image(data):
+    for mime in inline_image_types:
+        if mime in data:
+            if mime == "image/svg+xml":
+                return mime, data[mime].encode("utf-8")
+            return mime, base64.b64decode(data[mime])
+    return None
+
+
+# Runs code in a Jupyter kernel (e.g. ipykernel) using the optional
+# jupyter_client package.  It has the same interface as PythonRunner, so it
+# can be used in its place (see `backends` in filter.py).
+#
+# By default a new kernel of the given kernel spec is started and shut down
+# with the runner.  If a connection file is given, the runner connects to an
+# already running kernel instead and leaves it running, so that one warm kernel
+# can serve several builds.  Its variables are then shared by all of them.
+# A kernel started by the runner runs in `cwd` (as PythonRunner does), while a
+# running kernel keeps its own working directory.
+#
+# Each statement is sent as a separate execute request so that the transcript
+# looks the same as with PythonRunner: stream output, results, and errors are
+# read from the kernel's messages rather than from a console.  Display data
+# with an image (see inline_image_types) is passed on as an inline display
+# object, which the filter shows after the code block.
+class JupyterRunner(object):
+    prompt = PythonRunner.prompt
+    continuation = PythonRunner.continuation
+
+    # Seconds to wait for the kernel to start, and for interrupted code to stop
+    # before the kernel is shut down
+    startup_timeout = 60
+    interrupt_grace_period = PythonRunner.interrupt_grace_period
+
+    def __init__(
+        self, kernel_name="python3", connection_file=None, max_output=None, cwd=None
+    ):
+        self._kernel_name = kernel_name
+        self._connection_file = connection_file
+        self._max_output = max_output
+        self._cwd = cwd
+        self._manager = None
+        self._client = None
+        self._killed = False
+        self._displays = []
+
+        # Statistics for profiling (see profiling.py)
+        self.round_trips = 0
+        self.output_bytes = 0
+        self.peak_rss_kb = None
+
+    async def start(self):
+        if AsyncKernelManager is None:
+            raise RuntimeError(
+                "The jupyter backend requires the jupyter_client package "
+                "(e.g. `pip install jupyter_client ipykernel`)"
+            )
+
+        if self._connection_file:
+            self._client = AsyncKernelClient()
+            self._client.load_connection_file(self._connection_file)
+        else:
+            self._manager = AsyncKernelManager(kernel_name=self._kernel_name)
+            await self._manager.start_kernel(cwd=self._cwd or os.getcwd())
+            self._client = self._manager.client()
+        self._client.start_channels()
+        await self._client.wait_for_ready(timeout=self.startup_timeout)
+        await self._execute(display_publisher_code, Transcript(), None)
+        return ""
+
+    async def run_lines(self, lines, echo_input=True, repl=False, timeout=None):
+        if self._killed:
+            raise ExecutionTimeout("interpreter was stopped after a timeout")
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        transcript = Transcript(self._max_output, spill_directory)
+        try:
+            for statement in group_statements(fill_blank_lines(lines)):
+                for i, line in enumerate(statement):
+                    if echo_input:
+                        prompt = self.prompt if i == 0 else self.continuation
+                        transcript.add_input(echo_line(prompt, line, repl))
+                    elif i == 0:
+                        transcript.add_input()
+                if not await self._execute("\n".join(statement), transcript, deadline):
+                    # Like the console, skip the rest of interrupted code
+                    transcript.finish()
+                    raise ExecutionTimeout(
+                        f"code timed out after {timeout:g} s", transcript.text()
+                    )
+        finally:
+            self.round_trips += 1
+            transcript.finish()
+
+        return transcript.text()
+
+    def pop_displays(self):
+        displays, self._displays = self._displays, []
+        return displays
+
+    async def wait_for_displays(self):
+        pass
+
+    async def close(self):
+        self._client.stop_channels()
+        if self._manager is not None:
+            await self._manager.shutdown_kernel()
+
+    # Execute one statement, adding its output to `transcript`.  Returns False
+    # if the deadline passed and the statement was interrupted.
+    async def _execute(self, code, transcript, deadline):
+        msg_id = self._client.execute(code, store_history=False, allow_stdin=False)
+        receive = asyncio.ensure_future(self._receive_output(msg_id, transcript))
+        remaining = None if deadline is None else max(deadline - time.monotonic(), 0)
+        try:
+            await asyncio.wait_for(asyncio.shield(receive), remaining)
+            return True
+        except asyncio.TimeoutError:
+            await self._interrupt(receive)
+            return False
+
+    async def _receive_output(self, msg_id, transcript):
+        while True:
+            message = await self._client.get_iopub_msg()
+            if message["parent_header"].get("msg_id") != msg_id:
+                continue
+            msg_type = message["header"]["msg_type"]
+            content = message["content"]
+            if msg_type == "stream":
+                self._add_output(transcript, content["text"])
+            elif msg_type == "display_data" and "pythonexec" in content["metadata"]:
+                description = content["metadata"]["pythonexec"]
+                data = base64.b64decode(content["data"][description["mime"]])
+                self.output_bytes += len(data)
+                self._displays.append((description, data))
+            elif msg_type == "display_data" and inline_image(content["data"]):
+                mime, data = inline_image(content["data"])
+                self.output_bytes += len(data)
+                description = {"mime": mime, "key": display_key(data), "path": None}
+                self._displays.append(({**description, "inline": True}, data))
+            elif msg_type in ("execute_result", "display_data"):
+                text = content["data"].get("text/plain")
+                if text is not None:
+                    self._add_output(transcript, text + "\n")
+            elif msg_type == "error":
+                traceback = ansi_escape_pattern.sub("", "\n".join(content["traceback"]))
+                # Drop IPython's rule above the traceback, which would become a
+                # horizontal rule in markdown output
+                traceback = re.sub(r"^-+\n", "", traceback)
+                self._add_output(transcript, traceback)
+            elif msg_type == "status" and content["execution_state"] == "idle":
+                return
+
+    def _add_output(self, transcript, text):
+        self.output_bytes += len(text.encode("utf-8", "replace"))
+        transcript.add_output(text)
+
+    # Interrupt running code, and shut down the kernel (or stop using a kernel
+    # started elsewhere) if it doesn't stop within the grace period
+    async def _interrupt(self, receive):
+        if self._manager is not None:
+            await self._manager.interrupt_kernel()
+        else:
+            self._client.control_channel.send(
+                self._client.session.msg("interrupt_request", {})
+            )
+        try:
+            await asyncio.wait_for(asyncio.shield(receive), self.interrupt_grace_period)
+        except asyncio.TimeoutError:
+            receive.cancel()
+            self._killed = True
+            if self._manager is not None:
+                await self._manager.shutdown_kernel(now=True)
+                self._manager = None
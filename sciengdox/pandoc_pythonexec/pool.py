@@ -0,0 +1,296 @@
+# Pool of pre-warmed interpreters for the pandoc-pythonexec filter.
+#
+# The pool server imports a list of commonly used modules once and then listens
+# on a Unix domain socket.  Every connection is handled by a freshly forked copy
+# of the server, so each document gets a clean interpreter with those modules
+# already imported.  The forked worker runs the same driver loop (see
+# driver.py) that PythonRunner otherwise starts in a new process.
+#
+# This requires fork() and Unix domain sockets, so it is not available on
+# Windows.
+import argparse
+import asyncio
+import atexit
+import getpass
+import hashlib
+import importlib
+import importlib.metadata
+import io
+import os
+import signal
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from sciengdox.pandoc_pythonexec import driver
+
+default_preload = ["numpy", "scipy", "matplotlib", "sciengdox", "sciengdox.units"]
+
+
+def pool_supported():
+    return hasattr(os, "fork") and hasattr(socket, "AF_UNIX")
+
+
+# The pool runs any code sent to it, so its socket is kept in a directory only
+# the user can access: the per-user runtime directory if there is one, or else
+# a private directory in the temporary directory.  The socket name includes
+# pool_key(), so that each environment and sciengdox version gets its own pool.
+def default_socket_path():
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if not runtime_dir:
+        runtime_dir = private_directory(
+            Path(tempfile.gettempdir()).joinpath(f"sciengdox-pythonexec-{os.getuid()}")
+        )
+    return str(
+        Path(runtime_dir).joinpath(
+            f"sciengdox-pythonexec-{getpass.getuser()}-{pool_key()}.sock"
+        )
+    )
+
+
+# Short hash of the interpreter, its environment, and the sciengdox version.  A
+# pool started from another virtual environment has different site-packages,
+# and one started before an upgrade may speak an older driver protocol.
+def pool_key():
+    try:
+        version = importlib.metadata.version("sciengdox")
+    except importlib.metadata.PackageNotFoundError:
+        version = ""
+    key = "\0".join([sys.executable, sys.prefix, version])
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()[:12]
+
+
+# Create a directory that only the user can access, or make sure an existing
+# one is such a directory
+def private_directory(path):
+    try:
+        os.mkdir(path, 0o700)
+    except FileExistsError:
+        pass
+    info = os.lstat(path)
+    if (
+        not stat.S_ISDIR(info.st_mode)
+        or info.st_uid != os.getuid()
+        or stat.S_IMODE(info.st_mode) & 0o077
+    ):
+        raise PermissionError(f"{path} is not a private directory of this user")
+    return path
+
+
+# Refuse to talk to a socket that another user created
+def check_socket_owner(socket_path):
+    if os.stat(socket_path).st_uid != os.getuid():
+        raise PermissionError(f"{socket_path} belongs to another user")
+
+
+def preload_modules(names):
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except Exception as e:
+            print(f"pythonexec pool: could not preload {name}: {e}", file=sys.stderr)
+
+
+# Send the initial message on a new connection to the pool.  The worker takes
+# on the environment of the filter that connected, and its working directory
+# unless `cwd` is given.
+async def open_pool_connection(socket_path, cwd=None):
+    check_socket_owner(socket_path)
+    reader, writer = await asyncio.open_unix_connection(socket_path)
+    setup = {"cwd": cwd or os.getcwd(), "env": dict(os.environ)}
+    writer.write(driver.encode_message(setup))
+    return reader, writer
+
+
+def pool_running(socket_path):
+    if not pool_supported() or not os.path.exists(socket_path):
+        return False
+    try:
+        check_socket_owner(socket_path)
+    except OSError:
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(socket_path)
+        except OSError:
+            return False
+    return True
+
+
+# Start a pool server in the background unless one is already listening
+def start_pool(socket_path, preload, executable=None, timeout=60):
+    if pool_running(socket_path):
+        return True
+
+    with open(f"{socket_path}.log", "ab") as log:
+        subprocess.Popen(
+            [
+                executable or sys.executable,
+                "-m",
+                "sciengdox.pandoc_pythonexec.pool",
+                "serve",
+                "--socket",
+                socket_path,
+                "--preload",
+                *preload,
+            ],
+            stdin=subprocess.DEVNULL,
+            stdout=log,
+            stderr=log,
+            start_new_session=True,
+        )
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if pool_running(socket_path):
+            return True
+        time.sleep(0.1)
+    return False
+
+
+def stop_pool(socket_path):
+    if not pool_running(socket_path):
+        return False
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        s.connect(socket_path)
+        s.sendall(driver.encode_message({"shutdown": True}))
+    return True
+
+
+# Handle one connection in a forked worker
+def run_worker(conn, server_pid):
+    protocol_in = conn.makefile("rb")
+    protocol_out = conn.makefile("wb")
+
+    setup = driver.read_message(protocol_in)
+    if setup is None:
+        return
+    if setup.get("shutdown"):
+        os.kill(server_pid, signal.SIGTERM)
+        return
+
+    os.chdir(setup["cwd"])
+    os.environ.clear()
+    os.environ.update(setup.get("env", {}))
+    sys.stdin = io.StringIO()
+    sys.argv = [""]
+    sys.path[0] = ""
+
+    driver.serve(protocol_in, protocol_out)
+
+
+# Set on SIGTERM.  The accept loop polls this rather than exiting from the
+# signal handler, which could interrupt the server in the middle of a fork.
+stopping = False
+
+
+def terminate(signum, frame):
+    global stopping
+    stopping = True
+
+
+def serve(socket_path, preload):
+    preload_modules(preload)
+
+    # Reap finished workers automatically, and clean up the socket on SIGTERM
+    signal.signal(signal.SIGCHLD, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, terminate)
+
+    # Don't take over the socket of a pool that is already running
+    if pool_running(socket_path):
+        print(f"pythonexec pool: already running on {socket_path}", file=sys.stderr)
+        return
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    # Only the user may connect
+    umask = os.umask(0o177)
+    try:
+        server.bind(socket_path)
+    finally:
+        os.umask(umask)
+    os.chmod(socket_path, 0o600)
+    server.listen()
+    server.settimeout(0.5)
+    server_pid = os.getpid()
+    print(f"pythonexec pool: listening on {socket_path}", file=sys.stderr, flush=True)
+
+    try:
+        while not stopping:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                continue
+            if os.fork() == 0:
+                # The worker must not clean up the server's socket on exit, so
+                # it leaves via os._exit() after running the exit handlers a
+                # regular interpreter would.
+                server.close()
+                signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                try:
+                    run_worker(conn, server_pid)
+                finally:
+                    atexit._run_exitfuncs()
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(0)
+            conn.close()
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pool of pre-warmed interpreters for pandoc-pythonexec"
+    )
+    parser.add_argument(
+        "command",
+        choices=["serve", "start", "stop", "status"],
+        help="serve in the foreground, start in the background, stop, or "
+        "check whether a pool is running",
+    )
+    parser.add_argument(
+        "--socket",
+        type=str,
+        help="path of the Unix socket the pool listens on",
+    )
+    parser.add_argument(
+        "--preload",
+        type=str,
+        nargs="*",
+        default=default_preload,
+        help="modules to import before forking workers",
+    )
+    args = parser.parse_args()
+
+    if not pool_supported():
+        print("The interpreter pool is not supported on this platform.")
+        exit(-1)
+    if args.socket is None:
+        args.socket = default_socket_path()
+
+    if args.command == "serve":
+        serve(args.socket, args.preload)
+    elif args.command == "start":
+        if not start_pool(args.socket, args.preload):
+            print(f"Could not start pool.  See {args.socket}.log")
+            exit(-1)
+        print(f"Pool running on {args.socket}")
+    elif args.command == "stop":
+        if not stop_pool(args.socket):
+            print("Pool is not running.")
+    elif args.command == "status":
+        running = pool_running(args.socket)
+        print(f"Pool is {'' if running else 'not '}running on {args.socket}")
+        exit(0 if running else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+import json
+import os
+import time
+import urllib.parse
+from pathlib import Path
+
+import panflute
+
+
+# Records how long the code in each element of the document took to run.
+#
+# If the path of the markdown source is known, elements are located by
+# searching the source for their code, continuing from where the previous
+# element of the same session was found, so the line numbers are approximate
+# for code that appears more than once.
+class ExecutionProfile(object):
+    def __init__(self, source=None):
+        self.records = []
+        self._source = source
+        self._source_lines = []
+        self._cursors = {}
+        if source:
+            try:
+                with open(source, "r", encoding="utf-8") as f:
+                    self._source_lines = f.read().splitlines()
+            except OSError:
+                pass
+
+    # Run `execution` (an awaitable executing the element's code) and record
+    # its statistics.  Elements without any code to run aren't recorded.
+    async def measure(self, elem, runner, session, execution):
+        code = self._code(elem)
+        before = self._runner_stats(runner)
+        start = time.perf_counter()
+        try:
+            return await execution
+        finally:
+            elapsed = time.perf_counter() - start
+            after = self._runner_stats(runner)
+            round_trips = after["round_trips"] - before["round_trips"]
+            cache_hits = after["cache_hits"] - before["cache_hits"]
+            if round_trips or cache_hits:
+                rss_delta = None
+                if after["peak_rss_kb"] is not None:
+                    rss_delta = after["peak_rss_kb"] - (before["peak_rss_kb"] or 0)
+                self.records.append(
+                    {
+                        "location": self._location(code, session),
+                        "element": type(elem).__name__,
+                        "session": session,
+                        "code": code.splitlines()[0][:80] if code else "",
+                        "seconds": elapsed,
+                        "round_trips": round_trips,
+                        "cache_hits": cache_hits,
+                        "output_bytes": after["output_bytes"] - before["output_bytes"],
+                        "peak_rss_delta_kb": rss_delta,
+                    }
+                )
+
+    def save(self, path):
+        path = Path(path)
+        tmp_file = path.with_name(path.name + ".tmp")
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"source": self._source, "elements": self.records}, f, indent=2)
+        os.replace(tmp_file, path)
+
+    def _runner_stats(self, runner):
+        return {
+            "round_trips": runner.round_trips,
+            "output_bytes": runner.output_bytes,
+            "peak_rss_kb": runner.peak_rss_kb,
+            "cache_hits": getattr(runner, "cache_hits", 0),
+        }
+
+    def _code(self, elem):
+        if isinstance(elem, panflute.Image):
+            return urllib.parse.unquote(elem.url)
+        return getattr(elem, "text", "")
+
+    # Each session is searched for separately since sessions run concurrently
+    def _location(self, code, session):
+        if not self._source_lines or not code.strip():
+            return self._source
+        needle = code.strip().splitlines()[0].strip()
+        cursor = self._cursors.get(session, 0)
+        count = len(self._source_lines)
+
+        # Prefer a line holding just the code (as in a code block) over a line
+        # containing it (as for inline code)
+        for matches in [
+            lambda line: line.strip() == needle,
+            lambda line: needle in line,
+        ]:
+            for offset in range(count):
+                i = (cursor + offset) % count
+                if matches(self._source_lines[i]):
+                    self._cursors[session] = i
+                    return f"{self._source}:{i + 1}"
+        return self._source
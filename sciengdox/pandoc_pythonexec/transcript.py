@@ -0,0 +1,161 @@
+import hashlib
+import os
+from collections import deque
+from pathlib import Path
+
+# Directory (relative to where pandoc runs) for the full output of code whose
+# output was truncated in the document
+spill_directory = "pythonexec-output"
+
+
+# An input line as shown in the transcript.  A blank line is shown as a space
+# to avoid the blank line getting dropped in HTML output.
+def echo_line(prompt, line, repl):
+    return (prompt if repl else "") + (line if line != "" else " ")
+
+
+# Builds the transcript of one request to the interpreter (echoed input lines
+# and their output) as the output arrives.  Text is kept as a list of pieces,
+# so building the transcript is linear in the size of the output.
+#
+# If `max_chars` is given, only the first and last `max_chars / 2` characters
+# are kept in memory.  Once the output exceeds the limit, the whole transcript
+# is also written to a file in `spill_dir`, which is named after a hash of its
+# contents when the transcript is finished, and the transcript shows a marker
+# in place of the omitted text that points to that file.
+class Transcript(object):
+    def __init__(self, max_chars=None, spill_dir=None):
+        self.spill_path = None
+        self._max_chars = max_chars
+        self._head_max = max_chars // 2 if max_chars else None
+        self._tail_max = max_chars - self._head_max if max_chars else None
+        self._spill_dir = spill_dir
+        self._head = []
+        self._head_len = 0
+        self._tail = deque()
+        self._tail_len = 0
+        self._length = 0
+        self._parts = 0
+        self._record_output = False
+        self._held_newline = False
+        self._truncated = False
+        self._spill = None
+        self._spill_file = None
+        self._spill_hash = None
+
+    # Start the record of a new input line, optionally echoing the line
+    def add_input(self, line=None):
+        self._record_output = False
+        self._held_newline = False
+        if line is not None:
+            self._add_part(line)
+
+    # Add output of the current input line.  One trailing newline of each
+    # line's output is dropped, as the transcript joins the parts with newlines.
+    def add_output(self, text):
+        if not text:
+            return
+        if not self._record_output:
+            self._record_output = True
+            self._add_part("")
+        elif self._held_newline:
+            self._write("\n")
+        self._held_newline = text.endswith("\n")
+        self._write(text[:-1] if self._held_newline else text)
+
+    # Close the spill file, if any, and give it its final name
+    def finish(self):
+        if self._spill is None:
+            return
+        self._spill.close()
+        self._spill = None
+        self.spill_path = Path(self._spill_dir).joinpath(
+            self._spill_hash.hexdigest()[:16] + ".txt"
+        )
+        os.replace(self._spill_file, self.spill_path)
+
+    def text(self):
+        head = "".join(self._head)
+        tail = "".join(self._tail)
+        if not self._truncated:
+            return head + tail
+
+        # Cut the kept text at line boundaries
+        cut = head.rfind("\n")
+        if cut >= 0:
+            head = head[: cut + 1]
+        cut = tail.find("\n")
+        if cut >= 0:
+            tail = tail[cut:]
+        omitted = self._length - len(head) - len(tail)
+
+        marker = f"[... {omitted:,} characters omitted"
+        if self.spill_path is not None:
+            marker += f", full output in {self.spill_path.as_posix()}"
+        marker += " ...]"
+        if not head.endswith("\n"):
+            head += "\n"
+        if not tail.startswith("\n"):
+            tail = "\n" + tail
+        return head + marker + tail
+
+    def _add_part(self, text):
+        if self._parts:
+            text = "\n" + text
+        self._parts += 1
+        self._write(text)
+
+    def _write(self, text):
+        if not text:
+            return
+        self._length += len(text)
+        if self._spill is not None:
+            self._write_spill(text)
+        elif self._max_chars and self._length > self._max_chars:
+            self._truncated = True
+            self._open_spill()
+            if self._spill is not None:
+                self._write_spill(text)
+
+        if self._head_max is None or self._head_len < self._head_max:
+            piece = (
+                text
+                if self._head_max is None
+                else text[: self._head_max - self._head_len]
+            )
+            self._head.append(piece)
+            self._head_len += len(piece)
+            text = text[len(piece) :]
+        if text:
+            self._tail.append(text)
+            self._tail_len += len(text)
+            if self._truncated:
+                self._trim_tail()
+
+    def _trim_tail(self):
+        while self._tail_len - len(self._tail[0]) >= self._tail_max:
+            self._tail_len -= len(self._tail.popleft())
+        excess = self._tail_len - self._tail_max
+        if excess > 0:
+            self._tail[0] = self._tail[0][excess:]
+            self._tail_len -= excess
+
+    # Start writing the full transcript to a file, beginning with the text kept
+    # so far (which is everything, since nothing is dropped before this)
+    def _open_spill(self):
+        if self._spill_dir is None:
+            return
+        Path(self._spill_dir).mkdir(parents=True, exist_ok=True)
+        self._spill_file = Path(self._spill_dir).joinpath(
+            f".output-{os.getpid()}-{id(self)}.tmp"
+        )
+        self._spill = open(self._spill_file, "w", encoding="utf-8", newline="")
+        self._spill_hash = hashlib.sha256()
+        for piece in self._head:
+            self._write_spill(piece)
+        for piece in self._tail:
+            self._write_spill(piece)
+
+    def _write_spill(self, text):
+        self._spill.write(text)
+        self._spill_hash.update(text.encode("utf-8", "replace"))
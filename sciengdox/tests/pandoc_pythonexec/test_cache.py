@@ -0,0 +1,67 @@
+import asyncio
+
+from sciengdox.pandoc_pythonexec.cache import CachingRunner, ExecutionCache
+
+
+# Stands in for PythonRunner, recording the code it runs
+class RecordingRunner(object):
+    def __init__(self):
+        self.started = False
+        self.ran = []
+
+    async def start(self):
+        self.started = True
+        return ""
+
+    async def run_lines(self, lines, echo_input=True, repl=False, timeout=None):
+        assert self.started
+        self.ran.append(lines)
+        return "ran " + "; ".join(lines)
+
+    def pop_displays(self):
+        return []
+
+    async def close(self):
+        pass
+
+
+def build(cache_dir, blocks):
+    async def run():
+        runner = RecordingRunner()
+        caching_runner = CachingRunner(runner, ExecutionCache(cache_dir, "test"))
+        await caching_runner.start()
+        outputs = [await caching_runner.run_lines(lines) for lines in blocks]
+        await caching_runner.close()
+        return outputs, runner
+
+    return asyncio.run(run())
+
+
+blocks = [["a = 1"], ["b = a + 1"], ["print(b)"]]
+
+
+def test_unchanged_code_is_replayed_without_starting_an_interpreter(tmp_path):
+    outputs, _ = build(tmp_path, blocks)
+    replayed, runner = build(tmp_path, blocks)
+
+    assert replayed == outputs == ["ran a = 1", "ran b = a + 1", "ran print(b)"]
+    assert not runner.started
+
+
+def test_changed_block_invalidates_every_later_block(tmp_path):
+    build(tmp_path, blocks)
+    changed = [blocks[0], ["b = a + 2"], blocks[2]]
+    outputs, runner = build(tmp_path, changed)
+
+    # The unchanged first block is run again (without its output) to rebuild
+    # the interpreter's state, and everything from the changed block on runs
+    assert runner.ran == changed
+    assert outputs == ["ran a = 1", "ran b = a + 2", "ran print(b)"]
+
+
+def test_entries_not_used_by_a_build_are_pruned(tmp_path):
+    build(tmp_path, blocks)
+    build(tmp_path, blocks[:1])
+    _, runner = build(tmp_path, blocks)
+
+    assert runner.ran == blocks
@@ -0,0 +1,81 @@
+import asyncio
+import math
+import sys
+import threading
+
+import pytest
+
+from sciengdox.pandoc_pythonexec import driver
+from sciengdox.pandoc_pythonexec.cache import CachingRunner, ExecutionCache
+from sciengdox.pandoc_pythonexec.filter import PythonRunner
+
+needs_pickler = pytest.mark.skipif(
+    driver.checkpoint_pickler() is None, reason="requires cloudpickle or dill"
+)
+
+
+@needs_pickler
+def test_checkpoint_skips_variables_that_cannot_be_pickled(tmp_path):
+    namespace = {"x": [1, 2], "lock": threading.Lock(), "__name__": "__main__"}
+    path = tmp_path.joinpath("checkpoint.pkl")
+    assert driver.save_checkpoint(namespace, path) == ["lock"]
+
+    restored = {}
+    assert driver.restore_checkpoint(restored, path) == ["lock"]
+    assert restored == {"x": [1, 2]}
+
+
+@needs_pickler
+def test_modules_are_saved_by_name_and_imported_on_restore(tmp_path):
+    path = tmp_path.joinpath("checkpoint.pkl")
+    assert driver.save_checkpoint({"m": math, "x": 3}, path) == []
+
+    restored = {}
+    assert driver.restore_checkpoint(restored, path) == []
+    assert restored == {"m": math, "x": 3}
+
+
+def test_checkpoints_are_not_saved_with_plain_pickle(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "cloudpickle", None)
+    monkeypatch.setitem(sys.modules, "dill", None)
+    path = tmp_path.joinpath("checkpoint.pkl")
+
+    reply = driver.run_checkpoint_request(
+        {"math": math, "x": 3}, {"checkpoint": str(path)}
+    )
+    assert "cloudpickle or dill" in reply["error"]
+    assert not path.exists()
+
+
+def build(cache_dir, blocks):
+    async def run():
+        runner = CachingRunner(
+            PythonRunner(sys.executable), ExecutionCache(cache_dir, "test")
+        )
+        await runner.start()
+        results = [
+            await runner.run_lines(lines, echo_input=False, checkpoint=checkpoint)
+            for lines, checkpoint in blocks
+        ]
+        await runner.close()
+        return results
+
+    return asyncio.run(run())
+
+
+@needs_pickler
+def test_rebuild_resumes_from_the_last_checkpoint(tmp_path):
+    runs = tmp_path.joinpath("runs.txt")
+    expensive = [
+        f"open({str(runs)!r}, 'a').write('x')",
+        "def triple(x):",
+        "    return 3 * x",
+        "",
+        "value = 14",
+    ]
+    blocks = [(expensive, True), (["value += 1"], False), (["print(value)"], False)]
+    assert build(tmp_path, blocks)[-1] == "15"
+
+    blocks[-1] = (["print(triple(value))"], False)
+    assert build(tmp_path, blocks)[-1] == "45"
+    assert runs.read_text() == "x"
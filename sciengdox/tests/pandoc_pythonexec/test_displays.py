@@ -0,0 +1,52 @@
+import os
+
+from sciengdox.pandoc_pythonexec.displays import Displays, display_key
+
+
+def test_displays_with_a_path_are_written_to_that_file(tmp_path):
+    path = tmp_path.joinpath("figures", "a.svg")
+    displays = Displays()
+    displays.add([({"mime": "image/svg+xml", "key": "a", "path": str(path)}, b"<svg>")])
+
+    assert path.read_bytes() == b"<svg>"
+    assert displays.pop("a") is None
+
+
+def test_relative_paths_are_relative_to_the_code_directory(tmp_path):
+    displays = Displays(tmp_path)
+    displays.add([({"mime": "image/svg+xml", "key": "a", "path": "f/a.svg"}, b"<svg>")])
+
+    assert tmp_path.joinpath("f", "a.svg").read_bytes() == b"<svg>"
+
+
+def test_displays_do_not_rewrite_unchanged_files(tmp_path):
+    path = tmp_path.joinpath("a.svg")
+    path.write_bytes(b"<svg>")
+    os.utime(path, (0, 0))
+
+    description = {"mime": "image/svg+xml", "key": "a", "path": str(path)}
+    Displays().add([(description, b"<svg>")])
+    assert path.stat().st_mtime == 0
+
+    Displays().add([(description, b"<svg/>")])
+    assert path.read_bytes() == b"<svg/>"
+
+
+def test_displays_without_a_path_are_kept_until_taken():
+    html = b"<div>plot</div>"
+    key = display_key(html)
+    displays = Displays()
+    displays.add([({"mime": "text/html", "key": key, "path": None}, html)])
+
+    assert displays.pop(key) == ({"mime": "text/html", "key": key, "path": None}, html)
+    assert displays.pop(key) is None
+
+
+def test_inline_displays_are_kept_until_their_element_takes_them():
+    description = {"mime": "image/png", "key": "a", "path": None, "inline": True}
+    displays = Displays()
+    displays.add([(description, b"png")])
+
+    assert displays.pop("a") is None
+    assert displays.pop_inline() == [(description, b"png")]
+    assert displays.pop_inline() == []
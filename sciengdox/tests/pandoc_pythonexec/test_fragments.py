@@ -0,0 +1,34 @@
+import panflute
+
+from sciengdox.pandoc_pythonexec.fragments import FragmentConverter, simple_inlines
+
+
+def test_simple_inlines_converts_quantities():
+    inlines = simple_inlines("9.810 m/s^2^")
+    assert [type(i) for i in inlines] == [
+        panflute.Str,
+        panflute.Space,
+        panflute.Str,
+        panflute.Superscript,
+    ]
+    assert [panflute.stringify(i) for i in inlines] == ["9.810", " ", "m/s", "2"]
+
+
+def test_simple_inlines_leaves_markdown_to_pandoc():
+    for text in ["**bold**", "a_b", "- item", "1. x", "it's", "a -- b", "x^a b^"]:
+        assert simple_inlines(text) is None
+
+
+def test_fragments_are_converted_in_one_batch():
+    converted = []
+    converter = FragmentConverter()
+    converter.add("**bold**", converted.append)
+    converter.add("# Heading", converted.append)
+    converter.add("::: {.note}\nnested\n:::", converted.append)
+    converter.convert()
+
+    assert isinstance(converted[0], panflute.Para)
+    assert isinstance(converted[0].content[0], panflute.Strong)
+    assert isinstance(converted[1], panflute.Header)
+    assert isinstance(converted[2], panflute.Div)
+    assert converted[2].classes == ["note"]
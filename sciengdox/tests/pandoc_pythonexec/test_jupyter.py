@@ -0,0 +1,71 @@
+import asyncio
+import base64
+import sys
+
+import panflute
+import pytest
+
+from sciengdox.pandoc_pythonexec.filter import walk_and_execute_code
+from sciengdox.pandoc_pythonexec.jupyter import JupyterRunner, group_statements
+
+
+def test_group_statements_splits_lines_like_the_console():
+    lines = [
+        "x = 1",
+        "for i in range(2):",
+        "    print(i)",
+        "",
+        "def f():",
+        "    return (1,",
+        "            2)",
+    ]
+    assert list(group_statements(lines)) == [
+        ["x = 1"],
+        ["for i in range(2):", "    print(i)", ""],
+        ["def f():", "    return (1,", "            2)"],
+    ]
+
+
+def test_group_statements_leaves_syntax_errors_to_the_kernel():
+    assert list(group_statements(["x = = 1", "y = 2"])) == [["x = = 1"], ["y = 2"]]
+
+
+def test_jupyter_runner_transcript_matches_python_runner():
+    pytest.importorskip("jupyter_client")
+    pytest.importorskip("ipykernel")
+
+    async def run():
+        runner = JupyterRunner()
+        await runner.start()
+        try:
+            block = await runner.run_lines(
+                ["x = 2", "x * 3", "for i in range(2):", "    print(i)"], repl=True
+            )
+            inline = await runner.run_lines(["print(x)"], echo_input=False)
+        finally:
+            await runner.close()
+        return block, inline
+
+    block, inline = asyncio.run(run())
+    assert (
+        block
+        == ">>> x = 2\n>>> x * 3\n6\n>>> for i in range(2):\n...     print(i)\n0\n1"
+    )
+    assert inline == "2"
+
+
+def test_images_in_display_data_are_shown_after_their_block():
+    pytest.importorskip("jupyter_client")
+    pytest.importorskip("ipykernel")
+    source = (
+        "---\npythonexec-backend: jupyter\n---\n\n"
+        "```{.python}\nfrom IPython.display import SVG, display\n"
+        "display(SVG('<svg xmlns=\"http://www.w3.org/2000/svg\"/>'))\n```\n"
+    )
+    doc = panflute.convert_text(source, standalone=True)
+    asyncio.run(walk_and_execute_code(doc, sys.executable))
+
+    (para,) = doc.content
+    (image,) = para.content
+    assert image.url.startswith("data:image/svg+xml;base64,")
+    assert base64.b64decode(image.url.split(",")[1]).startswith(b"<svg")
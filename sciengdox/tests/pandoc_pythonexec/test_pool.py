@@ -0,0 +1,66 @@
+import asyncio
+import importlib.metadata
+import os
+import stat
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+from sciengdox.pandoc_pythonexec import pool
+
+pytestmark = pytest.mark.skipif(
+    not pool.pool_supported(), reason="interpreter pool not supported"
+)
+
+repo_root = Path(__file__).parents[3]
+
+
+def test_default_socket_is_in_a_private_directory(monkeypatch, tmp_path):
+    monkeypatch.delenv("XDG_RUNTIME_DIR", raising=False)
+    monkeypatch.setattr(tempfile, "gettempdir", lambda: str(tmp_path))
+
+    directory = Path(pool.default_socket_path()).parent
+    assert directory.parent == tmp_path
+    assert stat.S_IMODE(directory.stat().st_mode) == 0o700
+
+
+def test_directories_others_can_access_are_not_used(tmp_path):
+    directory = tmp_path.joinpath("shared")
+    directory.mkdir()
+    directory.chmod(0o777)
+    with pytest.raises(PermissionError):
+        pool.private_directory(directory)
+
+
+def test_pool_socket_is_only_used_by_its_owner(monkeypatch):
+    monkeypatch.setenv("PYTHONPATH", str(repo_root))
+    socket_path = os.path.join(tempfile.mkdtemp(), "pool.sock")
+    assert pool.start_pool(socket_path, [])
+    try:
+        assert stat.S_IMODE(os.stat(socket_path).st_mode) == 0o600
+
+        uid = os.getuid()
+        monkeypatch.setattr(os, "getuid", lambda: uid + 1)
+        assert not pool.pool_running(socket_path)
+        with pytest.raises(PermissionError):
+            asyncio.run(pool.open_pool_connection(socket_path))
+    finally:
+        monkeypatch.undo()
+        pool.stop_pool(socket_path)
+
+
+def test_each_environment_and_version_gets_its_own_socket(monkeypatch, tmp_path):
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    socket_path = pool.default_socket_path()
+    assert socket_path == pool.default_socket_path()
+
+    monkeypatch.setattr(sys, "executable", "/other/venv/bin/python")
+    monkeypatch.setattr(sys, "prefix", "/other/venv")
+    assert pool.default_socket_path() != socket_path
+    monkeypatch.undo()
+
+    monkeypatch.setenv("XDG_RUNTIME_DIR", str(tmp_path))
+    monkeypatch.setattr(importlib.metadata, "version", lambda name: "99.0.0")
+    assert pool.default_socket_path() != socket_path
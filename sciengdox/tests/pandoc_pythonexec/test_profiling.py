@@ -0,0 +1,46 @@
+import asyncio
+
+import panflute
+
+from sciengdox.pandoc_pythonexec.profiling import ExecutionProfile
+
+
+class FakeRunner(object):
+    round_trips = 0
+    output_bytes = 0
+    peak_rss_kb = 1000
+
+    async def run(self, output):
+        self.round_trips += 1
+        self.output_bytes += len(output)
+        self.peak_rss_kb += 24
+
+
+def test_profile_records_statistics_and_source_lines(tmp_path):
+    source = tmp_path.joinpath("doc.md")
+    source.write_text(
+        "# Title\n\n```{.python}\nx = 1\n```\n\nText `print(x)`{.python}.\n"
+    )
+    profile = ExecutionProfile(str(source))
+    runner = FakeRunner()
+
+    async def measure_all():
+        await profile.measure(
+            panflute.CodeBlock("x = 1"), runner, None, runner.run("abc")
+        )
+        await profile.measure(
+            panflute.Code("print(x)"), runner, "other", runner.run("")
+        )
+        await profile.measure(panflute.Code("y"), runner, None, asyncio.sleep(0))
+
+    asyncio.run(measure_all())
+
+    # Elements that didn't run any code aren't recorded
+    assert len(profile.records) == 2
+    block, inline = profile.records
+    assert block["location"] == f"{source}:4"
+    assert block["round_trips"] == 1
+    assert block["output_bytes"] == 3
+    assert block["peak_rss_delta_kb"] == 24
+    assert inline["location"] == f"{source}:7"
+    assert inline["session"] == "other"
@@ -0,0 +1,26 @@
+import panflute
+
+from sciengdox.pandoc_pythonexec.filter import (
+    apply_postponed_replacements,
+    postpone_replacement,
+)
+
+
+def test_postponed_replacements_match_elements_by_identity():
+    first = panflute.Para(panflute.Str("same"))
+    second = panflute.Para(panflute.Str("same"))
+    doc = panflute.Doc(first, panflute.Div(second))
+    doc.postponed_replacements = {}
+
+    postpone_replacement(
+        doc,
+        doc.content[1].content[0],
+        [panflute.RawBlock("<hr>"), panflute.Para(panflute.Str("new"))],
+    )
+    apply_postponed_replacements(doc)
+
+    assert doc.content[0] is first
+    div = doc.content[1]
+    assert isinstance(div.content[0], panflute.RawBlock)
+    assert panflute.stringify(div.content[1]).strip() == "new"
+    assert len(div.content) == 2
@@ -0,0 +1,166 @@
+import asyncio
+import sys
+
+from sciengdox.pandoc_pythonexec.filter import ExecutionTimeout, PythonRunner
+
+
+def run_blocks(*blocks):
+    async def run():
+        runner = PythonRunner(sys.executable)
+        await runner.start()
+        results = [await runner.run_lines(lines, **kwargs) for lines, kwargs in blocks]
+        await runner.close()
+        return results
+
+    return asyncio.run(run())
+
+
+block = ["x = 3", "for i in range(2):", "    print(i)", "", 'print("a")']
+
+
+def test_run_lines_echoes_input_and_output():
+    (result,) = run_blocks((block, {}))
+    assert result == 'x = 3\nfor i in range(2):\n    print(i)\n \n0\n1\nprint("a")\na'
+
+
+def test_run_lines_shows_prompts_for_repl_blocks():
+    (result,) = run_blocks((block, {"repl": True}))
+    assert result == (
+        ">>> x = 3\n>>> for i in range(2):\n...     print(i)\n...  \n0\n1\n"
+        '>>> print("a")\na'
+    )
+
+
+def test_run_lines_keeps_state_between_blocks():
+    _, result = run_blocks((["y = 6"], {}), (["y * 7"], {"echo_input": False}))
+    assert result == "42"
+
+
+def test_run_lines_keeps_indented_block_with_blank_lines_together():
+    lines = ["def f():", "    a = 1", "", "    return a", "", "f()"]
+    (result,) = run_blocks((lines, {"echo_input": False}))
+    assert result == "1"
+
+
+def test_run_lines_includes_tracebacks():
+    (result,) = run_blocks((["1/0"], {"echo_input": False}))
+    assert result.splitlines()[-1] == "ZeroDivisionError: division by zero"
+
+
+def test_run_lines_does_not_drop_output_that_looks_like_a_prompt():
+    (result,) = run_blocks((['print(">>> not a prompt")'], {"echo_input": False}))
+    assert result == ">>> not a prompt"
+
+
+def test_run_lines_keeps_order_of_stdout_and_stderr():
+    lines = [
+        "import sys",
+        "print(1, file=sys.stderr); print(2); print(3, file=sys.stderr)",
+    ]
+    (result,) = run_blocks((lines, {"echo_input": False}))
+    assert result == "1\n2\n3"
+
+
+def test_run_lines_handles_output_without_trailing_newline():
+    lines = ['print("abc", end="")', 'print("def")']
+    (result,) = run_blocks((lines, {"echo_input": False}))
+    assert result == "abc\ndef"
+
+
+def test_run_lines_finishes_a_statement_left_open_at_the_end_of_a_block():
+    result, after = run_blocks(
+        (["for i in range(2):", "    print(i)"], {}), (["print('x')"], {})
+    )
+    assert result == "for i in range(2):\n    print(i)\n0\n1"
+    assert after == "print('x')\nx"
+
+
+def test_run_lines_interrupts_code_that_times_out():
+    async def run():
+        runner = PythonRunner(sys.executable)
+        await runner.start()
+        try:
+            await runner.run_lines(
+                ["import time", "print('a')", "time.sleep(10)", "print('b')"],
+                timeout=0.5,
+            )
+        except ExecutionTimeout as e:
+            timeout = e
+        after = await runner.run_lines(["print('c')"])
+        await runner.close()
+        return timeout, after
+
+    timeout, after = asyncio.run(run())
+    assert "a\ntime.sleep(10)" in timeout.output
+    assert timeout.output.endswith("KeyboardInterrupt")
+    assert "b" not in timeout.output.split("\n")
+    assert after == "print('c')\nc"
+
+
+def test_run_lines_receives_display_objects_apart_from_output():
+    async def run():
+        runner = PythonRunner(sys.executable)
+        await runner.start()
+        output = await runner.run_lines(
+            [
+                "print('before')",
+                "pythonexec_display.publish('image/png', b'\\x00\\xff>>> ', 'key')",
+                "print('after')",
+            ],
+            echo_input=False,
+        )
+        displays = runner.pop_displays()
+        await runner.close()
+        return output, displays
+
+    output, displays = asyncio.run(run())
+    assert output == "before\nafter"
+    assert displays == [
+        ({"mime": "image/png", "key": "key", "path": None}, b"\x00\xff>>> ")
+    ]
+
+
+def test_display_objects_rendered_in_background_are_sent_when_ready():
+    async def run():
+        runner = PythonRunner(sys.executable)
+        await runner.start()
+        await runner.run_lines(
+            [
+                "from concurrent.futures import Future, ThreadPoolExecutor",
+                "ready, replaced = Future(), Future()",
+                "pythonexec_display.publish('text/plain', replaced, 'a', path='a')",
+                "pythonexec_display.publish('text/plain', ready, 'a', path='a')",
+                "slow = ThreadPoolExecutor().submit(lambda: __import__('time')"
+                ".sleep(0.2) or 'slow')",
+                "pythonexec_display.publish('text/plain', slow, 'b', path='b')",
+            ]
+        )
+        before_ready = runner.pop_displays()
+        await runner.run_lines(["ready.set_result(b'ready')", "replaced.cancelled()"])
+        after_ready = runner.pop_displays()
+        await runner.wait_for_displays()
+        after_wait = runner.pop_displays()
+        output = await runner.run_lines(["print(replaced.cancelled())"], False)
+        await runner.close()
+        return before_ready, after_ready, after_wait, output
+
+    before_ready, after_ready, after_wait, output = asyncio.run(run())
+    assert before_ready == []
+    assert after_ready == [({"mime": "text/plain", "key": "a", "path": "a"}, b"ready")]
+    assert after_wait == [({"mime": "text/plain", "key": "b", "path": "b"}, b"slow")]
+    assert output == "True"
+
+
+def test_code_runs_in_the_given_directory(tmp_path):
+    tmp_path.joinpath("data.csv").write_text("1,2\n")
+
+    async def run():
+        runner = PythonRunner(sys.executable, cwd=str(tmp_path))
+        await runner.start()
+        output = await runner.run_lines(
+            ["print(open('data.csv').read().strip())"], False
+        )
+        await runner.close()
+        return output
+
+    assert asyncio.run(run()) == "1,2"
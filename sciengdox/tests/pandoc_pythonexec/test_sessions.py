@@ -0,0 +1,31 @@
+import asyncio
+import sys
+
+import panflute
+
+from sciengdox.pandoc_pythonexec.filter import walk_and_execute_code
+
+source = """
+```{.python}
+x = "main"
+```
+
+```{.python session=other}
+x = "other"
+```
+
+Main `print(x)`{.python}, other `print(x)`{.python session=other}.
+
+```{.python .echo session=other}
+print(x * 2)
+```
+"""
+
+
+def test_sessions_run_in_separate_interpreters():
+    doc = panflute.convert_text(source, standalone=True)
+    asyncio.run(walk_and_execute_code(doc, sys.executable))
+
+    assert len(doc.content) == 2
+    assert panflute.stringify(doc.content[0]).strip() == "Main main, other other."
+    assert doc.content[1].text == "print(x * 2)\notherother"
@@ -0,0 +1,50 @@
+from sciengdox.pandoc_pythonexec.transcript import Transcript
+
+
+def build(transcript, records):
+    for line, outputs in records:
+        transcript.add_input(line)
+        for text in outputs:
+            transcript.add_output(text)
+    transcript.finish()
+    return transcript.text()
+
+
+def test_transcript_joins_input_and_output_lines():
+    records = [
+        ("print('a')", ["a", "\n"]),
+        ("print('b\\n')", ["b\n\n"]),
+        (" ", []),
+        ("x", ["\n"]),
+    ]
+    assert build(Transcript(), records) == ("print('a')\na\nprint('b\\n')\nb\n\n \nx\n")
+
+
+def test_transcript_without_echoed_input():
+    records = [(None, ["\n"]), (None, []), (None, ["x\n"])]
+    assert build(Transcript(), records) == "\nx"
+
+
+def test_long_transcript_keeps_head_and_tail_and_spills_the_rest(tmp_path):
+    lines = [f"line {i}" for i in range(1000)]
+    transcript = Transcript(200, tmp_path)
+    text = build(transcript, [("loop()", [line + "\n" for line in lines])])
+
+    head, marker = text.split("[... ")
+    marker, tail = marker.split(" ...]")
+    assert head.startswith("loop()\nline 0\nline 1\n")
+    assert tail.endswith("\nline 998\nline 999")
+    assert len(text) < 400
+    assert marker.endswith(
+        f"characters omitted, full output in {transcript.spill_path.as_posix()}"
+    )
+    assert transcript.spill_path.parent == tmp_path
+    assert transcript.spill_path.read_text() == "\n".join(["loop()"] + lines)
+    assert list(tmp_path.iterdir()) == [transcript.spill_path]
+
+
+def test_long_transcript_without_spill_directory():
+    transcript = Transcript(100)
+    text = build(transcript, [(None, ["x" * 1000])])
+    assert text == "x" * 50 + "\n[... 900 characters omitted ...]\n" + "x" * 50
+    assert transcript.spill_path is None
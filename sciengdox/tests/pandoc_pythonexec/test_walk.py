@@ -0,0 +1,79 @@
+import asyncio
+
+import panflute
+
+from sciengdox.pandoc_pythonexec.filter import async_walk
+
+
+def walk(doc, action, types):
+    return asyncio.run(async_walk(doc, action, doc, types=types))
+
+
+def test_async_walk_applies_action_in_document_order():
+    doc = panflute.convert_text("a `1` b\n\n- `2`\n\n> `3` and `4`", standalone=True)
+    seen = []
+
+    async def action(elem, doc):
+        seen.append(elem.text)
+        return panflute.Str(f"<{elem.text}>")
+
+    walk(doc, action, panflute.Code)
+    assert seen == ["1", "2", "3", "4"]
+    assert "<1>" in panflute.stringify(doc)
+    assert "<4>" in panflute.stringify(doc)
+
+
+def test_async_walk_splices_lists_and_sets_parents():
+    doc = panflute.convert_text("a `1` b", standalone=True)
+    parents = []
+
+    async def action(elem, doc):
+        parents.append(type(elem.parent))
+        return [panflute.Str("x"), panflute.Space(), panflute.Str("y")]
+
+    walk(doc, action, panflute.Code)
+    assert parents == [panflute.Para]
+    assert panflute.stringify(doc).strip() == "a x y b"
+
+
+def test_async_walk_handles_deeply_nested_documents():
+    inner = panflute.Para(panflute.Code("deep"))
+    for i in range(5000):
+        inner = panflute.BlockQuote(inner)
+    doc = panflute.Doc(inner)
+
+    async def action(elem, doc):
+        return panflute.Str("found")
+
+    walk(doc, action, panflute.Code)
+    while isinstance(inner, panflute.BlockQuote):
+        inner = inner.content[0]
+    assert isinstance(inner.content[0], panflute.Str)
+
+
+def test_async_walk_attaches_elements_like_panflute():
+    text = "a `1` *b `2`*\n\n- [c]{.x}\n"
+    types = (panflute.Code, panflute.Emph, panflute.Span)
+
+    def attachments(walker):
+        doc = panflute.convert_text(text, standalone=True)
+        seen = []
+
+        def record(elem, doc):
+            if isinstance(elem, types):
+                seen.append((type(elem.parent), elem.location, elem.index))
+
+        walker(doc, record)
+        return seen
+
+    async def record_async(record, elem, doc):
+        record(elem, doc)
+
+    expected = attachments(lambda doc, record: doc.walk(record))
+    actual = attachments(
+        lambda doc, record: walk(
+            doc, lambda elem, doc: record_async(record, elem, doc), types
+        )
+    )
+    assert actual == expected
+    assert len(expected) == 4
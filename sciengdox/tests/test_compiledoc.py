@@ -0,0 +1,296 @@
+import argparse
+import asyncio
+import json
+import shutil
+import sys
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+from sciengdox import compiledoc
+from sciengdox.compiledoc import replace_html_placeholders
+
+repo_root = Path(__file__).parents[2]
+
+
+def fragment(number, html):
+    return f"<!-- pythonexec-html {number} -->{html}<!-- /pythonexec-html {number} -->"
+
+
+def placeholder(number):
+    return f'<img src="broken_img_replace_me" data-pythonexec-html="{number}" />'
+
+
+def test_html_fragments_replace_their_placeholder_images():
+    html = (
+        fragment(0, "<div id='a'>A</div>")
+        + f"<p>{placeholder(0)}</p>"
+        + "<figure>"
+        + fragment(1, "<div id=''><script>1 < 2</script></div>")
+        + f"<p>{placeholder(1)}</p><figcaption>B</figcaption></figure>"
+    )
+    assert replace_html_placeholders(html) == (
+        "<p><div id='a'>A</div></p><figure><p><div id=''><script>1 < 2</script>"
+        "</div></p><figcaption>B</figcaption></figure>"
+    )
+
+
+def test_other_images_are_left_alone():
+    html = '<p><img src="a.png" id="fig:a" /></p>'
+    assert replace_html_placeholders(html) == html
+
+
+# Executable script in `directory` running the given Python code
+def script(directory, name, code):
+    path = directory.joinpath(name)
+    path.write_text(f"#!{sys.executable}\nimport sys\n{code}\n")
+    path.chmod(0o755)
+    return str(path)
+
+
+# Run compiledoc in `directory` with the filter from this checkout and a
+# pandoc-crossref stand-in that passes the document through
+@pytest.fixture
+def run_compiledoc(tmp_path, monkeypatch):
+    if shutil.which("pandoc") is None or sys.platform == "win32":
+        pytest.skip("requires pandoc")
+    bin_dir = tmp_path.joinpath("bin")
+    bin_dir.mkdir()
+    pythonexec = script(
+        bin_dir,
+        "pandoc-pythonexec",
+        f"sys.path.insert(0, {str(repo_root)!r})\n"
+        "from sciengdox.pandoc_pythonexec.filter import main\nmain()",
+    )
+    crossref = script(bin_dir, "pandoc-crossref", "sys.stdout.write(sys.stdin.read())")
+    monkeypatch.setenv("PYTHONPATH", str(repo_root))
+    monkeypatch.chdir(tmp_path)
+
+    def run(*args):
+        monkeypatch.setattr(
+            sys,
+            "argv",
+            ["compiledoc", "--pandoc-pythonexec", pythonexec]
+            + ["--pandoc-crossref", crossref, "--no-citeproc", "--md", *args],
+        )
+        compiledoc.main()
+
+    return run
+
+
+def test_code_can_read_static_files_copied_to_the_output_directory(
+    tmp_path, run_compiledoc
+):
+    tmp_path.joinpath("data.csv").write_text("1,2,3\n")
+    tmp_path.joinpath("doc.md").write_text(
+        "```{.python}\ntext = open('data.csv').read().strip()\n```\n\n"
+        "Data: `print(text)`{.python}\n"
+    )
+    run_compiledoc("--statics", "data.csv", "--", "doc.md")
+
+    assert "Data: 1,2,3" in tmp_path.joinpath("output", "doc.md").read_text()
+
+
+def test_formats_built_together_run_their_code_in_separate_directories(
+    tmp_path, run_compiledoc
+):
+    tmp_path.joinpath("images").mkdir()
+    tmp_path.joinpath("images", "logo.txt").write_text("logo")
+    tmp_path.joinpath("doc.md").write_text(
+        "```{.python}\nimport time\n"
+        "open('format.txt', 'w').write(document_output_format)\n"
+        "time.sleep(0.5)\n```\n\n"
+        "Format: `print(open('format.txt').read())`{.python}\n\n"
+        "Logo: `print(open('images/logo.txt').read())`{.python}\n"
+    )
+    run_compiledoc("--html", "--", "doc.md")
+
+    md = tmp_path.joinpath("output", "doc.md").read_text()
+    html = tmp_path.joinpath("output", "doc.html").read_text()
+    assert "Format: markdown" in md and "Logo: logo" in md
+    assert "Format: html" in html and "Logo: logo" in html
+    assert tmp_path.joinpath("output", "format.txt").read_text() in ["markdown", "html"]
+
+
+def test_exec_once_runs_the_code_once_for_all_formats(tmp_path, run_compiledoc):
+    tmp_path.joinpath("doc.md").write_text(
+        "```{.python}\nopen('runs.txt', 'a').write('x')\n```\n\n"
+        "Formats: `print(document_output_format, *document_output_formats)`"
+        "{.python}\n"
+    )
+    run_compiledoc("--html", "--exec-once", "--", "doc.md")
+
+    output_dir = tmp_path.joinpath("output")
+    assert output_dir.joinpath("runs.txt").read_text() == "x"
+    ast = json.loads(output_dir.joinpath("doc.json").read_text())
+    assert "pandoc-api-version" in ast
+    assert "Formats: json markdown html" in output_dir.joinpath("doc.md").read_text()
+    assert "Formats: json markdown html" in output_dir.joinpath("doc.html").read_text()
+
+
+# Document that counts how often its code runs in output/runs.txt
+@pytest.fixture
+def counting_document(tmp_path):
+    tmp_path.joinpath("template").mkdir()
+    tmp_path.joinpath("template", "style.txt").write_text("a")
+    tmp_path.joinpath("data.csv").write_text("1")
+    tmp_path.joinpath("doc.md").write_text(
+        "```{.python}\nopen('runs.txt', 'a').write('x')\n```\n"
+    )
+    return lambda: tmp_path.joinpath("output", "runs.txt").read_text()
+
+
+def test_unchanged_inputs_are_not_rebuilt(run_compiledoc, counting_document):
+    run_compiledoc("--statics", "data.csv", "--", "doc.md")
+    run_compiledoc("--statics", "data.csv", "--", "doc.md")
+    assert counting_document() == "x"
+
+
+@pytest.mark.parametrize(
+    "change, args",
+    [
+        (lambda: Path("template", "style.txt").write_text("b"), []),
+        (lambda: Path("data.csv").write_text("2"), []),
+        (lambda: None, ["--timeout", "30"]),
+        (lambda: None, ["--force"]),
+    ],
+    ids=["template", "static file", "option", "force"],
+)
+def test_changed_inputs_are_rebuilt(run_compiledoc, counting_document, change, args):
+    run_compiledoc("--statics", "data.csv", "--", "doc.md")
+    change()
+    run_compiledoc("--statics", "data.csv", *args, "--", "doc.md")
+    assert counting_document() == "xx"
+
+
+def test_builds_sharing_a_kernel_run_one_at_a_time(tmp_path, monkeypatch):
+    running = []
+    overlapped = []
+
+    async def build_format(name, *args):
+        running.append(name)
+        overlapped.append(len(running) > 1)
+        await asyncio.sleep(0.01)
+        running.remove(name)
+        return 0
+
+    monkeypatch.setattr(compiledoc, "build_format", build_format)
+    builds = [(name, [name], tmp_path.joinpath(name)) for name in ["md", "html"]]
+
+    def build(**options):
+        args = argparse.Namespace(force=True, **options)
+        manifest = compiledoc.BuildManifest(tmp_path)
+        compiledoc.build_formats(builds, None, tmp_path, args, manifest, "")
+
+    build(backend="python", kernel_connection=None)
+    assert overlapped == [False, True]
+
+    overlapped.clear()
+    build(backend="jupyter", kernel_connection="kernel.json")
+    assert overlapped == [False, False]
+
+
+def test_profile_is_a_flag_followed_by_the_input():
+    args = compiledoc.argument_parser().parse_args(["--profile", "doc.md"])
+    assert args.profile
+    assert args.profile_top == 10
+    assert args.input_md == ["doc.md"]
+
+    args = compiledoc.argument_parser().parse_args(
+        ["--profile", "--profile-top", "20", "doc.md"]
+    )
+    assert args.profile_top == 20
+
+
+@pytest.fixture
+def polled_document(tmp_path, monkeypatch):
+    monkeypatch.setattr(compiledoc, "Observer", None)
+    input_md = tmp_path.joinpath("doc.md")
+    input_md.write_text("one")
+    args = argparse.Namespace(
+        template_dir=str(tmp_path.joinpath("template")),
+        images_dir=str(tmp_path.joinpath("images")),
+        statics=[],
+    )
+    return input_md, args
+
+
+def test_wait_for_changes_polls_for_a_touched_file(polled_document):
+    input_md, args = polled_document
+    previous = compiledoc.watch_snapshot([input_md])
+
+    def touch():
+        time.sleep(0.1)
+        input_md.write_text("changed")
+
+    thread = threading.Thread(target=touch)
+    thread.start()
+    current = compiledoc.wait_for_changes(
+        [input_md], args, previous, interval=0.02, settle=0.02
+    )
+    thread.join()
+    assert current == compiledoc.watch_snapshot([input_md]) != previous
+
+
+def test_wait_for_changes_returns_edits_made_before_it_was_called(polled_document):
+    input_md, args = polled_document
+    previous = compiledoc.watch_snapshot([input_md])
+    input_md.write_text("edited during the build")
+
+    current = compiledoc.wait_for_changes(
+        [input_md], args, previous, interval=60, settle=0.02
+    )
+    assert current != previous
+
+
+def test_each_document_is_built_into_its_own_subdirectory():
+    output_dirs = compiledoc.document_output_dirs(
+        [Path("a.md"), Path("docs", "b.md")], Path("output")
+    )
+    assert output_dirs == [Path("output", "a"), Path("output", "b")]
+
+
+def test_documents_sharing_a_name_are_told_apart_by_their_path():
+    output_dirs = compiledoc.document_output_dirs(
+        [Path("x", "doc.md"), Path("y", "doc.md"), Path("x", "other.md")],
+        Path("output"),
+    )
+    assert output_dirs == [
+        Path("output", "x-doc"),
+        Path("output", "y-doc"),
+        Path("output", "other"),
+    ]
+
+
+def test_input_patterns_are_expanded_in_order_without_duplicates(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    for name in ["b.md", "a.md", "c.txt"]:
+        tmp_path.joinpath(name).write_text("")
+
+    input_files = compiledoc.expand_input_patterns(["c.txt", "*.md", "a.md"])
+    assert input_files == [Path("c.txt"), Path("a.md"), Path("b.md")]
+
+
+def test_input_patterns_without_matches_are_kept_as_given(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    assert compiledoc.expand_input_patterns(["missing*.md"]) == [Path("missing*.md")]
+
+
+def test_summary_shows_the_status_of_each_job(monkeypatch, capsys):
+    def build_document(input_md, output_dir, args):
+        if input_md.stem == "bad":
+            exit(2)
+
+    monkeypatch.setattr(compiledoc, "build_document", build_document)
+    results = [
+        compiledoc.build_document_job(Path(name), Path("output", name), None)
+        for name in ["good.md", "bad.md"]
+    ]
+    assert [code for _, code, _, _ in results] == [0, 2]
+
+    compiledoc.print_build_summary(results)
+    lines = capsys.readouterr().out.splitlines()
+    assert "ok" in next(line for line in lines if "good.md" in line)
+    assert "failed (2)" in next(line for line in lines if "bad.md" in line)
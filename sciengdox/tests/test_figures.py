@@ -1,6 +1,12 @@
+import asyncio
 import os
+import sys
+from pathlib import Path
 
+import panflute
+import pytest
 from sciengdox.figures import svg_figure
+from sciengdox.pandoc_pythonexec.filter import walk_and_execute_code
 from svg import RootSvg
 
 import matplotlib.figure
@@ -141,3 +147,235 @@ def test_svg_figure_saves_svg_diagram_to_correct_location(mocker):
     url = svg_figure(fig, "mysvgdiagram", figure_dir="figs", output_dir="outs")
     fig.write.assert_called_once_with("outs/figs/mysvgdiagram.svg")
     assert (url) == "figs/mysvgdiagram.svg"
+
+
+def test_svg_figure_publishes_figure_when_run_by_pandoc_pythonexec(
+    mocker, tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    fig = setup_mocks(mocker, False)
+    display = mocker.Mock()
+    mocker.patch.object(
+        sys.modules["__main__"], "pythonexec_display", display, create=True
+    )
+
+    url = svg_figure(fig, "myfigure", output_dir="outs")
+    assert url == "figures/myfigure.svg"
+    os.makedirs.assert_not_called()
+    display.publish.assert_called_once_with(
+        "image/svg+xml", b"", "figures/myfigure.svg", path="outs/figures/myfigure.svg"
+    )
+
+
+def test_svg_figure_renders_figures_in_worker_processes(tmp_path, monkeypatch):
+    # The interpreter runs in tmp_path, so it needs to find this checkout
+    monkeypatch.setenv("PYTHONPATH", str(Path(__file__).parents[2]))
+    monkeypatch.chdir(tmp_path)
+    source = """
+```{.python}
+import matplotlib.pyplot as plt
+from sciengdox.figures import svg_figure
+fig, ax = plt.subplots()
+ax.plot([1, 2], [3, 4])
+url = svg_figure(fig, "line")
+ax.set_title("changed after the call")
+```
+
+![Figure](`url`{.python})
+"""
+    doc = panflute.convert_text(source, standalone=True)
+    doc.metadata["pythonexec-figure-workers"] = panflute.MetaString("2")
+    asyncio.run(walk_and_execute_code(doc, sys.executable))
+
+    images = []
+    doc.walk(
+        lambda e, d: images.append(e.url) if isinstance(e, panflute.Image) else None
+    )
+    assert images == ["figures/line.svg"]
+    svg = tmp_path.joinpath("figures", "line.svg").read_text()
+    assert svg.startswith("<?xml")
+    assert "changed after the call" not in svg
+
+
+def test_svg_figure_only_publishes_figures_that_changed(mocker, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    display = mocker.Mock()
+    mocker.patch.object(
+        sys.modules["__main__"], "pythonexec_display", display, create=True
+    )
+    mocker.patch("sciengdox.figures.fingerprints._fingerprints", {})
+
+    def build(fig):
+        # Save the published figures as the filter would
+        display.reset_mock()
+        svg_figure(fig, "diagram")
+        for (mime, data, key), kwargs in display.publish.call_args_list:
+            tmp_path.joinpath(kwargs["path"]).parent.mkdir(exist_ok=True)
+            tmp_path.joinpath(kwargs["path"]).write_bytes(data)
+        return display.publish.call_count
+
+    assert build(RootSvg((0, 0, 10, 10))) == 1
+    assert build(RootSvg((0, 0, 10, 10))) == 0
+    assert build(RootSvg((0, 0, 20, 10))) == 1
+
+    # A figure whose file was changed since is saved again
+    tmp_path.joinpath("figures", "diagram.svg").write_text("")
+    assert build(RootSvg((0, 0, 20, 10))) == 1
+
+
+def test_matplotlib_figure_data_is_the_same_for_the_same_figure():
+    import matplotlib.pyplot as plt
+    from sciengdox.figures.figures import figure_data
+
+    def draw():
+        fig, ax = plt.subplots()
+        ax.plot([1, 2, 3], [3, 1, 2], clip_on=True)
+        data = figure_data(fig)
+        plt.close(fig)
+        return data
+
+    data = draw()
+    assert b"<dc:date>" not in data
+    assert draw() == data
+
+
+def test_svg_figure_saves_pdf_when_building_latex(mocker):
+    fig = setup_mocks(mocker, True)
+    mocker.patch.object(
+        sys.modules["__main__"], "document_output_format", "latex", create=True
+    )
+
+    url = svg_figure(fig, "myfigure")
+    assert url == "figures/myfigure.pdf"
+    fig.savefig_stub.assert_called_once_with("figures/myfigure.pdf", format="pdf")
+
+
+def test_svg_figure_keeps_svg_diagrams_when_building_latex(mocker):
+    setup_mocks(mocker, True)
+    mocker.patch.object(
+        sys.modules["__main__"], "document_output_format", "latex", create=True
+    )
+    fig = RootSvg((0, 1, 2, 3))
+    fig.write = mocker.stub()
+
+    assert svg_figure(fig, "diagram") == "figures/diagram.svg"
+
+
+def test_rasterized_only_rasterizes_dense_artists_while_saving():
+    import matplotlib.pyplot as plt
+    from sciengdox.figures import rasterized
+
+    fig, ax = plt.subplots()
+    (dense,) = ax.plot(range(1000), range(1000))
+    (sparse,) = ax.plot(range(10), range(10))
+    scatter = ax.scatter(range(1000), range(1000))
+    with rasterized(fig, 100):
+        assert dense.get_rasterized() and scatter.get_rasterized()
+        assert not sparse.get_rasterized()
+    assert not dense.get_rasterized() and not scatter.get_rasterized()
+    plt.close(fig)
+
+
+def test_minify_svg_drops_comments_and_indentation_and_rounds_numbers():
+    from sciengdox.figures import minify_svg
+
+    data = (
+        b'<svg>\n  <!-- a comment -->\n  <path d="M 1.23456 7.5 L 2.999 10"/>\n</svg>'
+    )
+    assert minify_svg(data) == b'<svg><path d="M 1.23 7.5 L 3 10"/></svg>'
+
+
+def test_minify_svg_leaves_numbers_in_text_alone():
+    from sciengdox.figures import minify_svg
+
+    data = b'<text x="1.23456">p = 0.0012</text><text>0.125</text>'
+    assert minify_svg(data) == b'<text x="1.23">p = 0.0012</text><text>0.125</text>'
+    data = b"<text>p = 0.0012</text><text>0.125</text>"
+    assert minify_svg(data) == data
+
+
+def test_typed_array_encodes_long_number_lists():
+    import base64
+
+    import numpy as np
+    from sciengdox.figures.interactive import compact_arrays, typed_array
+
+    values = [float(i) / 2 for i in range(100)]
+    spec = typed_array(values)
+    assert spec["dtype"] == "f8"
+    assert np.frombuffer(base64.b64decode(spec["bdata"]), "<f8").tolist() == values
+    assert typed_array([[1, 2]] * 100)["shape"] == "100,2"
+    assert typed_array([1, 2, 3]) is None
+    assert typed_array(["a"] * 100) is None
+
+    trace = {"x": list(range(100)), "name": "a", "marker": {"color": ["red"] * 100}}
+    compact = compact_arrays(trace)
+    assert compact["x"]["dtype"] == "i4"
+    assert compact["marker"] == trace["marker"]
+
+
+def test_svg_figure_saves_lazy_plotly_figures_next_to_shared_scripts(
+    tmp_path, monkeypatch
+):
+    go = pytest.importorskip("plotly.graph_objects")
+    monkeypatch.chdir(tmp_path)
+
+    fig = go.Figure(go.Scatter(x=list(range(1000)), y=list(range(1000))))
+    html = svg_figure(fig, "lazy", interactive="lazy")
+    svg_figure(fig, "again", interactive="lazy")
+
+    files = sorted(p.name for p in tmp_path.joinpath("figures").iterdir())
+    assert files[:3] == [".fingerprints.json", "again.js", "lazy.js"]
+    assert files[3].startswith("plotly-") and files[3].endswith(".min.js")
+    assert files[4:] == ["pythonexec-plotly.js"]
+    assert 'data-figure="figures/lazy.js"' in html
+    assert f'data-plotlyjs="figures/{files[3]}"' in html
+    assert html.endswith('<script src="figures/pythonexec-plotly.js"></script>')
+    assert len(tmp_path.joinpath("figures", "lazy.js").read_text()) < 20000
+
+
+def test_decimate_keeps_peaks_gaps_and_end_points():
+    import numpy as np
+    from sciengdox.figures import decimate
+
+    x = np.arange(100_000)
+    y = np.sin(x / 1000)
+    y[12_345] = 10
+    y[54_321] = -10
+    y[70_000] = np.nan
+    for method in ["minmax", "lttb"]:
+        xd, yd = decimate(x, y, 1000, method)
+        assert len(xd) <= 1000
+        assert xd[0] == 0 and xd[-1] == 99_999
+        assert np.all(np.diff(xd) > 0)
+        assert 12_345 in xd and 54_321 in xd
+    xd, yd = decimate(x, y, 1000)
+    assert 70_000 in xd
+
+
+def test_decimated_reduces_matplotlib_lines_while_saving():
+    import matplotlib.pyplot as plt
+    import numpy as np
+    from sciengdox.figures.decimation import decimated
+
+    fig, ax = plt.subplots()
+    (line,) = ax.plot(np.arange(10_000), np.arange(10_000) % 7)
+    with decimated(fig, True):
+        assert len(line.get_xdata()) <= 2 * ax.bbox.width + 1
+    assert len(line.get_xdata()) == 10_000
+    plt.close(fig)
+
+
+def test_decimated_plotly_copies_figure_and_keeps_full_data():
+    go = pytest.importorskip("plotly.graph_objects")
+    from sciengdox.figures.decimation import decimated_plotly
+
+    fig = go.Figure(
+        [go.Scatter(y=list(range(5000))), go.Scatter(y=[1, 2], mode="markers")]
+    )
+    decimated_fig, full_data, points = decimated_plotly(fig, 500)
+    assert points == 500
+    assert len(decimated_fig.data[0].y) <= 500
+    assert len(fig.data[0].y) == 5000
+    assert list(full_data) == [0]
+    assert len(full_data[0][1]) == 5000